@@ -1,14 +1,30 @@
 import logging
 import json
 import os
+import sys
+import signal
+import sqlite3
 import threading
 import asyncio
-from datetime import datetime
-from flask import Flask  
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+import time
+import bisect
+import heapq
+import math
+import collections
+import contextlib
+import difflib
+import functools
+import gzip
+import re
+import urllib.parse
+import weakref
+from datetime import datetime, timedelta
+from flask import Flask, Response
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.constants import ParseMode
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ApplicationBuilder
-from telegram.error import TelegramError, NetworkError, TimedOut
+from telegram.error import TelegramError, NetworkError, TimedOut, RetryAfter, Forbidden, BadRequest
+from telegram.request import HTTPXRequest
 
 # Logging sozlamalari
 logger = logging.getLogger(__name__)
@@ -17,6 +33,233 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# ==================== METRIKALAR ====================
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS = []  # /metrics da chiqariladigan barcha metrikalar
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Faqat o'sadigan hisoblagich (Prometheus counter)"""
+    
+    kind = "counter"
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()  # Flask threadi ham o'qiydi
+        METRICS.append(self)
+    
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+class Histogram:
+    """Davomiyliklar taqsimoti (Prometheus histogram)"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=METRIC_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # label -> [har bir bucket soni, yig'indi, jami soni]
+        self._lock = threading.Lock()
+        METRICS.append(self)
+    
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            item[0][index] += 1
+            item[1] += value
+            item[2] += 1
+    
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+class Gauge:
+    """Joriy qiymat - so'ralganda funksiyadan olinadi"""
+    
+    kind = "gauge"
+    
+    def __init__(self, name, help_text, value_fn):
+        self.name = name
+        self.help_text = help_text
+        self.value_fn = value_fn
+        METRICS.append(self)
+    
+    def samples(self):
+        value = self.value_fn()
+        if value is not None:
+            yield f"{self.name} {value}"
+
+def render_metrics():
+    """Barcha metrikalar Prometheus text formatida"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        try:
+            lines.extend(metric.samples())
+        except Exception as e:
+            logger.warning(f"⚠️ Metrika {metric.name} o'qilmadi: {e}")
+    return "\n".join(lines) + "\n"
+
+process_started_at = time.time()
+bot_started_at = None  # on_startup da o'rnatiladi
+last_update_at = None  # Oxirgi qayta ishlangan update vaqti
+
+UPDATES_TOTAL = Counter("bot_updates_total", "Handlerlar qabul qilgan updatelar", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handlerdan chiqib ketgan xatolar", ("handler",))
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Handler bajarilish vaqti", ("handler",))
+TELEGRAM_REQUESTS = Counter("telegram_api_requests_total", "Telegram Bot API so'rovlari (HTTP status yoki 'network')", ("method", "status"))
+TELEGRAM_LATENCY = Histogram("telegram_api_duration_seconds", "Telegram Bot API so'rovlari davomiyligi", ("method",))
+STORAGE_LATENCY = Histogram("bot_storage_duration_seconds", "Saqlash amallari davomiyligi", ("operation",))
+STORAGE_ERRORS = Counter("bot_storage_errors_total", "Saqlashdagi xatolar", ("operation",))
+OUTBOX_FAILURES = Counter("bot_outbox_failures_total", "Navbatdagi xabarlar: qayta urinish yoki tashlab yuborish", ("result",))
+
+def instrumented(handler):
+    """Handlerni o'lchash: updatelar soni, davomiyligi va xatolari"""
+    name = handler.__name__
+    
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        global last_update_at
+        last_update_at = time.time()
+        UPDATES_TOTAL.inc(handler=name)
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+    
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """Har bir Bot API so'rovini (handlerlar, navbat, broadcast) o'lchaydigan HTTP klient"""
+    
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            TELEGRAM_REQUESTS.inc(method=api_method, status="network")
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, method=api_method)
+        TELEGRAM_REQUESTS.inc(method=api_method, status=status)
+        return status, payload
+
+# ==================== PARALLEL ISHLASH (QULFLAR) ====================
+# Updatelar parallel ishlanadi (CONCURRENT_UPDATES). Bitta foydalanuvchining updatelari navbat bilan,
+# admin amallari esa har bir yozuv (ariza, to'lov) bo'yicha qulf ostida bajariladi.
+# Qulfni hech kim ushlamasa va kutmasa, u lug'atdan o'zi o'chib ketadi.
+_user_locks = weakref.WeakValueDictionary()  # user_id -> asyncio.Lock
+_entity_locks = weakref.WeakValueDictionary()  # (tur, kalit) -> asyncio.Lock
+
+def _get_lock(locks, key):
+    lock = locks.get(key)
+    if lock is None:
+        lock = locks[key] = asyncio.Lock()
+    return lock
+
+def user_lock(user_id):
+    """Foydalanuvchi updatelarini navbatga qo'yadigan qulf"""
+    return _get_lock(_user_locks, user_id)
+
+def entity_lock(kind, key):
+    """Bitta yozuv (masalan ('payment', payment_id)) ustidagi admin amallari uchun qulf"""
+    return _get_lock(_entity_locks, (kind, key))
+
+def serialized(handler):
+    """Bitta foydalanuvchining updatelari bir-biri bilan parallel ishlamasin"""
+    
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            return await handler(update, context)
+        async with user_lock(user.id):
+            return await handler(update, context)
+    
+    return wrapper
+
+# ==================== TAKRORIY AMALLARDAN HIMOYA ====================
+# Ariza va to'lov holatlari: faqat shu o'tishlarga ruxsat bor, yakuniy holatdan chiqib bo'lmaydi
+STATUS_TRANSITIONS = {
+    'pending': ('verified', 'rejected'),
+    'verified': (),
+    'rejected': (),
+}
+
+def status_transition_allowed(old_status, new_status):
+    """Holatni old_status dan new_status ga o'tkazish mumkinmi (holati yo'q eski yozuvlar - pending)"""
+    return new_status in STATUS_TRANSITIONS.get(old_status or 'pending', ())
+
+class IdempotencyCache:
+    """Oxirgi N ta kalitni eslab qolish (LRU): bir xil kalit ikkinchi marta kelsa takroriy hisoblanadi"""
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._keys = collections.OrderedDict()
+    
+    def claim(self, key):
+        """Kalit yangi bo'lsa uni band qilib True, oldin ko'rilgan bo'lsa False qaytaradi"""
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return False
+        self._keys[key] = True
+        if len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+        return True
+    
+    def release(self, key):
+        """Amal bajarilmay qolganda kalitni bo'shatish (qayta urinish mumkin bo'lsin)"""
+        self._keys.pop(key, None)
+
 # ==================== ERROR HANDLER ====================
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xatolarni boshqarish"""
@@ -171,9 +414,42 @@ def home():
 </html>
     """
 
+def health_status():
+    """Haqiqiy holat: (ma'lumot, HTTP status). Bot ishlamasa yoki navbat tiqilib qolsa 503.
+    
+    Navbat chuqurligi emas, eng eski xabarning kutish vaqti tekshiriladi: bitta haydovchi
+    tasdiqlanganda obunachilarga minglab xabar qo'yilishi normal holat.
+    """
+    now = time.time()
+    depth = outbound_queue.depth()
+    oldest_age = outbound_queue.oldest_age(now)
+    
+    status = "ok"
+    if bot_started_at is None:
+        status = "starting"
+    elif oldest_age > HEALTH_MAX_OUTBOX_AGE:
+        status = "degraded"
+    
+    data = {
+        "status": status,
+        "service": "telegram-ride-bot",
+        "timestamp": datetime.now().isoformat(),
+        "uptime_seconds": round(now - process_started_at),
+        "last_update_age_seconds": round(now - last_update_at, 1) if last_update_at else None,
+        "outbox_depth": depth,
+        "outbox_oldest_age_seconds": round(oldest_age, 1),
+        "active_access": len(access_expires_at),
+        "verified_drivers": len(verified_drivers)
+    }
+    return data, 200 if status == "ok" else 503
+
 @flask_app.route('/health')
 def health():
-    return {"status": "ok", "service": "telegram-ride-bot", "timestamp": datetime.now().isoformat()}
+    return health_status()
+
+@flask_app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 def run_flask_server():
     """Flask serverni ishga tushiradi"""
@@ -187,350 +463,2377 @@ CHANNEL_ID = "-1003236563110"
 ADMIN_ID = 8014950410  # Bu int bo'lishi kerak
 
 PAYMENT_AMOUNT = 5000
+ACCESS_DURATION = 24 * 3600  # To'lovdan keyingi access muddati (soniya)
+ACCESS_REMINDER_BEFORE = 3600  # Access tugashidan shuncha soniya oldin qayta to'lov taklif qilinadi
+SCHEDULER_TICK = 60  # Rejali hodisalar (eslatmalar, access tugashi) tekshiriladigan oraliq (soniya)
+PENDING_ESCALATE_AFTER = 2 * 3600  # Admin shuncha vaqt ko'rmagan pending ariza/to'lov eslatiladi
+PENDING_ESCALATE_REPEAT = 12 * 3600  # Hali ham pending bo'lsa eslatma shu oraliqda takrorlanadi
+ESCALATION_LIST_MAX = 20  # Adminga bitta eslatmada ko'rsatiladigan yozuvlar
+REGISTRATION_TTL = 1800  # Ro'yxatdan o'tish shuncha soniya harakatsiz qolsa bekor qilinadi
+REGISTRATION_PURGE_INTERVAL = 300  # Eskirgan ro'yxatdan o'tishlarni tozalash oralig'i (soniya)
+
+# Haydovchilarni joylashuv bo'yicha tanlash
+DRIVERS_LIST_LIMIT = 10  # Yo'lovchiga ko'rsatiladigan haydovchilar soni
+PRICE_LIST_MAX = 20  # /arzon va /narx bir martada ko'rsatadigan eng ko'p haydovchilar
+# Mashina modeli -> qulaylik klassi (yo'lovchi klass tanlasa shu klassdagi modellar mos keladi)
+CAR_CLASSES = {
+    'Spark': 'Iqtisodiy',
+    'Nexia': 'Iqtisodiy',
+    'Cobalt': 'Iqtisodiy',
+    'Lacetti': 'Komfort',
+    'Gentra': 'Komfort',
+    'Malibu': 'Komfort',
+}
+CAR_PREFERENCE_ANY = 'Farqi yoq'  # "Farqi yo'q" tugmasi - haydovchilar saralanmaydi
+DEPARTURE_WINDOW = 30 * 60  # Aniq vaqt aytilganda jo'nash oynasi uzunligi (soniya)
+DEMAND_HORIZON = 3600  # /yolovchilar shuncha soniya ichida jo'naydiganlarni ko'rsatadi
+DEMAND_LIST_MAX = 20  # /yolovchilar ko'rsatadigan eng ko'p yo'lovchilar
+PRICE_THOUSANDS_THRESHOLD = 1000  # Birliksiz bundan kichik son "ming" deb tushuniladi ("150" -> 150,000 so'm)
+PRICE_MIN_AMOUNT = 5000  # Bundan kichik summa narx emas - qabul qilinmaydi
+PRICE_MAX_AMOUNT = 10_000_000  # Bundan katta summa narx emas (masalan telefon raqami) - qabul qilinmaydi
+GEO_CELL_DEG = 0.1  # Grid katagi o'lchami (gradus, ~11 km)
+GEO_MAX_RING = 20  # Qidiruv radiusi: shuncha katak (~200 km), undan uzoqdagilar "yaqin" hisoblanmaydi
+SKIP_BUTTON_TEXT = "⏭ O'tkazib yuborish"
+PLACE_FUZZY_CUTOFF = 0.8  # Joy nomini taxminiy moslashtirish chegarasi (difflib, 0..1)
+PLACE_LOCATION_RADIUS_KM = 40  # Lokatsiya shuncha km ichida bo'lsa shu shaharga tegishli hisoblanadi
+
+# Admin hisobotlari
+STATS_DAILY_RETENTION = 400  # Kunlik statistika shuncha kun saqlanadi
+STATS_DAILY_SHOWN = 7  # /stats da ko'rsatiladigan oxirgi kunlar
+REPORT_PAGE_SIZE = 10  # Bitta sahifadagi yozuvlar soni
+LEGACY_PAYMENT_FIELDS = ('user_name', 'user_phone', 'user_id')  # Eski /payments to'lovlarga yozib qo'ygan maydonlar
+# Eski versiya ro'yxatdan o'tish jarayonida user_data ga yozib qo'ygan maydonlar (endi faqat arizada saqlanadi)
+LEGACY_REGISTRATION_FIELDS = (
+    'price', 'route', 'route_from', 'route_to', 'location', 'car_photo',
+    'departure', 'departure_location', 'destination', 'destination_location', 'car_preference', 'departure_time'
+)
+
+# Monitoring
+HEALTH_MAX_OUTBOX_AGE = 1800  # Navbatdagi eng eski xabar shuncha soniyadan beri yuborilmagan bo'lsa /health 503 qaytaradi
+
+# Telegram limitlari
+TELEGRAM_GLOBAL_RATE = 25  # Umumiy: soniyasiga xabarlar (Telegram ~30/s ruxsat beradi)
+TELEGRAM_PER_CHAT_INTERVAL = 1.0  # Bitta chatga xabarlar orasidagi minimal vaqt (soniya)
+SEND_MAX_ATTEMPTS = 5
+
+# Broadcast sozlamalari
+BROADCAST_CONCURRENCY = 20  # Bir vaqtda yuborilayotgan xabarlar soni
+BROADCAST_BATCH_SIZE = 100  # Har shuncha foydalanuvchidan keyin progress saqlanadi
+
+# Chiquvchi xabarlar navbati (kanal va admin xabarlari)
+OUTBOX_WORKERS = 4
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE = 5  # Birinchi qayta urinishgacha (soniya), har safar ikki baravar
+OUTBOX_RETRY_MAX = 900
+
+# Bir vaqtda ishlanadigan updatelar soni (1 - ketma-ket). Bitta foydalanuvchiniki baribir navbat bilan
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))
+CALLBACK_DEDUP_SIZE = 4096  # Takroriy callbacklarni aniqlash uchun eslab qolinadigan callback ID lar soni
+
+# Ishga tushirish rejimi: "polling" (Flask alohida threadda) yoki "webhook" (bitta asyncio server)
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # Tashqi manzil, masalan https://example.com
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_BODY = 1024 * 1024
+# Lokal sinov uchun Telegram API manzili (stand-in server), masalan http://127.0.0.1:8081/bot
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "")
 
 DATA_FILE = "ride_sharing_bot_data.json"
 PAYMENTS_FILE = "payments_data.json"
+JOURNAL_FILE = "ride_sharing_bot_journal.jsonl"
+SQLITE_FILE = "ride_sharing_bot.db"
+
+# Arxiv: eski yo'lovchi arizalari va to'lovlar oylik gzip segmentlarga ko'chiriladi (ARCHIVE_DIR/<tur>-YYYY-MM.jsonl.gz)
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 90))  # Shundan eski yozuvlar arxivga ko'chiriladi
+ARCHIVE_INTERVAL = 24 * 3600  # Arxivlash oralig'i (soniya)
+ARCHIVE_FIRST_DELAY = 600  # Ishga tushgandan keyin birinchi arxivlashgacha (soniya)
+ARCHIVE_LIST_MAX = 20  # /archive <user_id> ko'rsatadigan eng ko'p yozuvlar
+
+# Saqlash usuli: "json" (snapshot + jurnal) yoki "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+
+# Jurnal shuncha yozuvga yetganda snapshot kutmasdan darhol olinadi
+JOURNAL_COMPACT_THRESHOLD = int(os.environ.get("JOURNAL_COMPACT_THRESHOLD", 1000))
+# O'zgarishlar to'xtagandan keyin shuncha soniya kutib snapshot olinadi (ketma-ket o'zgarishlar bitta snapshotga yig'iladi)
+SNAPSHOT_DEBOUNCE = float(os.environ.get("SNAPSHOT_DEBOUNCE", 5))
+# Birinchi saqlanmagan o'zgarishdan keyin snapshot shundan kechikmaydi (soniya)
+SNAPSHOT_MAX_STALENESS = float(os.environ.get("SNAPSHOT_MAX_STALENESS", 60))
+# True bo'lsa har bir yozuvdan keyin fsync (elektr uzilishiga ham chidamli, lekin sekinroq)
+JOURNAL_FSYNC = os.environ.get("JOURNAL_FSYNC", "0") == "1"
 
 # Global ma'lumotlar
 user_data = {}
-user_states = {}
+registration_sessions = {}  # user_id -> RegistrationSession (tugallanmagan ro'yxatdan o'tishlar, saqlanmaydi)
 driver_applications = {}
 passenger_applications = {}
 payments_data = {}
 application_counter = 1
+meta_data = {}  # Boshqa saqlanadigan holatlar (broadcast va h.k.)
+outbox = {}  # Yuborilishi kutilayotgan xabarlar: key -> item
+processed_callbacks = IdempotencyCache(CALLBACK_DEDUP_SIZE)  # Ishlangan callback query ID lari (qayta yetkazilganlar o'tkaziladi)
 
-# ==================== MA'LUMOTLARNI YUKLASH/SAQLASH ====================
-def load_data():
-    global user_data, driver_applications, passenger_applications, payments_data, application_counter
+# Indekslar (load_data() da qayta quriladi)
+payment_index = {}  # payment_id -> (user_id_str, payment)
+access_expires_at = {}  # user_id (int) -> access tugash vaqti (unix timestamp)
+# Rejali hodisalar min-heap: (vaqt, tur, kalit, versiya). Har bir foydalanuvchi uchun alohida job yo'q -
+# bitta job_queue vazifasi vaqti kelganlarini pop qiladi; versiya eskirgan hodisalar tashlab yuboriladi
+scheduled_events = []
+driver_app_by_user = {}  # user_id (int) -> oxirgi haydovchi ariza ID si
+passenger_apps_by_user = {}  # user_id (int) -> yo'lovchi ariza ID lari (tartib bilan)
+verified_drivers = {}  # app_id -> tasdiqlangan haydovchi arizasi (tasdiqlangan tartibda)
+_driver_entry_cache = {}  # app_id -> haydovchining tayyor matni (ariza o'zgarganda tozalanadi)
+driver_grid = {}  # (lat_katak, lon_katak) -> joylashuvi bor tasdiqlangan haydovchilar app_id lari
+driver_cell = {}  # app_id -> haydovchi turgan katak
+# Hisobot indekslari: nom -> [(sana, id), ...] o'sish tartibida (sahifalash bisect orqali)
+report_indexes = {'payments': [], 'paid': [], 'drivers': [], 'drivers_verified': [], 'passengers': []}
+corridor_drivers = {}  # (qayerdan, qayerga) -> tasdiqlangan haydovchilar app_id lari (ikkala yo'nalish)
+corridor_passengers = {}  # (qayerdan, qayerga) -> yo'lovchilarning oxirgi arizalari app_id lari
+passenger_corridor = {}  # user_id (int) -> (app_id, yo'nalish) - oxirgi ariza indeksda
+driver_corridor = {}  # app_id -> haydovchi indekslangan yo'nalish
+driver_prices = []  # [(narx_so'm, app_id)] o'sish tartibida - narxi ma'lum tasdiqlangan haydovchilar
+driver_price_entry = {}  # app_id -> driver_prices dagi yozuvi
+driver_facets = {}  # ('model', 'cobalt') yoki ('class', 'komfort') -> tasdiqlangan haydovchilar app_id lari
+driver_facet_keys = {}  # app_id -> haydovchi indekslangan facetlar
+demand_buckets = {}  # soat (unix // 3600) -> shu soatda jo'nashi mumkin yo'lovchi arizalari app_id lari
+demand_hours = []  # demand_buckets kalitlari min-heap; o'tib ketgan soatlar shu orqali tozalanadi
+passenger_window = {}  # app_id -> (boshlanish, tugash) unix timestamp - kelgusi jo'nash oynasi
+
+storage = None
+
+# ==================== MA'LUMOTLARNI SAQLASH BACKENDLARI ====================
+def _write_file_atomic(path, text):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class JsonStorage:
+    """JSON fayllar: snapshot (DATA_FILE + PAYMENTS_FILE) va append-only jurnal.
     
-    try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
+    Har bir o'zgarish jurnal fayliga bitta qator bo'lib qo'shiladi (O(1) yozish).
+    Jurnal vaqti-vaqti bilan snapshotga siqiladi, ishga tushganda esa
+    snapshot + jurnal qayta o'ynaladi.
+    """
+    
+    name = "json"
+    
+    def __init__(self, state_fn, data_file=DATA_FILE, payments_file=PAYMENTS_FILE, journal_file=JOURNAL_FILE):
+        self._state_fn = state_fn
+        self.data_file = data_file
+        self.payments_file = payments_file
+        self.journal_file = journal_file
+        self.journal_seq = 0
+        self.journal_records = 0
+        self._journal = None
+    
+    def exists(self):
+        """Saqlangan ma'lumotlar bormi (snapshot yoki jurnal)"""
+        paths = (self.data_file, self.payments_file, self.journal_file, self.journal_file + ".old")
+        return any(os.path.exists(path) for path in paths)
+    
+    # ---------- Yuklash ----------
+    def load(self):
+        state = {
+            "user_data": {},
+            "driver_applications": {},
+            "passenger_applications": {},
+            "payments_data": {},
+            "application_counter": 1,
+            "meta_data": {},
+            "outbox": {}
+        }
+        snapshot_seq = 0
+        
+        if os.path.exists(self.data_file):
+            with open(self.data_file, "r", encoding="utf-8") as f:
                 data = json.load(f)
-                user_data = data.get("user_data", {})
                 # JSON da kalitlar string, lekin biz int kerak
-                user_data = {int(k): v for k, v in user_data.items()}
-                driver_applications = data.get("driver_applications", {})
-                passenger_applications = data.get("passenger_applications", {})
-                application_counter = data.get("application_counter", 1)
+                state["user_data"] = {int(k): v for k, v in data.get("user_data", {}).items()}
+                state["driver_applications"] = data.get("driver_applications", {})
+                state["passenger_applications"] = data.get("passenger_applications", {})
+                state["application_counter"] = data.get("application_counter", 1)
+                state["meta_data"] = data.get("meta_data", {})
+                state["outbox"] = data.get("outbox", {})
+                snapshot_seq = data.get("journal_seq", 0)
                 logger.info("✅ Asosiy ma'lumotlar yuklandi")
         
-        if os.path.exists(PAYMENTS_FILE):
-            with open(PAYMENTS_FILE, "r", encoding="utf-8") as f:
-                payments_data = json.load(f)
+        if os.path.exists(self.payments_file):
+            with open(self.payments_file, "r", encoding="utf-8") as f:
+                state["payments_data"] = json.load(f)
                 logger.info("✅ To'lov ma'lumotlari yuklandi")
-    except Exception as e:
-        logger.error(f"❌ Ma'lumotlarni yuklashda xato: {e}")
-        # Fayl bo'lmasa yangisini yaratish
-        save_data()
-
-def save_data():
-    try:
-        # user_data kalitlarini string ga o'tkazish
-        user_data_str = {str(k): v for k, v in user_data.items()}
-        
-        main_data = {
-            "user_data": user_data_str,
-            "driver_applications": driver_applications,
-            "passenger_applications": passenger_applications,
-            "application_counter": application_counter
-        }
         
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(main_data, f, ensure_ascii=False, indent=4)
+        # Snapshotdan keyingi o'zgarishlarni qayta o'ynash
+        self.journal_seq = snapshot_seq
+        self.journal_records = 0
+        for path in (self.journal_file + ".old", self.journal_file):
+            if os.path.exists(path):
+                last_seq, count = self._replay(path, snapshot_seq, state)
+                self.journal_seq = max(self.journal_seq, last_seq)
+                self.journal_records += count
         
-        with open(PAYMENTS_FILE, "w", encoding="utf-8") as f:
-            json.dump(payments_data, f, ensure_ascii=False, indent=4)
+        if self.journal_records:
+            logger.info(f"✅ Jurnal qayta o'ynaldi: {self.journal_records} ta yozuv (seq={self.journal_seq})")
         
-        logger.info("✅ Ma'lumotlar saqlandi")
-    except Exception as e:
-        logger.error(f"❌ Ma'lumotlarni saqlashda xato: {e}")
-
-load_data()
-
-# ==================== KEYBOARD FUNKSIYALARI ====================
-def car_type_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("Spark ⚡️", callback_data='car_type_Spark'),
-         InlineKeyboardButton("Cobalt", callback_data='car_type_Cobalt')],
-        [InlineKeyboardButton("Gentra", callback_data='car_type_Gentra'),
-         InlineKeyboardButton("Lacetti", callback_data='car_type_Lacetti')],
-        [InlineKeyboardButton("Nexia", callback_data='car_type_Nexia'),
-         InlineKeyboardButton("Malibu", callback_data='car_type_Malibu')],
-        [InlineKeyboardButton("Boshqa", callback_data='car_type_Boshqa')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def car_preference_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("Iqtisodiy 💸", callback_data='car_pref_Iqtisodiy'),
-         InlineKeyboardButton("Komfort 🛋️", callback_data='car_pref_Komfort')],
-        [InlineKeyboardButton("Spark", callback_data='car_pref_Spark'),
-         InlineKeyboardButton("Cobalt", callback_data='car_pref_Cobalt')],
-        [InlineKeyboardButton("Gentra", callback_data='car_pref_Gentra'),
-         InlineKeyboardButton("Farqi yo'q", callback_data='car_pref_Farqi yoq')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def time_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("Hozir 🕐", callback_data='time_Hozir'),
-         InlineKeyboardButton("30 daqiqadan keyin", callback_data='time_30 daqiqadan keyin')],
-        [InlineKeyboardButton("1 soatdan keyin", callback_data='time_1 soatdan keyin'),
-         InlineKeyboardButton("Bugun kechqurun", callback_data='time_Bugun kechqurun')],
-        [InlineKeyboardButton("Ertaga ertalab", callback_data='time_Ertaga ertalab')],
-        [InlineKeyboardButton("Boshqa vaqt", callback_data='time_Boshqa')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def main_menu_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("🚗 Haydovchi bo'lish", callback_data='role_driver')],
-        [InlineKeyboardButton("🚶 Yo'lovchi bo'lish", callback_data='role_passenger')],
-        [InlineKeyboardButton("💰 Haydovchilar ro'yxati (5,000 so'm)", callback_data='show_drivers')],
-        [InlineKeyboardButton("📞 Admin", url=f"tg://user?id={ADMIN_ID}")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def payment_methods_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("💳 Bank karta", callback_data='pay_card')],
-        [InlineKeyboardButton("📱 Click", callback_data='pay_click')],
-        [InlineKeyboardButton("💵 Payme", callback_data='pay_payme')],
-        [InlineKeyboardButton("❌ Bekor qilish", callback_data='cancel_payment')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def confirm_payment_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("✅ To'lov qildim", callback_data='confirm_payment')],
-        [InlineKeyboardButton("❌ Bekor qilish", callback_data='cancel_payment')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-# ==================== TO'LOV TIZIMI FUNKSIYALARI ====================
-def has_paid_recently(user_id):
-    """24 soat ichida to'lov qilganmi tekshirish"""
-    user_id_str = str(user_id)
+        return state
     
-    if user_id_str in payments_data:
-        for payment in payments_data[user_id_str]:
-            if payment.get('status') == 'verified':
+    def _replay(self, path, snapshot_seq, state):
+        """Jurnal faylini qayta o'ynash. (oxirgi seq, yozuvlar soni) qaytaradi"""
+        last_seq = snapshot_seq
+        count = 0
+        
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
                 try:
-                    payment_date = datetime.fromisoformat(payment['date'])
-                    time_diff = datetime.now() - payment_date
-                    if time_diff.total_seconds() < 24 * 3600:
-                        return True
-                except:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Yozish paytida uzilgan oxirgi qator
+                    logger.warning(f"⚠️ Jurnalda buzilgan yozuv o'tkazib yuborildi: {path}")
                     continue
-    return False
-
-def add_payment_record(user_id, method, screenshot_id=None):
-    """To'lov yozuvini qo'shish"""
-    user_id_str = str(user_id)
-    
-    if user_id_str not in payments_data:
-        payments_data[user_id_str] = []
+                
+                count += 1
+                seq = record.get("seq", 0)
+                if seq <= snapshot_seq:
+                    continue
+                self._apply(record, state)
+                last_seq = max(last_seq, seq)
+        
+        return last_seq, count
     
-    payment_record = {
-        'id': f"pay_{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}",
-        'date': datetime.now().isoformat(),
-        'amount': PAYMENT_AMOUNT,
-        'method': method,
-        'status': 'pending',
-        'screenshot': screenshot_id
-    }
+    @staticmethod
+    def _apply(record, state):
+        """Bitta jurnal yozuvini holatga qo'llash"""
+        collection, key, value = record["c"], record["k"], record.get("v")
+        
+        if collection == "meta":
+            if key == "application_counter":
+                state["application_counter"] = value
+            elif value is None:
+                state["meta_data"].pop(key, None)
+            else:
+                state["meta_data"][key] = value
+            return
+        
+        target = state.get(collection)
+        if target is None:
+            logger.warning(f"⚠️ Jurnalda noma'lum kolleksiya: {collection}")
+            return
+        
+        if collection == "user_data":
+            key = int(key)
+        
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = value
     
-    payments_data[user_id_str].append(payment_record)
-    save_data()
-    return payment_record['id']
-
-async def send_drivers_list_to_user(context, user_id):
-    """Haydovchilar ro'yxatini foydalanuvchiga yuborish"""
-    active_drivers = []
-    for app_id, driver in driver_applications.items():
-        # Faqat tasdiqlangan haydovchilarni qo'shish
-        if driver.get('status') == 'verified':
-            active_drivers.append(driver)
-    
-    if not active_drivers:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="🚗 *Haydovchilar ro'yxati*\n\nHozircha faol haydovchilar yo'q. Biroz vaqt o'tgach qayta urinib ko'ring.\n\n✅ To'lovingiz qabul qilindi va saqlandi.",
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return
+    # ---------- Yozish ----------
+    def _open_journal(self):
+        if self._journal is None or self._journal.closed:
+            self._journal = open(self.journal_file, "a", encoding="utf-8")
+        return self._journal
     
-    message = "🚗 *TOP HAYDOVCHILAR*\n\n"
-    message += "💰 *To'lov qilganingiz uchun rahmat! (5,000 so'm)*\n\n"
+    def put(self, collection, key, value):
+        """Bitta yozuvning joriy holatini jurnalga qo'shish"""
+        self.journal_seq += 1
+        record = {"seq": self.journal_seq, "c": collection, "k": key, "v": value}
+        
+        f = self._open_journal()
+        f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+        f.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(f.fileno())
+        self.journal_records += 1
     
-    for i, driver in enumerate(active_drivers[:10], 1):
-        message += f"{i}. *{driver.get('first_name', 'Noma\'lum')}*\n"
-        message += f"   🚘 {driver.get('car_type', 'Mashina yo\'q')}\n"
-        message += f"   💰 {driver.get('price', 'Narx yo\'q')}\n"
-        message += f"   📞 {driver.get('phone', 'Telefon yo\'q')}\n\n"
+    def _copy_state(self):
+        """Holatning yuzaki nusxasi - kolleksiyalar (kalit, yozuv) ro'yxatlari. Event loop ichida, arzon"""
+        state = self._state_fn()
+        return {
+            # user_data kalitlarini string ga o'tkazish
+            "user_data": [(str(k), v) for k, v in state["user_data"].items()],
+            "driver_applications": list(state["driver_applications"].items()),
+            "passenger_applications": list(state["passenger_applications"].items()),
+            "application_counter": state["application_counter"],
+            "meta_data": list(state["meta_data"].items()),
+            "outbox": list(state["outbox"].items()),
+            "journal_seq": self.journal_seq,
+            "payments_data": list(state["payments_data"].items())
+        }
     
-    message += "📞 *Haydovchi bilan bog'laning va safar haqida kelishing*\n\n"
-    message += "⏱️ *24 soat davomida yangi haydovchilar qo'shilganda sizga xabar yuboriladi*"
+    @staticmethod
+    def _serialize_snapshot(copy):
+        """Nusxadan snapshot matnlarini (asosiy, to'lovlar) yig'ish - executor da ham ishlaydi.
+        
+        Har bir yozuv alohida json.dumps qilinadi, shuning uchun GIL yozuvlar orasida bo'shaydi va
+        event loop to'xtab qolmaydi. Nusxa olingandan keyin o'zgargan yozuvlar yangi jurnalda
+        ham bor - qayta o'ynalganda to'liq qiymati bilan yoziladi.
+        """
+        def collection(items):
+            return "{" + ", ".join(
+                f"{json.dumps(key, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False)}" for key, value in items
+            ) + "}"
+        
+        main_text = "{" + ", ".join(
+            f'"{name}": {collection(copy[name]) if isinstance(copy[name], list) else copy[name]}'
+            for name in ("user_data", "driver_applications", "passenger_applications", "application_counter",
+                         "meta_data", "outbox", "journal_seq")
+        ) + "}"
+        return main_text, collection(copy["payments_data"])
     
-    await context.bot.send_message(
-        chat_id=user_id,
-        text=message, 
-        parse_mode=ParseMode.MARKDOWN
-    )
-
-async def notify_admin_about_payment(context, user_id, payment_id, screenshot_id=None):
-    """Admin ga to'lov haqida xabar berish"""
-    try:
-        user = await context.bot.get_chat(user_id)
-        message = (
-            f"💳 *TO'LOV TEKSHRIVI*\n\n"
-            f"📋 **Foydalanuvchi ma'lumotlari:**\n"
-            f"• Ism: {user.first_name}\n"
-            f"• ID: {user_id}\n"
-            f"• Summa: {PAYMENT_AMOUNT:,} so'm\n"
-            f"• Vaqt: {datetime.now().strftime('%H:%M %d.%m.%Y')}\n"
-            f"• To'lov ID: {payment_id}\n\n"
-            f"🔍 *Screenshotni tekshiring:*\n"
-            f"1. To'lov summasi to'g'rimi?\n"
-            f"2. Screenshot aniq va ko'rinadimi?\n"
-            f"3. To'lov vaqti to'g'rimi?\n\n"
-            f"*Tasdiqlang yoki rad eting:*"
-        )
+    def _rotate_journal(self):
+        """Joriy jurnalni .old ga o'tkazib, yangi bo'sh jurnal ochish"""
+        if self._journal is not None and not self._journal.closed:
+            self._journal.close()
+        self._journal = None
         
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ To'lovni tasdiqlash", callback_data=f'verify_{payment_id}'),
-                InlineKeyboardButton("❌ To'lovni rad etish", callback_data=f'reject_{payment_id}')
-            ]
-        ]
+        old_path = self.journal_file + ".old"
+        if os.path.exists(self.journal_file):
+            if os.path.exists(old_path):
+                # Oldingi siqish tugamagan - yozuvlarni yo'qotmaslik uchun qo'shib qo'yamiz
+                with open(self.journal_file, "r", encoding="utf-8") as src, open(old_path, "a", encoding="utf-8") as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_file)
+            else:
+                os.replace(self.journal_file, old_path)
         
-        if screenshot_id:
-            await context.bot.send_photo(
-                chat_id=ADMIN_ID,
-                photo=screenshot_id,
-                caption=message,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=message,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
-            )
-        logger.info(f"📤 Adminga TO'LOV tekshiruvi uchun xabar yuborildi: {payment_id}")
-    except Exception as e:
-        logger.error(f"Adminga xabar yuborishda xato: {e}")
+        self.journal_records = 0
+    
+    def _write_snapshot_files(self, copy):
+        """Snapshotni serializatsiya qilish, fayllarni atomik yozish va eski jurnalni o'chirish"""
+        main_text, payments_text = self._serialize_snapshot(copy)
+        _write_file_atomic(self.payments_file, payments_text)
+        _write_file_atomic(self.data_file, main_text)
+        
+        old_path = self.journal_file + ".old"
+        if os.path.exists(old_path):
+            os.remove(old_path)
+    
+    def save_all(self):
+        """To'liq snapshot olish (sinxron)"""
+        copy = self._copy_state()
+        self._rotate_journal()
+        self._write_snapshot_files(copy)
+    
+    def snapshot_in_background(self, loop):
+        """Jurnalni fonda snapshotga siqish. Bir vaqtda faqat bittasi ishlashi kerak (SnapshotScheduler)"""
+        # Event loop ichida faqat yuzaki nusxa va jurnal almashtirish; serializatsiya va disk yozuvi executor da
+        copy = self._copy_state()
+        self._rotate_journal()
+        return loop.run_in_executor(None, self._write_snapshot_files, copy)
+    
+    def close(self):
+        if self._journal is not None and not self._journal.closed:
+            self._journal.close()
+    
+    # ---------- Admin so'rovlari ----------
+    def report_page(self, name, cursor, direction, page_size):
+        """Hisobot sahifasi xotiradagi indeksdan (index_report_page)"""
+        return index_report_page(name, cursor, direction, page_size)
+    
+    def role_counts(self):
+        counts = {}
+        for user_info in self._state_fn()["user_data"].values():
+            role = user_info.get('role')
+            counts[role] = counts.get(role, 0) + 1
+        return counts
+    
+    def recent_users(self, limit):
+        """Oxirgi ro'yxatdan o'tganlar: [(user_id, user_info), ...]"""
+        return list(self._state_fn()["user_data"].items())[-limit:]
 
-# ==================== HAYDOVCHI ARIZASINI YAKUNLASH ====================
-async def complete_driver_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Haydovchi arizasini admin tasdiqlashi uchun yuborish"""
-    try:
-        user_id = update.effective_user.id
+class SqliteStorage:
+    """SQLite (WAL) backend: har bir yozuv alohida qator, admin so'rovlari indekslangan SQL"""
+    
+    name = "sqlite"
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            role TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_role ON users(role);
         
-        # Foydalanuvchi ma'lumotlarini tekshirish
-        if user_id not in user_data:
-            await update.message.reply_text(
-                "❌ Xatolik! Iltimos, qaytadan /start boshlang.", 
-                parse_mode=ParseMode.MARKDOWN
-            )
-            return
+        CREATE TABLE IF NOT EXISTS driver_applications (
+            app_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            status TEXT,
+            date TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_drivers_user ON driver_applications(user_id);
+        CREATE INDEX IF NOT EXISTS idx_drivers_status ON driver_applications(status, date);
+        CREATE INDEX IF NOT EXISTS idx_drivers_date ON driver_applications(date);
         
-        # Kerakli maydonlarni tekshirish
-        required_fields = ['first_name', 'phone', 'car_type', 'price', 'car_photo']
-        missing_fields = []
+        CREATE TABLE IF NOT EXISTS passenger_applications (
+            app_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            date TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_passengers_user ON passenger_applications(user_id);
+        CREATE INDEX IF NOT EXISTS idx_passengers_date ON passenger_applications(date);
         
-        for field in required_fields:
-            if field not in user_data[user_id]:
-                missing_fields.append(field)
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            status TEXT,
+            date TEXT,
+            amount INTEGER,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id);
+        CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status, date);
+        CREATE INDEX IF NOT EXISTS idx_payments_date ON payments(date);
         
-        if missing_fields:
-            await update.message.reply_text(
-                f"❌ Quyidagi maydonlar to'ldirilmagan: {', '.join(missing_fields)}\nIltimos, qaytadan /start boshlang.", 
-                parse_mode=ParseMode.MARKDOWN
-            )
-            return
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
         
-        # Rolni o'rnatish
-        user_data[user_id]['role'] = 'driver'
+        CREATE TABLE IF NOT EXISTS outbox (
+            key TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+    """
+    
+    def __init__(self, state_fn, path=SQLITE_FILE):
+        self._state_fn = state_fn
+        self.path = path
+        self._existed = os.path.exists(path)
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+    
+    @staticmethod
+    def _dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    
+    def exists(self):
+        """Baza fayli ishga tushishdan oldin bor edimi (eski JSON import qilinsa ham yangi hisoblanadi)"""
+        return self._existed
+    
+    # ---------- Yuklash ----------
+    def load(self):
+        cur = self.conn.cursor()
         
-        # Ariza ID sini yaratish
-        global application_counter
-        app_id = f"D{application_counter:04d}"
-        application_counter += 1
+        if cur.execute("SELECT COUNT(*) FROM meta").fetchone()[0] == 0 and os.path.exists(DATA_FILE):
+            self._import_json()
         
-        # Ma'lumotlarni vaqtinchalik saqlash (admin tasdiqlashini kutish)
-        driver_applications[app_id] = {
-            'user_id': user_id,  # int saqlanadi
-            'first_name': user_data[user_id]['first_name'],
-            'phone': user_data[user_id]['phone'],
-            'car_type': user_data[user_id]['car_type'],
-            'price': user_data[user_id]['price'],
-            'car_photo': user_data[user_id]['car_photo'],
-            'date': datetime.now().isoformat(),
-            'status': 'pending'
+        state = {
+            "user_data": {},
+            "driver_applications": {},
+            "passenger_applications": {},
+            "payments_data": {},
+            "application_counter": 1,
+            "meta_data": {},
+            "outbox": {}
         }
         
-        # Admin uchun tasdiqlash keyboardi
-        keyboard = [
-            [InlineKeyboardButton("✅ Mashinani tasdiqlash", callback_data=f'admin_verify_driver_{app_id}'),
-             InlineKeyboardButton("❌ Mashinani rad etish", callback_data=f'admin_reject_driver_{app_id}')]
-        ]
+        for user_id, data in cur.execute("SELECT user_id, data FROM users ORDER BY rowid"):
+            state["user_data"][user_id] = json.loads(data)
+        for app_id, data in cur.execute("SELECT app_id, data FROM driver_applications ORDER BY rowid"):
+            state["driver_applications"][app_id] = json.loads(data)
+        for app_id, data in cur.execute("SELECT app_id, data FROM passenger_applications ORDER BY rowid"):
+            state["passenger_applications"][app_id] = json.loads(data)
+        for user_id_str, data in cur.execute("SELECT user_id, data FROM payments ORDER BY rowid"):
+            state["payments_data"].setdefault(user_id_str, []).append(json.loads(data))
         
-        # Adminga xabar yuborish
-        try:
-            caption = (
-                f"🚗 *MASHINA TEKSHRIVI*\n\n"
-                f"📋 **Haydovchi ma'lumotlari:**\n"
-                f"• ID: {app_id}\n"
-                f"• Ism: {user_data[user_id]['first_name']}\n"
-                f"• Telefon: {user_data[user_id]['phone']}\n"
-                f"• Mashina: {user_data[user_id]['car_type']}\n"
-                f"• Narx: {user_data[user_id]['price']}\n"
-                f"• Vaqt: {datetime.now().strftime('%H:%M %d.%m.%Y')}\n\n"
-                f"🔍 *Mashina rasmiga qarang va tekshiring:*\n"
-                f"1. Rasm mashinaga tegishlimi?\n"
-                f"2. Rasm aniq va ko'rinadimi?\n"
-                f"3. Barcha ma'lumotlar to'grimi?\n\n"
-                f"*Tasdiqlang yoki rad eting:*"
-            )
+        for key, data in cur.execute("SELECT key, data FROM outbox ORDER BY rowid"):
+            state["outbox"][key] = json.loads(data)
+        
+        for key, value in cur.execute("SELECT key, value FROM meta"):
+            if key == "application_counter":
+                state["application_counter"] = json.loads(value)
+            else:
+                state["meta_data"][key] = json.loads(value)
+        
+        logger.info(f"✅ SQLite ma'lumotlari yuklandi: {self.path}")
+        return state
+    
+    def _import_json(self):
+        """Birinchi ishga tushishda mavjud JSON ma'lumotlarni SQLite ga ko'chirish"""
+        state = JsonStorage(self._state_fn).load()
+        self._write_state(state)
+        logger.info("✅ JSON ma'lumotlari SQLite ga ko'chirildi")
+    
+    # ---------- Yozish ----------
+    def put(self, collection, key, value):
+        with self.conn:
+            self._put(collection, key, value)
+    
+    def _put(self, collection, key, value):
+        cur = self.conn.cursor()
+        
+        if collection == "meta":
+            if value is None:
+                cur.execute("DELETE FROM meta WHERE key = ?", (key,))
+            else:
+                cur.execute(
+                    "INSERT INTO meta(key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (key, self._dumps(value))
+                )
+        
+        elif collection == "user_data":
+            if value is None:
+                cur.execute("DELETE FROM users WHERE user_id = ?", (int(key),))
+            else:
+                cur.execute(
+                    "INSERT INTO users(user_id, role, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET role = excluded.role, data = excluded.data",
+                    (int(key), value.get('role'), self._dumps(value))
+                )
+        
+        elif collection == "driver_applications":
+            if value is None:
+                cur.execute("DELETE FROM driver_applications WHERE app_id = ?", (key,))
+            else:
+                cur.execute(
+                    "INSERT INTO driver_applications(app_id, user_id, status, date, data) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(app_id) DO UPDATE SET user_id = excluded.user_id, status = excluded.status, "
+                    "date = excluded.date, data = excluded.data",
+                    (key, value.get('user_id'), value.get('status'), value.get('date'), self._dumps(value))
+                )
+        
+        elif collection == "passenger_applications":
+            if value is None:
+                cur.execute("DELETE FROM passenger_applications WHERE app_id = ?", (key,))
+            else:
+                cur.execute(
+                    "INSERT INTO passenger_applications(app_id, user_id, date, data) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(app_id) DO UPDATE SET user_id = excluded.user_id, date = excluded.date, "
+                    "data = excluded.data",
+                    (key, value.get('user_id'), value.get('date'), self._dumps(value))
+                )
+        
+        elif collection == "payments_data":
+            # key - foydalanuvchi ID si (str), value - uning to'lovlari ro'yxati
+            payments = value or []
+            ids = [payment['id'] for payment in payments]
+            cur.execute(
+                f"DELETE FROM payments WHERE user_id = ? AND payment_id NOT IN ({','.join('?' * len(ids))})",
+                (str(key), *ids)
+            )
+            for payment in payments:
+                cur.execute(
+                    "INSERT INTO payments(payment_id, user_id, status, date, amount, data) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(payment_id) DO UPDATE SET status = excluded.status, date = excluded.date, "
+                    "amount = excluded.amount, data = excluded.data",
+                    (payment['id'], str(key), payment.get('status'), payment.get('date'),
+                     payment.get('amount', 0), self._dumps(payment))
+                )
+        
+        elif collection == "outbox":
+            if value is None:
+                cur.execute("DELETE FROM outbox WHERE key = ?", (key,))
+            else:
+                cur.execute(
+                    "INSERT INTO outbox(key, data) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                    (key, self._dumps(value))
+                )
+        
+        else:
+            logger.warning(f"⚠️ Noma'lum kolleksiya: {collection}")
+    
+    def _write_state(self, state):
+        with self.conn:
+            for user_id, info in state["user_data"].items():
+                self._put("user_data", user_id, info)
+            for app_id, app in state["driver_applications"].items():
+                self._put("driver_applications", app_id, app)
+            for app_id, app in state["passenger_applications"].items():
+                self._put("passenger_applications", app_id, app)
+            for user_id_str, payments in state["payments_data"].items():
+                self._put("payments_data", user_id_str, payments)
+            self._put("meta", "application_counter", state["application_counter"])
+            for key, value in state["meta_data"].items():
+                self._put("meta", key, value)
+            for key, item in state["outbox"].items():
+                self._put("outbox", key, item)
+    
+    def save_all(self):
+        """To'liq holatni yozish va WAL ni asosiy faylga o'tkazish"""
+        self._write_state(self._state_fn())
+        self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    
+    def _checkpoint(self):
+        # Alohida ulanish: executor threadi asosiy ulanish bilan to'qnashmaydi
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        finally:
+            conn.close()
+    
+    def snapshot_in_background(self, loop):
+        """O'zgarishlar har put() da yoziladi - snapshot bu yerda WAL checkpoint (fonda)"""
+        return loop.run_in_executor(None, self._checkpoint)
+    
+    def close(self):
+        self.conn.close()
+    
+    # ---------- Admin so'rovlari ----------
+    # Hisobot nomi -> (jadval, ID ustuni, shart). (date, ID) bo'yicha keyset sahifalash - date indekslari ishlatiladi
+    REPORT_QUERIES = {
+        'payments': ("payments", "payment_id", ""),
+        'paid': ("payments", "payment_id", "status = 'verified'"),
+        'drivers': ("driver_applications", "app_id", ""),
+        'drivers_verified': ("driver_applications", "app_id", "status = 'verified'"),
+        'passengers': ("passenger_applications", "app_id", ""),
+    }
+    
+    def report_page(self, name, cursor, direction, page_size):
+        """Hisobot sahifasi bazadan: (jami, sahifadan yangiroqlar soni, [(ID, yozuv), ...] yangilari birinchi).
+        
+        Xotiradagi indeks o'qilmaydi - faqat shu sahifa qatorlari olinadi. To'lov yozuvi (user_id, to'lov).
+        """
+        table, id_column, condition = self.REPORT_QUERIES[name]
+        user_column = ", user_id" if table == "payments" else ""
+        base = [condition] if condition else []
+        
+        def select(extra, params, order):
+            where = " AND ".join(base + extra)
+            return self.conn.execute(
+                f"SELECT {id_column}, date, data{user_column} FROM {table} {'WHERE ' + where if where else ''} "
+                f"ORDER BY date {order}, {id_column} {order} LIMIT ?",
+                (*params, page_size)
+            ).fetchall()
+        
+        def count(extra=(), params=()):
+            where = " AND ".join(base + list(extra))
+            return self.conn.execute(f"SELECT COUNT(*) FROM {table} {'WHERE ' + where if where else ''}", params).fetchone()[0]
+        
+        row = self.conn.execute(f"SELECT date FROM {table} WHERE {id_column} = ?", (cursor,)).fetchone() if cursor else None
+        if row is None:
+            rows = select([], (), "DESC")
+        elif direction == 'prev':
+            rows = select([f"(date, {id_column}) > (?, ?)"], (row[0], cursor), "ASC")[::-1]
+            if len(rows) < page_size:
+                # Yangiroqlar sahifaga yetmaydi - birinchi sahifa
+                rows = select([], (), "DESC")
+        else:
+            rows = select([f"(date, {id_column}) < (?, ?)"], (row[0], cursor), "DESC")
+        
+        newer = count([f"(date, {id_column}) > (?, ?)"], (rows[0][1], rows[0][0])) if rows else 0
+        if user_column:
+            items = [(item_id, (user_id, json.loads(data))) for item_id, _, data, user_id in rows]
+        else:
+            items = [(item_id, json.loads(data)) for item_id, _, data in rows]
+        return count(), newer, items
+    
+    def role_counts(self):
+        return dict(self.conn.execute("SELECT role, COUNT(*) FROM users GROUP BY role"))
+    
+    def recent_users(self, limit):
+        rows = self.conn.execute(
+            "SELECT user_id, data FROM users ORDER BY rowid DESC LIMIT ?", (limit,)
+        )
+        return [(user_id, json.loads(data)) for user_id, data in rows][::-1]
+
+# ==================== MA'LUMOTLARNI YUKLASH/SAQLASH ====================
+def _current_state():
+    return {
+        "user_data": user_data,
+        "driver_applications": driver_applications,
+        "passenger_applications": passenger_applications,
+        "payments_data": payments_data,
+        "application_counter": application_counter,
+        "meta_data": meta_data,
+        "outbox": outbox
+    }
+
+def create_storage():
+    """STORAGE_BACKEND sozlamasiga qarab backend yaratish"""
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(_current_state)
+    return JsonStorage(_current_state)
+
+def load_data():
+    global user_data, driver_applications, passenger_applications, payments_data, application_counter, meta_data, outbox, storage
+    
+    try:
+        if storage is None:
+            storage = create_storage()
+        fresh = not storage.exists()
+        
+        state = storage.load()
+        user_data = state["user_data"]
+        driver_applications = state["driver_applications"]
+        passenger_applications = state["passenger_applications"]
+        payments_data = state["payments_data"]
+        application_counter = state["application_counter"]
+        meta_data = state["meta_data"]
+        outbox = state["outbox"]
+        
+        strip_legacy_payment_fields()
+        strip_registration_fields()
+        rebuild_indexes()
+        restore_application_counter()
+    except Exception as e:
+        # Buzilgan fayllar ustiga bo'sh holat yozilmaydi - snapshot va jurnal tiklash uchun kerak
+        logger.critical(f"❌ Ma'lumotlarni yuklashda xato: {e}. Fayllar o'zgartirilmadi, bot to'xtatildi")
+        sys.exit(1)
+    
+    if fresh:
+        # Birinchi ishga tushish - fayllar hali yo'q, yangisini yaratish
+        save_data()
+    
+    if "stats" not in meta_data:
+        rebuild_stats()
+    elif "daily" in meta_data["stats"]:
+        split_stats_days()
+
+def strip_legacy_payment_fields():
+    """Eski versiya to'lov yozuvlariga qo'shib saqlagan foydalanuvchi maydonlarini olib tashlash"""
+    for user_id_str, payments in payments_data.items():
+        changed = False
+        for payment in payments:
+            for field in LEGACY_PAYMENT_FIELDS:
+                if field in payment:
+                    del payment[field]
+                    changed = True
+        if changed:
+            save_change("payments_data", user_id_str)
+
+def strip_registration_fields():
+    """Eski versiya user_data ga yozgan ro'yxatdan o'tish maydonlarini olib tashlash (profil maydonlari qoladi)"""
+    for user_id, profile in user_data.items():
+        stale = [field for field in LEGACY_REGISTRATION_FIELDS if field in profile]
+        for field in stale:
+            del profile[field]
+        if stale:
+            save_change("user_data", user_id)
+
+def save_change(collection, key):
+    """Bitta yozuvning joriy holatini saqlash (butun ma'lumotlarni qayta yozmasdan)"""
+    if collection == "meta":
+        value = application_counter if key == "application_counter" else meta_data.get(key)
+    else:
+        value = _current_state()[collection].get(key)
+    
+    try:
+        with STORAGE_LATENCY.time(operation="put"):
+            storage.put(collection, key, value)
+    except Exception as e:
+        STORAGE_ERRORS.inc(operation="put")
+        logger.error(f"❌ O'zgarishni saqlashda xato ({collection}/{key}): {e}")
+    
+    snapshot_scheduler.mark_dirty()
+
+def allocate_application_id(prefix):
+    """Yangi ariza ID si ("D0001", "P0002").
+    
+    Hisoblagich oshiriladi va shu zahoti saqlanadi; oraliqda await yo'q, shuning uchun
+    parallel updatelar bir xil ID olmaydi va qayta ishga tushganda ID takrorlanmaydi.
+    """
+    global application_counter
+    app_id = f"{prefix}{application_counter:04d}"
+    application_counter += 1
+    save_change("meta", "application_counter")
+    return app_id
+
+def restore_application_counter():
+    """Hisoblagich mavjud ariza ID laridan orqada qolgan bo'lsa (jurnal yo'qolgan) uni surish"""
+    global application_counter
+    used = [int(app_id[1:]) for app_id in (*driver_applications, *passenger_applications) if app_id[1:].isdigit()]
+    if used and max(used) >= application_counter:
+        logger.warning(f"⚠️ application_counter {application_counter} -> {max(used) + 1} ga surildi")
+        application_counter = max(used) + 1
+        save_change("meta", "application_counter")
+
+def save_data():
+    """To'liq snapshot olish (sinxron). Oddiy o'zgarishlar uchun save_change() ishlatiladi"""
+    try:
+        with STORAGE_LATENCY.time(operation="save_all"):
+            storage.save_all()
+        logger.info("✅ Ma'lumotlar saqlandi")
+    except Exception as e:
+        STORAGE_ERRORS.inc(operation="save_all")
+        logger.error(f"❌ Ma'lumotlarni saqlashda xato: {e}")
+
+class SnapshotScheduler:
+    """Snapshotlarni yig'ib, fonda olish.
+    
+    save_change() har safar mark_dirty() ni chaqiradi. Snapshot o'zgarishlar
+    SNAPSHOT_DEBOUNCE soniya to'xtaganda olinadi, lekin birinchi saqlanmagan
+    o'zgarishdan SNAPSHOT_MAX_STALENESS soniyadan kechikmaydi. Disk yozuvi
+    executor da bajariladi, bir vaqtda faqat bitta snapshot yoziladi.
+    """
+    
+    def __init__(self, debounce=SNAPSHOT_DEBOUNCE, max_staleness=SNAPSHOT_MAX_STALENESS):
+        self.debounce = debounce
+        self.max_staleness = max_staleness
+        self.dirty_since = None  # Birinchi saqlanmagan o'zgarish vaqti (monotonic)
+        self.changes = 0
+        self._timer = None
+        self._writing = None  # Yozilayotgan snapshot (future)
+    
+    def mark_dirty(self):
+        now = time.monotonic()
+        self.changes += 1
+        if self.dirty_since is None:
+            self.dirty_since = now
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Event loop yo'q (ishga tushish paytida) - o'zgarish jurnalda, keyingi snapshotga qo'shiladi
+            return
+        
+        if self.changes >= JOURNAL_COMPACT_THRESHOLD:
+            delay = 0
+        else:
+            delay = min(self.debounce, max(0, self.dirty_since + self.max_staleness - now))
+        
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_later(delay, self._flush, loop)
+    
+    def _flush(self, loop):
+        self._timer = None
+        if self.dirty_since is None:
+            return
+        
+        if self._writing is not None and not self._writing.done():
+            # Oldingi snapshot hali yozilmoqda - keyinroq qayta urinamiz
+            self._timer = loop.call_later(self.debounce, self._flush, loop)
+            return
+        
+        changes = self.changes
+        self.changes = 0
+        self.dirty_since = None
+        started = time.perf_counter()
+        
+        try:
+            self._writing = storage.snapshot_in_background(loop)
+        except Exception as e:
+            STORAGE_ERRORS.inc(operation="snapshot")
+            logger.error(f"❌ Snapshot olishda xato: {e}")
+            self._writing = None
+            return
+        
+        def _done(future):
+            STORAGE_LATENCY.observe(time.perf_counter() - started, operation="snapshot")
+            if future.exception():
+                STORAGE_ERRORS.inc(operation="snapshot")
+                logger.error(f"❌ Snapshotni yozishda xato: {future.exception()}")
+            else:
+                logger.info(f"✅ Snapshot saqlandi ({changes} ta o'zgarish)")
+        
+        self._writing.add_done_callback(_done)
+    
+    async def flush(self):
+        """Kutilayotgan snapshotni darhol yozish (bot to'xtaganda)"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        
+        if self._writing is not None and not self._writing.done():
+            await asyncio.wait([self._writing])
+        
+        if self.dirty_since is not None:
+            self._flush(asyncio.get_running_loop())
+            if self._writing is not None:
+                await asyncio.wait([self._writing])
+
+snapshot_scheduler = SnapshotScheduler()
+
+# ==================== JOYLAR (GAZETTEER) ====================
+# Kanonik nom -> (kenglik, uzunlik, muqobil yozilishlar)
+GAZETTEER = {
+    "Toshkent": (41.311, 69.279, [
+        "tashkent", "ташкент", "toshkent", "tosh", "chilonzor", "chilanzor", "yunusobod", "sergeli",
+        "yakkasaroy", "mirobod", "olmazor", "shayxontohur", "uchtepa", "yashnobod", "bektemir", "ulug'bek"
+    ]),
+    "Samarqand": (39.654, 66.960, ["samarkand", "самарканд", "samarqand"]),
+    "Buxoro": (39.767, 64.423, ["bukhara", "buxara", "бухара", "buxoro"]),
+    "Andijon": (40.783, 72.344, ["andijan", "андижан", "andijon"]),
+    "Namangan": (40.998, 71.673, ["наманган", "namangan"]),
+    "Farg'ona": (40.384, 71.786, ["fergana", "fargona", "ferghana", "фергана", "farg'ona"]),
+    "Qo'qon": (40.528, 70.943, ["kokand", "qoqon", "коканд", "qo'qon"]),
+    "Marg'ilon": (40.471, 71.725, ["margilan", "margilon", "маргилан", "marg'ilon"]),
+    "Navoiy": (40.084, 65.379, ["navoi", "навои", "navoiy"]),
+    "Qarshi": (38.861, 65.789, ["karshi", "карши", "qarshi"]),
+    "Shahrisabz": (39.058, 66.834, ["shakhrisabz", "шахрисабз", "shahrisabz"]),
+    "Termiz": (37.224, 67.278, ["termez", "термез", "termiz"]),
+    "Denov": (38.267, 67.899, ["denau", "денау", "denov"]),
+    "Jizzax": (40.116, 67.842, ["jizzakh", "jizax", "джизак", "jizzax"]),
+    "Guliston": (40.490, 68.781, ["gulistan", "гулистан", "guliston"]),
+    "Nukus": (42.460, 59.603, ["нукус", "nukus"]),
+    "Urganch": (41.550, 60.631, ["urgench", "ургенч", "urganch"]),
+    "Xiva": (41.378, 60.364, ["khiva", "хива", "xiva"]),
+    "Chirchiq": (41.469, 69.582, ["chirchik", "чирчик", "chirchiq"]),
+    "Olmaliq": (40.845, 69.598, ["almalyk", "алмалык", "olmaliq"]),
+    "Angren": (41.017, 70.144, ["ангрен", "angren"]),
+    "Bekobod": (40.221, 69.270, ["bekabad", "бекабад", "bekobod"]),
+    "Yangiyo'l": (41.112, 69.047, ["yangiyul", "янгиюль", "yangiyo'l", "yangiyol"]),
+    "Kattaqo'rg'on": (39.899, 66.256, ["kattakurgan", "каттакурган", "kattaqo'rg'on", "kattaqorgon"]),
+    "Zarafshon": (41.574, 64.201, ["zarafshan", "зарафшан", "zarafshon"]),
+}
+
+# Joy nomiga aloqasi yo'q so'zlar
+PLACE_STOPWORDS = {"shahar", "shahri", "shaxar", "viloyat", "viloyati", "tuman", "tumani", "город", "область", "район"}
+# Kelishik qo'shimchalari: "Toshkentdan", "Samarqandga"
+PLACE_SUFFIXES = ("gacha", "dan", "ga", "ka", "qa", "da", "ning", "ni")
+
+# muqobil yozilish -> kanonik nom
+PLACE_ALIASES = {alias: place for place, (_, _, aliases) in GAZETTEER.items() for alias in aliases}
+PLACE_ALIAS_KEYS = list(PLACE_ALIASES)
+
+def _place_tokens(text):
+    """Matnni kichik harflarga, apostroflarni bir xil ko'rinishga keltirib so'zlarga ajratish"""
+    text = re.sub(r"[ʻʼ’‘`´]", "'", text.lower())
+    return [token.strip("'") for token in re.findall(r"[\w']+", text) if token.strip("'") not in PLACE_STOPWORDS]
+
+@functools.lru_cache(maxsize=4096)
+def _resolve_token(token):
+    if token in PLACE_ALIASES:
+        return PLACE_ALIASES[token]
+    if len(token) < 4 or token.isdigit():
+        return None
+    
+    candidates = [token] + [token[:-len(suffix)] for suffix in PLACE_SUFFIXES if token.endswith(suffix) and len(token) - len(suffix) >= 4]
+    for candidate in candidates[1:]:
+        if candidate in PLACE_ALIASES:
+            return PLACE_ALIASES[candidate]
+    for candidate in candidates:
+        match = difflib.get_close_matches(candidate, PLACE_ALIAS_KEYS, n=1, cutoff=PLACE_FUZZY_CUTOFF)
+        if match:
+            return PLACE_ALIASES[match[0]]
+    return None
+
+def resolve_places(text):
+    """Matndagi barcha joylar (kanonik nomlar, matndagi tartibda, takrorlanmasdan)"""
+    places = []
+    for token in _place_tokens(text or ""):
+        place = _resolve_token(token)
+        if place and place not in places:
+            places.append(place)
+    return places
+
+def resolve_place(text=None, location=None):
+    """Erkin matn yoki lokatsiyani kanonik joy nomiga aylantirish (topilmasa None)"""
+    if location:
+        best = min(
+            GAZETTEER,
+            key=lambda place: distance_km(location['latitude'], location['longitude'], GAZETTEER[place][0], GAZETTEER[place][1])
+        )
+        lat, lon, _ = GAZETTEER[best]
+        if distance_km(location['latitude'], location['longitude'], lat, lon) <= PLACE_LOCATION_RADIUS_KM:
+            return best
+    
+    places = resolve_places(text)
+    return places[0] if places else None
+
+def resolve_route(text):
+    """Haydovchi yo'nalishi ("Toshkent - Samarqand"): (qayerdan, qayerga) yoki None"""
+    places = resolve_places(text)
+    if len(places) < 2:
+        return None
+    return places[0], places[1]
+
+# ==================== NARXLAR ====================
+PRICE_MULTIPLIERS = {
+    'ming': 1000, 'минг': 1000, 'k': 1000, 'тыс': 1000,
+    'mln': 1000000, 'million': 1000000, 'млн': 1000000,
+}
+# Butun qism (minglik ajratuvchi bo'sh joy, nuqta yoki vergul), ixtiyoriy kasr va birlik
+_PRICE_RE = re.compile(
+    r"(\d+(?:[ .,]\d{3}(?!\d))*)(?:[.,](\d+))?(?:\s*(" + "|".join(PRICE_MULTIPLIERS) + r")(?![a-zа-яё]))?"
+)
+
+def parse_price(text):
+    """Erkin matndagi narx so'mda ("150000 soʻm", "150 000", "150 ming", "1,5 mln").
+    
+    Topilmasa yoki PRICE_MIN_AMOUNT..PRICE_MAX_AMOUNT oralig'idan tashqarida bo'lsa None.
+    """
+    match = _PRICE_RE.search((text or '').lower())
+    if match is None:
+        return None
+    
+    integer, fraction, unit = match.groups()
+    digits = re.sub(r"\D", "", integer)
+    value = float(f"{digits}.{fraction or 0}")
+    if unit:
+        value *= PRICE_MULTIPLIERS[unit]
+    elif value < PRICE_THOUSANDS_THRESHOLD:
+        value *= 1000
+    amount = int(round(value))
+    if not PRICE_MIN_AMOUNT <= amount <= PRICE_MAX_AMOUNT:
+        return None
+    return amount
+
+def format_price(app, default="Narx yo'q"):
+    """Haydovchi narxi: son ma'lum bo'lsa "150,000 so'm", aks holda kiritilgan matn"""
+    amount = app.get('price_amount')
+    if amount:
+        return f"{amount:,} so'm"
+    return app.get('price') or default
+
+# ==================== JO'NASH VAQTI ====================
+# Kun qismlari: so'z -> (boshlanish soati, tugash soati). "tushdan keyin" "tushda" dan oldin tekshiriladi
+DAY_PARTS = {
+    'tushdan keyin': (14, 18),
+    'ertalab': (6, 10),
+    'tushda': (12, 14),
+    'kunduzi': (10, 17),
+    'kechqurun': (18, 22),
+    'kechasi': (22, 24),
+}
+DAY_OFFSETS = {'bugun': 0, 'ertaga': 1, 'indinga': 2}
+_RELATIVE_TIME_RE = re.compile(r"(\d+)\s*(daqiqa|minut|soat)\w*\s+keyin")
+_CLOCK_RE = re.compile(r"(\d{1,2})[:.](\d{2})|soat\s*(\d{1,2})")
+
+def parse_departure_window(text, base):
+    """Jo'nash vaqti matni -> (boshlanish, tugash) datetime; base - ariza yaratilgan vaqt.
+    
+    "Hozir", "30 daqiqadan keyin", "1 soatdan keyin", "Bugun kechqurun", "Ertaga ertalab",
+    "15:30", "ertaga soat 10" ko'rinishlari tushuniladi; tushunilmasa None.
+    """
+    text = (text or '').strip().lower()
+    window = timedelta(seconds=DEPARTURE_WINDOW)
+    if not text:
+        return None
+    if text.startswith('hozir'):
+        return base, base + window
+    
+    match = _RELATIVE_TIME_RE.search(text)
+    if match:
+        amount = int(match.group(1))
+        start = base + (timedelta(hours=amount) if match.group(2) == 'soat' else timedelta(minutes=amount))
+        return start, start + window
+    
+    explicit_day = next((offset for word, offset in DAY_OFFSETS.items() if word in text), None)
+    midnight = datetime.combine(base.date(), datetime.min.time()) + timedelta(days=explicit_day or 0)
+    
+    match = _CLOCK_RE.search(text)
+    if match:
+        hour, minute = int(match.group(1) or match.group(3)), int(match.group(2) or 0)
+        if hour > 23 or minute > 59:
+            return None
+        start = midnight + timedelta(hours=hour, minutes=minute)
+        # Kun aytilmagan va vaqt o'tib ketgan ("15:30" kechqurun yozilgan) - ertangi kun
+        if explicit_day is None and start < base - timedelta(hours=1):
+            start += timedelta(days=1)
+        return start, start + window
+    
+    for part, (first_hour, last_hour) in DAY_PARTS.items():
+        if part in text:
+            start, end = midnight + timedelta(hours=first_hour), midnight + timedelta(hours=last_hour)
+            if explicit_day is None and end <= base:
+                start, end = start + timedelta(days=1), end + timedelta(days=1)
+            if end <= base:
+                # Kun aniq aytilgan, lekin kunning bu qismi o'tib ketgan ("Bugun kechqurun" soat 23 da)
+                return None
+            return max(start, base), end
+    
+    return None
+
+def departure_window_field(text, base):
+    """Arizada saqlanadigan ko'rinish: [boshlanish, tugash] ISO matn yoki None"""
+    window = parse_departure_window(text, base)
+    if window is None:
+        return None
+    return [moment.isoformat(timespec='minutes') for moment in window]
+
+# ==================== INDEKSLAR ====================
+def rebuild_indexes():
+    """Xotiradagi indekslarni ma'lumotlardan qayta qurish"""
+    payment_index.clear()
+    access_expires_at.clear()
+    scheduled_events.clear()
+    driver_app_by_user.clear()
+    passenger_apps_by_user.clear()
+    verified_drivers.clear()
+    _driver_entry_cache.clear()
+    driver_grid.clear()
+    driver_cell.clear()
+    for index in report_indexes.values():
+        index.clear()
+    corridor_drivers.clear()
+    corridor_passengers.clear()
+    passenger_corridor.clear()
+    driver_corridor.clear()
+    driver_prices.clear()
+    driver_price_entry.clear()
+    driver_facets.clear()
+    driver_facet_keys.clear()
+    demand_buckets.clear()
+    demand_hours.clear()
+    passenger_window.clear()
+    
+    for app_id, app in driver_applications.items():
+        index_driver_application(app_id, app)
+        update_driver_roster(app_id, app)
+        if app.get('status') == 'pending':
+            schedule_pending_escalation('driver', app_id, app.get('date'))
+    for app_id, app in passenger_applications.items():
+        index_passenger_application(app_id, app)
+    
+    for user_id_str, payments in payments_data.items():
+        for payment in payments:
+            payment_index[payment['id']] = (user_id_str, payment)
+            index_payment(payment)
+            if payment.get('status') == 'verified':
+                grant_access(int(user_id_str), payment)
+            elif payment.get('status') == 'pending':
+                schedule_pending_escalation('payment', payment['id'], payment.get('date'))
+    
+    logger.info(
+        f"✅ Indekslar qurildi: {len(payment_index)} ta to'lov, {len(access_expires_at)} ta faol access, "
+        f"{len(verified_drivers)} ta tasdiqlangan haydovchi, {len(scheduled_events)} ta rejali hodisa"
+    )
+
+def find_payment(payment_id):
+    """To'lovni ID bo'yicha topish: (user_id_str, payment) yoki None"""
+    return payment_index.get(payment_id)
+
+def report_index_add(name, key):
+    index = report_indexes[name]
+    i = bisect.bisect_left(index, key)
+    if i == len(index) or index[i] != key:
+        index.insert(i, key)
+
+def report_index_remove(name, key):
+    index = report_indexes[name]
+    i = bisect.bisect_left(index, key)
+    if i < len(index) and index[i] == key:
+        del index[i]
+
+def index_payment(payment):
+    """To'lovni hisobot indekslariga qo'shish (status o'zgarganda ham chaqiriladi)"""
+    key = (payment.get('date', ''), payment['id'])
+    report_index_add('payments', key)
+    if payment.get('status') == 'verified':
+        report_index_add('paid', key)
+    else:
+        report_index_remove('paid', key)
+
+def index_driver_application(app_id, app):
+    user_id = app.get('user_id')
+    if user_id is not None:
+        driver_app_by_user[int(user_id)] = app_id
+    report_index_add('drivers', (app.get('date', ''), app_id))
+
+def index_passenger_application(app_id, app):
+    user_id = app.get('user_id')
+    if user_id is not None:
+        passenger_apps_by_user.setdefault(int(user_id), []).append(app_id)
+        index_passenger_corridor(int(user_id), app_id, app)
+    report_index_add('passengers', (app.get('date', ''), app_id))
+    index_passenger_demand(app_id, app)
+
+def unindex_passenger_application(app_id, app):
+    """Arxivga ko'chirilgan (oxirgi bo'lmagan) yo'lovchi arizasini indekslardan olib tashlash"""
+    user_id = app.get('user_id')
+    app_ids = passenger_apps_by_user.get(int(user_id)) if user_id is not None else None
+    if app_ids and app_id in app_ids:
+        app_ids.remove(app_id)
+        if not app_ids:
+            del passenger_apps_by_user[int(user_id)]
+    report_index_remove('passengers', (app.get('date', ''), app_id))
+    passenger_window.pop(app_id, None)
+
+def unindex_payment(payment):
+    payment_index.pop(payment['id'], None)
+    key = (payment.get('date', ''), payment['id'])
+    report_index_remove('payments', key)
+    report_index_remove('paid', key)
+
+def application_corridor(app):
+    """Yo'lovchi arizasining yo'nalishi (qayerdan, qayerga) yoki None.
+    
+    Eski arizalarda kanonik joylar saqlanmagan - matn/lokatsiyadan aniqlanadi.
+    """
+    origin = app.get('departure_place') or resolve_place(app.get('departure'), app.get('departure_location'))
+    destination = app.get('destination_place') or resolve_place(app.get('destination'), app.get('destination_location'))
+    if origin and destination and origin != destination:
+        return origin, destination
+    return None
+
+def index_passenger_corridor(user_id, app_id, app):
+    """Yo'lovchining faqat oxirgi arizasi yo'nalish indeksida turadi"""
+    previous = passenger_corridor.pop(user_id, None)
+    if previous is not None:
+        old_app_id, old_corridor = previous
+        bucket = corridor_passengers.get(old_corridor)
+        if bucket is not None:
+            bucket.discard(old_app_id)
+            if not bucket:
+                del corridor_passengers[old_corridor]
+    
+    corridor = application_corridor(app)
+    if corridor is not None:
+        corridor_passengers.setdefault(corridor, set()).add(app_id)
+        passenger_corridor[user_id] = (app_id, corridor)
+
+def update_driver_corridor_index(app_id, app):
+    """Tasdiqlangan haydovchini yo'nalishining ikkala tomoni bo'yicha indekslash"""
+    old_corridor = driver_corridor.pop(app_id, None)
+    if old_corridor is not None:
+        for corridor in (old_corridor, old_corridor[::-1]):
+            bucket = corridor_drivers.get(corridor)
+            if bucket is not None:
+                bucket.discard(app_id)
+                if not bucket:
+                    del corridor_drivers[corridor]
+    
+    origin, destination = app.get('route_from'), app.get('route_to')
+    if app.get('status') == 'verified' and origin and destination:
+        corridor_drivers.setdefault((origin, destination), set()).add(app_id)
+        corridor_drivers.setdefault((destination, origin), set()).add(app_id)
+        driver_corridor[app_id] = (origin, destination)
+
+def drivers_for_corridor(origin, destination):
+    """Shu yo'nalishda qatnaydigan tasdiqlangan haydovchilar"""
+    return corridor_drivers.get((origin, destination), set())
+
+def passengers_for_corridor(origin, destination):
+    """Shu yo'nalishdagi yo'lovchilar arizalari"""
+    return corridor_passengers.get((origin, destination), set())
+
+def index_passenger_demand(app_id, app, now=None):
+    """Kelgusida jo'naydigan yo'lovchini soatlik savatlarga qo'shish (oyna qamragan har bir soatga)"""
+    window = app.get('departure_window')
+    if 'departure_window' not in app and app.get('date'):
+        # Oynasi saqlanmagan eski arizalar - hisoblanadi, lekin arizaga yozilmaydi (faqat indeksda)
+        window = departure_window_field(app.get('departure_time'), datetime.fromisoformat(app['date']))
+    if not window:
+        return
+    start, end = (datetime.fromisoformat(moment).timestamp() for moment in window)
+    if end <= (now or time.time()):
+        return
+    
+    passenger_window[app_id] = (start, end)
+    for hour in range(int(start // 3600), int((end - 1) // 3600) + 1):
+        bucket = demand_buckets.get(hour)
+        if bucket is None:
+            bucket = demand_buckets[hour] = set()
+            heapq.heappush(demand_hours, hour)
+        bucket.add(app_id)
+
+def prune_demand_buckets(now):
+    """O'tib ketgan soat savatlarini va tugagan oynalarni o'chirish"""
+    current_hour = int(now // 3600)
+    while demand_hours and demand_hours[0] < current_hour:
+        for app_id in demand_buckets.pop(heapq.heappop(demand_hours), ()):
+            window = passenger_window.get(app_id)
+            if window is not None and window[1] <= now:
+                del passenger_window[app_id]
+
+def upcoming_passengers(origin, destination, within=DEMAND_HORIZON, now=None):
+    """Shu yo'nalishda keyingi `within` soniya ichida jo'naydigan yo'lovchi arizalari (erta jo'naydigan birinchi)"""
+    now = now or time.time()
+    prune_demand_buckets(now)
+    route_apps = passengers_for_corridor(origin, destination)
+    if not route_apps:
+        return []
+    
+    found = set()
+    for hour in range(int(now // 3600), int((now + within) // 3600) + 1):
+        found |= demand_buckets.get(hour, set()) & route_apps
+    
+    upcoming = []
+    for app_id in found:
+        window = passenger_window.get(app_id)
+        if window is not None and window[0] < now + within and window[1] > now:
+            upcoming.append((window[0], app_id))
+    upcoming.sort()
+    return [app_id for _, app_id in upcoming]
+
+def update_driver_roster(app_id, app):
+    """Haydovchi statusi o'zgarganda tasdiqlanganlar ro'yxatini yangilash"""
+    _driver_entry_cache.pop(app_id, None)
+    
+    if app.get('status') == 'verified':
+        verified_drivers.setdefault(app_id, app)
+        report_index_add('drivers_verified', (app.get('date', ''), app_id))
+    else:
+        verified_drivers.pop(app_id, None)
+        report_index_remove('drivers_verified', (app.get('date', ''), app_id))
+    
+    update_driver_location_index(app_id, app)
+    update_driver_corridor_index(app_id, app)
+    update_driver_price_index(app_id, app)
+    update_driver_facet_index(app_id, app)
+
+def update_driver_price_index(app_id, app):
+    """Tasdiqlangan haydovchini narx indeksiga qo'shish/ko'chirish/olib tashlash"""
+    old_entry = driver_price_entry.pop(app_id, None)
+    if old_entry is not None:
+        del driver_prices[bisect.bisect_left(driver_prices, old_entry)]
+    
+    # Narx soni saqlanmagan eski arizalar - matndan hisoblanadi, lekin arizaga yozilmaydi (faqat indeksda)
+    amount = app['price_amount'] if 'price_amount' in app else parse_price(app.get('price'))
+    if app.get('status') == 'verified' and amount:
+        entry = (amount, app_id)
+        bisect.insort(driver_prices, entry)
+        driver_price_entry[app_id] = entry
+
+def car_facets(car_type):
+    """Haydovchi mashinasining facetlari: model va (CAR_CLASSES da bo'lsa) klass"""
+    if not car_type:
+        return ()
+    car_type = car_type.strip()
+    facets = [('model', car_type.lower())]
+    if car_type in CAR_CLASSES:
+        facets.append(('class', CAR_CLASSES[car_type].lower()))
+    return tuple(facets)
+
+def preference_facet(preference):
+    """Yo'lovchi tanlovi ("Komfort", "Cobalt", ...) -> facet; "Farqi yo'q" yoki bo'sh bo'lsa None"""
+    if not preference or preference == CAR_PREFERENCE_ANY:
+        return None
+    key = preference.strip().lower()
+    if any(key == car_class.lower() for car_class in CAR_CLASSES.values()):
+        return ('class', key)
+    return ('model', key)
+
+def update_driver_facet_index(app_id, app):
+    """Tasdiqlangan haydovchini mashina modeli va klassi facetlariga qo'shish/olib tashlash"""
+    for facet in driver_facet_keys.pop(app_id, ()):
+        members = driver_facets[facet]
+        members.discard(app_id)
+        if not members:
+            del driver_facets[facet]
+    
+    if app.get('status') == 'verified':
+        facets = car_facets(app.get('car_type'))
+        for facet in facets:
+            driver_facets.setdefault(facet, set()).add(app_id)
+        if facets:
+            driver_facet_keys[app_id] = facets
+
+def drivers_matching_preference(preference):
+    """Tanlovga mos haydovchilar to'plami; saralash kerak bo'lmasa None"""
+    facet = preference_facet(preference)
+    if facet is None:
+        return None
+    return driver_facets.get(facet, set())
+
+def cheapest_drivers(limit):
+    """Eng arzon tasdiqlangan haydovchilar app_id lari"""
+    return [app_id for _, app_id in driver_prices[:limit]]
+
+def drivers_in_price_range(low, high, limit):
+    """Narxi [low, high] oralig'idagi haydovchilar app_id lari (arzonidan boshlab)"""
+    start = bisect.bisect_left(driver_prices, (low, ''))
+    end = min(bisect.bisect_right(driver_prices, (high, '\uffff')), start + limit)
+    return [app_id for _, app_id in driver_prices[start:end]]
+
+def geo_cell(latitude, longitude):
+    return (math.floor(latitude / GEO_CELL_DEG), math.floor(longitude / GEO_CELL_DEG))
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Ikki nuqta orasidagi masofa (haversine, km)"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371 * 2 * math.asin(math.sqrt(a))
+
+def update_driver_location_index(app_id, app):
+    """Haydovchini grid indeksda to'g'ri katakka qo'yish (faqat tasdiqlangan va joylashuvi borlar)"""
+    old_cell = driver_cell.pop(app_id, None)
+    if old_cell is not None:
+        bucket = driver_grid.get(old_cell)
+        if bucket is not None:
+            bucket.discard(app_id)
+            if not bucket:
+                del driver_grid[old_cell]
+    
+    location = app.get('location')
+    if app.get('status') == 'verified' and location:
+        cell = geo_cell(location['latitude'], location['longitude'])
+        driver_grid.setdefault(cell, set()).add(app_id)
+        driver_cell[app_id] = cell
+
+def nearest_drivers(latitude, longitude, limit, allowed=None):
+    """Eng yaqin haydovchilar: [(masofa_km, app_id)], katak halqalari bo'yicha kengayib qidiriladi.
+    
+    allowed berilsa faqat shu to'plamdagi haydovchilar hisobga olinadi.
+    """
+    center_lat, center_lon = geo_cell(latitude, longitude)
+    # Halqa r dan tashqaridagi har qanday nuqta kamida shuncha km uzoqda (uzunlik katagi kengligi eng kichik)
+    ring_km = GEO_CELL_DEG * 111.32 * max(math.cos(math.radians(abs(latitude) + GEO_CELL_DEG)), 0.01)
+    found = []
+    
+    for ring in range(GEO_MAX_RING + 1):
+        for d_lat in range(-ring, ring + 1):
+            for d_lon in range(-ring, ring + 1):
+                if max(abs(d_lat), abs(d_lon)) != ring:
+                    continue
+                for app_id in driver_grid.get((center_lat + d_lat, center_lon + d_lon), ()):
+                    if allowed is not None and app_id not in allowed:
+                        continue
+                    location = verified_drivers[app_id]['location']
+                    found.append((distance_km(latitude, longitude, location['latitude'], location['longitude']), app_id))
+        
+        if len(found) >= limit:
+            found.sort()
+            if found[limit - 1][0] <= ring * ring_km:
+                break
+    
+    found.sort()
+    return found[:limit]
+
+def select_drivers_for_user(user_id, limit=DRIVERS_LIST_LIMIT):
+    """Yo'lovchi uchun haydovchilar: avval uning yo'nalishida qatnaydiganlar, keyin
+    jo'nash joyiga eng yaqinlari, keyin qolganlari. Yo'lovchi mashina turi yoki klassini
+    tanlagan bo'lsa, faqat shu facetdagi haydovchilar olinadi (to'plamlar kesishmasi).
+    
+    [(app_id, app, masofa_km yoki None)] qaytaradi.
+    """
+    location = None
+    preference = None
+    passenger_app_ids = passenger_apps_by_user.get(user_id)
+    if passenger_app_ids:
+        last_app = passenger_applications[passenger_app_ids[-1]]
+        location = last_app.get('departure_location')
+        preference = last_app.get('car_preference')
+    
+    # Tanlovga mos haydovchi umuman yo'q bo'lsa ro'yxat bo'sh qolmasligi uchun saralanmaydi
+    allowed = drivers_matching_preference(preference) or None
+    
+    def distance_to(app):
+        driver_location = app.get('location')
+        if location and driver_location:
+            return distance_km(location['latitude'], location['longitude'], driver_location['latitude'], driver_location['longitude'])
+        return None
+    
+    selected = []
+    chosen = set()
+    
+    # 1. Yo'nalish bo'yicha mos haydovchilar (yaqinroqlari birinchi)
+    indexed = passenger_corridor.get(user_id)
+    if indexed is not None:
+        route_ids = drivers_for_corridor(*indexed[1])
+        if allowed is not None:
+            route_ids = route_ids & allowed
+        route_matches = [(app_id, verified_drivers[app_id]) for app_id in route_ids]
+        ranked = sorted(
+            ((app_id, app, distance_to(app)) for app_id, app in route_matches),
+            key=lambda item: (item[2] is None, item[2] or 0, item[0])
+        )
+        for item in ranked[:limit]:
+            selected.append(item)
+            chosen.add(item[0])
+    
+    # 2. Jo'nash joyiga eng yaqinlari
+    if len(selected) < limit and location and driver_grid:
+        for distance, app_id in nearest_drivers(location['latitude'], location['longitude'], limit, allowed):
+            if app_id not in chosen and len(selected) < limit:
+                selected.append((app_id, verified_drivers[app_id], distance))
+                chosen.add(app_id)
+    
+    # 3. Qolganlari ro'yxat tartibida
+    if len(selected) < limit:
+        for app_id in (verified_drivers if allowed is None else sorted(allowed)):
+            if app_id not in chosen:
+                selected.append((app_id, verified_drivers[app_id], None))
+                if len(selected) >= limit:
+                    break
+    
+    return selected
+
+def grant_access(user_id, payment):
+    """Tasdiqlangan to'lov uchun access muddatini yangilash"""
+    try:
+        expires = datetime.fromisoformat(payment['date']).timestamp() + ACCESS_DURATION
+    except (KeyError, ValueError):
+        return
+    
+    if expires > time.time() and expires > access_expires_at.get(user_id, 0):
+        access_expires_at[user_id] = expires
+        schedule_access_events(user_id, expires)
+
+# ==================== REJALI HODISALAR ====================
+# meta_data["scheduler_watermark"]: shu vaqtgacha bo'lgan hodisalar bajarilgan. Qayta ishga tushganda
+# heap ma'lumotlardan quriladi va watermark dan oldingi eslatmalar qayta yuborilmaydi.
+ACCESS_NOTICES = {
+    'access_reminder': (
+        f"⏳ *Access muddati {ACCESS_REMINDER_BEFORE // 60} daqiqadan keyin tugaydi*\n\n"
+        f"Haydovchilar ro'yxatini yana 24 soat ko'rish uchun oldindan to'lashingiz mumkin ({PAYMENT_AMOUNT:,} so'm):"
+    ),
+    'access_expired': (
+        "⌛ *24 soatlik access tugadi*\n\n"
+        f"Haydovchilar ro'yxati va yangi haydovchilar haqida xabarlar uchun qayta to'lang ({PAYMENT_AMOUNT:,} so'm):"
+    ),
+}
+
+def schedule_event(due, kind, key, version=0):
+    heapq.heappush(scheduled_events, (due, kind, key, version))
+
+def schedule_access_events(user_id, expires):
+    """Access tugashidan oldin qayta to'lov taklifi va tugaganda xabar (versiya - tugash vaqti)"""
+    reminder_at = expires - ACCESS_REMINDER_BEFORE
+    if reminder_at > meta_data.get('scheduler_watermark', 0):
+        schedule_event(reminder_at, 'access_reminder', user_id, expires)
+    schedule_event(expires, 'access_expired', user_id, expires)
+
+def schedule_pending_escalation(kind, key, created):
+    """Pending yozuv uchun adminga eslatma (bajarilgan eslatmalar o'tkazib yuboriladi)"""
+    try:
+        due = datetime.fromisoformat(created).timestamp() + PENDING_ESCALATE_AFTER
+    except (TypeError, ValueError):
+        return
+    watermark = meta_data.get('scheduler_watermark', 0)
+    if due <= watermark:
+        due += (math.floor((watermark - due) / PENDING_ESCALATE_REPEAT) + 1) * PENDING_ESCALATE_REPEAT
+    schedule_event(due, 'pending', (kind, key))
+
+def _pending_record(kind, key):
+    """Hali ham pending bo'lgan to'lov yoki haydovchi arizasi (aks holda None)"""
+    if kind == 'payment':
+        found = find_payment(key)
+        record = found[1] if found else None
+    else:
+        record = driver_applications.get(key)
+    if record is not None and record.get('status') == 'pending':
+        return record
+    return None
+
+def notify_access_event(user_id, expires, kind):
+    """Access eslatmasi/tugash xabari to'lov tugmalari bilan (navbat orqali, kalit bo'yicha bir marta)"""
+    if user_data.get(user_id, {}).get('blocked'):
+        return
+    outbound_queue.enqueue(f"{kind}:{user_id}:{int(expires)}", [
+        outbox_step(
+            'send_message',
+            user_id,
+            text=ACCESS_NOTICES[kind],
+            reply_markup=payment_methods_keyboard(),
+            parse_mode=ParseMode.MARKDOWN
+        )
+    ])
+
+def escalate_pending(items, now):
+    """Uzoq vaqt ko'rilmagan pending yozuvlar ro'yxatini adminga yuborish"""
+    lines = []
+    for kind, key in items[:ESCALATION_LIST_MAX]:
+        record = _pending_record(kind, key)
+        label = f"💳 To'lov {key}" if kind == 'payment' else f"🚗 Haydovchi {key} ({record.get('first_name', 'Noma\'lum')})"
+        try:
+            hours = (now - datetime.fromisoformat(record['date']).timestamp()) / 3600
+            lines.append(f"• {label} - {hours:.0f} soat")
+        except (KeyError, ValueError):
+            lines.append(f"• {label}")
+    if len(items) > ESCALATION_LIST_MAX:
+        lines.append(f"... va yana {len(items) - ESCALATION_LIST_MAX} ta")
+    
+    text = "⏰ KO'RIB CHIQILMAGAN ARIZA VA TO'LOVLAR\n\n" + "\n".join(lines) + "\n\n/payments <ID> - to'lovni ko'rish"
+    outbound_queue.enqueue(f"escalation:{int(now)}", [outbox_step('send_message', ADMIN_ID, text=text)])
+
+async def run_scheduled_events(context: ContextTypes.DEFAULT_TYPE):
+    """Vaqti kelgan rejali hodisalarni bajarish (job_queue orqali, har SCHEDULER_TICK soniyada)"""
+    now = time.time()
+    fired = 0
+    stale = {}  # (tur, kalit) -> True, tartib saqlanadi
+    
+    while scheduled_events and scheduled_events[0][0] <= now:
+        due, kind, key, version = heapq.heappop(scheduled_events)
+        if kind == 'pending':
+            if key in stale or _pending_record(*key) is None:
+                continue
+            stale[key] = True
+            # Kelajakka surish - aks holda eski yozuv shu siklda qayta-qayta pop qilinadi
+            schedule_event(max(due, now) + PENDING_ESCALATE_REPEAT, 'pending', key)
+        elif access_expires_at.get(key) != version:
+            # Access uzaytirilgan - bu hodisa eskirgan
+            continue
+        elif kind == 'access_reminder':
+            if version <= now:
+                # Tik kechikkan (bot to'xtab turgan) - access tugagan, faqat tugash xabari yuboriladi
+                continue
+            notify_access_event(key, version, kind)
+        else:
+            del access_expires_at[key]
+            notify_access_event(key, version, kind)
+        fired += 1
+    
+    if stale:
+        escalate_pending(list(stale), now)
+    if fired:
+        meta_data['scheduler_watermark'] = now
+        save_change("meta", "scheduler_watermark")
+        logger.info(f"⏰ Rejali hodisalar bajarildi: {fired} ta ({len(stale)} ta pending adminga eslatildi)")
+
+# ==================== STATISTIKA ====================
+# meta_data["stats"]: har bir holat o'zgarishida yangilanadi va ma'lumotlar bilan birga saqlanadi
+#   drivers: {status: soni}, passengers: soni, payments: {status: {'count', 'amount'}}
+# meta_data["stats_day:YYYY-MM-DD"]: {drivers, passengers, payments, verified_payments, revenue}
+#   har bir kun alohida kalit - o'zgarishda faqat umumiy hisoblagichlar va shu kun jurnalga yoziladi
+STATS_DAY_PREFIX = "stats_day:"
+_stats_touched_days = set()  # save_stats() gacha o'zgargan (yoki o'chirilgan) kunlik kalitlar
+
+def get_stats():
+    return meta_data["stats"]
+
+def stats_days():
+    """Saqlanayotgan kunlar (o'sish tartibida)"""
+    return sorted(key[len(STATS_DAY_PREFIX):] for key in meta_data if key.startswith(STATS_DAY_PREFIX))
+
+def _stats_day(date=None):
+    """Kunlik hisoblagich. Saqlash oynasi to'lgan bo'lsa va kun undan eski bo'lsa None"""
+    day = (date or datetime.now().isoformat())[:10]
+    key = STATS_DAY_PREFIX + day
+    bucket = meta_data.get(key)
+    if bucket is None:
+        days = stats_days()
+        if len(days) >= STATS_DAILY_RETENTION:
+            if day < days[0]:
+                return None
+            oldest = STATS_DAY_PREFIX + days[0]
+            del meta_data[oldest]
+            _stats_touched_days.add(oldest)
+        bucket = meta_data[key] = {'drivers': 0, 'passengers': 0, 'payments': 0, 'verified_payments': 0, 'revenue': 0}
+    _stats_touched_days.add(key)
+    return bucket
+
+def _count_application(stats, kind, app):
+    bucket = _stats_day(app.get('date'))
+    if kind == 'driver':
+        status = app.get('status', 'pending')
+        stats['drivers'][status] = stats['drivers'].get(status, 0) + 1
+    else:
+        stats['passengers'] += 1
+    if bucket is not None:
+        bucket['drivers' if kind == 'driver' else 'passengers'] += 1
+
+def _count_payment_status(stats, payment, status, sign=1):
+    item = stats['payments'].setdefault(status, {'count': 0, 'amount': 0})
+    item['count'] += sign
+    item['amount'] += sign * payment.get('amount', 0)
+    
+    if status == 'verified':
+        bucket = _stats_day(payment.get('verified_at') or payment.get('date'))
+        if bucket is not None:
+            bucket['verified_payments'] += sign
+            bucket['revenue'] += sign * payment.get('amount', 0)
+
+def _count_payment(stats, payment):
+    bucket = _stats_day(payment.get('date'))
+    if bucket is not None:
+        bucket['payments'] += 1
+    _count_payment_status(stats, payment, payment.get('status', 'pending'))
+
+def save_stats():
+    """Umumiy hisoblagichlar va faqat o'zgargan kunlarni saqlash"""
+    save_change("meta", "stats")
+    while _stats_touched_days:
+        save_change("meta", _stats_touched_days.pop())
+
+def rebuild_stats():
+    """Statistikani mavjud ma'lumotlardan hisoblash (meta_data da hali bo'lmasa, bir marta)"""
+    for key in [key for key in meta_data if key.startswith(STATS_DAY_PREFIX)]:
+        del meta_data[key]
+        _stats_touched_days.add(key)
+    
+    stats = meta_data["stats"] = {'drivers': {}, 'passengers': 0, 'payments': {}}
+    for app in driver_applications.values():
+        _count_application(stats, 'driver', app)
+    for app in passenger_applications.values():
+        _count_application(stats, 'passenger', app)
+    for payments in payments_data.values():
+        for payment in payments:
+            _count_payment(stats, payment)
+    
+    save_stats()
+    logger.info("✅ Statistika ma'lumotlardan qayta hisoblandi")
+
+def split_stats_days():
+    """Eski versiya kunlik statistikani meta_data["stats"] ichida saqlagan - har kunni alohida kalitga ko'chirish"""
+    for day, bucket in meta_data["stats"].pop("daily").items():
+        meta_data[STATS_DAY_PREFIX + day] = bucket
+        _stats_touched_days.add(STATS_DAY_PREFIX + day)
+    save_stats()
+
+def stats_application_created(kind, app):
+    """kind: 'driver' yoki 'passenger'"""
+    _count_application(get_stats(), kind, app)
+    save_stats()
+
+def stats_driver_status(old_status, new_status):
+    if old_status == new_status:
+        return
+    drivers = get_stats()['drivers']
+    drivers[old_status] = drivers.get(old_status, 0) - 1
+    drivers[new_status] = drivers.get(new_status, 0) + 1
+    save_stats()
+
+def stats_payment_created(payment):
+    _count_payment(get_stats(), payment)
+    save_stats()
+
+def stats_payment_status(payment, old_status):
+    if old_status == payment['status']:
+        return
+    stats = get_stats()
+    _count_payment_status(stats, payment, old_status, sign=-1)
+    _count_payment_status(stats, payment, payment['status'])
+    save_stats()
+
+load_data()
+
+# ==================== CALLBACK MA'LUMOTLARI ====================
+# callback_data formati: "<prefiks>:<maydon1>:<maydon2>..." (Telegram limiti 64 bayt).
+# Oxirgi maydon ajratuvchini ham o'z ichiga olishi mumkin, shuning uchun ID larda '_' yoki ':' muammo emas.
+CALLBACK_SEPARATOR = ':'
+
+# prefiks -> maydonlar; har bir prefiks uchun o'z namedtuple turi yasaladi
+CALLBACK_SCHEMAS = {
+    'role': ('role',),
+    'car': ('value',),
+    'pref': ('value',),
+    'time': ('value',),
+    'drivers': (),
+    'pay': ('action',),
+    'payment': ('action', 'payment_id'),
+    'driver': ('action', 'app_id'),
+    'page': ('report', 'direction', 'cursor'),
+}
+CALLBACK_TYPES = {
+    prefix: collections.namedtuple(f"{prefix.capitalize()}Callback", ('prefix',) + fields)
+    for prefix, fields in CALLBACK_SCHEMAS.items()
+}
+
+# Eski formatdagi tugmalar (oldin yuborilgan xabarlarda qolgan) yangi formatga o'giriladi
+LEGACY_CALLBACKS = {
+    'role_driver': 'role:driver',
+    'role_passenger': 'role:passenger',
+    'show_drivers': 'drivers',
+    'pay_card': 'pay:card',
+    'pay_click': 'pay:click',
+    'pay_payme': 'pay:payme',
+    'cancel_payment': 'pay:cancel',
+    'confirm_payment': 'pay:confirm',
+}
+LEGACY_CALLBACK_PREFIXES = (
+    ('admin_verify_driver_', 'driver:verify:'),
+    ('admin_reject_driver_', 'driver:reject:'),
+    ('verify_', 'payment:verify:'),
+    ('reject_', 'payment:reject:'),
+    ('car_type_', 'car:'),
+    ('car_pref_', 'pref:'),
+    ('time_', 'time:'),
+)
+
+def encode_callback(prefix, *values):
+    """Tugma uchun callback_data yasash, masalan: encode_callback('driver', 'verify', app_id)"""
+    assert len(values) == len(CALLBACK_SCHEMAS[prefix]), prefix
+    return CALLBACK_SEPARATOR.join((prefix,) + tuple(str(value) for value in values))
+
+def _upgrade_legacy_callback(data):
+    if data in LEGACY_CALLBACKS:
+        return LEGACY_CALLBACKS[data]
+    for old_prefix, new_prefix in LEGACY_CALLBACK_PREFIXES:
+        if data.startswith(old_prefix):
+            return new_prefix + data[len(old_prefix):]
+    return None
+
+def decode_callback(data):
+    """callback_data -> prefiksga mos namedtuple (noma'lum yoki buzilgan bo'lsa None)"""
+    prefix, _, rest = data.partition(CALLBACK_SEPARATOR)
+    if prefix not in CALLBACK_SCHEMAS:
+        data = _upgrade_legacy_callback(data)
+        if data is None:
+            return None
+        prefix, _, rest = data.partition(CALLBACK_SEPARATOR)
+    
+    fields = CALLBACK_SCHEMAS[prefix]
+    values = rest.split(CALLBACK_SEPARATOR, len(fields) - 1) if fields else []
+    if len(values) != len(fields) or (not fields and rest):
+        return None
+    return CALLBACK_TYPES[prefix](prefix, *values)
+
+# ==================== KEYBOARD FUNKSIYALARI ====================
+def car_type_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("Spark ⚡️", callback_data=encode_callback('car', 'Spark')),
+         InlineKeyboardButton("Cobalt", callback_data=encode_callback('car', 'Cobalt'))],
+        [InlineKeyboardButton("Gentra", callback_data=encode_callback('car', 'Gentra')),
+         InlineKeyboardButton("Lacetti", callback_data=encode_callback('car', 'Lacetti'))],
+        [InlineKeyboardButton("Nexia", callback_data=encode_callback('car', 'Nexia')),
+         InlineKeyboardButton("Malibu", callback_data=encode_callback('car', 'Malibu'))],
+        [InlineKeyboardButton("Boshqa", callback_data=encode_callback('car', 'Boshqa'))]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def car_preference_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("Iqtisodiy 💸", callback_data=encode_callback('pref', 'Iqtisodiy')),
+         InlineKeyboardButton("Komfort 🛋️", callback_data=encode_callback('pref', 'Komfort'))],
+        [InlineKeyboardButton("Spark", callback_data=encode_callback('pref', 'Spark')),
+         InlineKeyboardButton("Cobalt", callback_data=encode_callback('pref', 'Cobalt'))],
+        [InlineKeyboardButton("Gentra", callback_data=encode_callback('pref', 'Gentra')),
+         InlineKeyboardButton("Farqi yo'q", callback_data=encode_callback('pref', 'Farqi yoq'))]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def time_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("Hozir 🕐", callback_data=encode_callback('time', 'Hozir')),
+         InlineKeyboardButton("30 daqiqadan keyin", callback_data=encode_callback('time', '30 daqiqadan keyin'))],
+        [InlineKeyboardButton("1 soatdan keyin", callback_data=encode_callback('time', '1 soatdan keyin')),
+         InlineKeyboardButton("Bugun kechqurun", callback_data=encode_callback('time', 'Bugun kechqurun'))],
+        [InlineKeyboardButton("Ertaga ertalab", callback_data=encode_callback('time', 'Ertaga ertalab'))],
+        [InlineKeyboardButton("Boshqa vaqt", callback_data=encode_callback('time', 'Boshqa'))]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def phone_keyboard():
+    keyboard = [[KeyboardButton("📱 Telefon raqamni yuborish", request_contact=True)]]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+
+def location_keyboard(button_text, skippable=False):
+    keyboard = [[KeyboardButton(button_text, request_location=True)]]
+    if skippable:
+        keyboard.append([KeyboardButton(SKIP_BUTTON_TEXT)])
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+
+def skip_keyboard():
+    return ReplyKeyboardMarkup([[KeyboardButton(SKIP_BUTTON_TEXT)]], resize_keyboard=True, one_time_keyboard=True)
+
+def main_menu_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("🚗 Haydovchi bo'lish", callback_data=encode_callback('role', 'driver'))],
+        [InlineKeyboardButton("🚶 Yo'lovchi bo'lish", callback_data=encode_callback('role', 'passenger'))],
+        [InlineKeyboardButton("💰 Haydovchilar ro'yxati (5,000 so'm)", callback_data=encode_callback('drivers'))],
+        [InlineKeyboardButton("📞 Admin", url=f"tg://user?id={ADMIN_ID}")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def payment_methods_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("💳 Bank karta", callback_data=encode_callback('pay', 'card'))],
+        [InlineKeyboardButton("📱 Click", callback_data=encode_callback('pay', 'click'))],
+        [InlineKeyboardButton("💵 Payme", callback_data=encode_callback('pay', 'payme'))],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data=encode_callback('pay', 'cancel'))]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def confirm_payment_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("✅ To'lov qildim", callback_data=encode_callback('pay', 'confirm'))],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data=encode_callback('pay', 'cancel'))]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# ==================== TELEGRAM GA YUBORISH (LIMITLAR) ====================
+class RateLimiter:
+    """Telegram limitlari: umumiy token bucket va har bir chat uchun minimal oraliq"""
+    
+    def __init__(self, rate, per_chat_interval):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._chat_next = {}  # chat_id -> keyingi ruxsat etilgan vaqt
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds):
+        """RetryAfter kelganda barcha yuborishlarni to'xtatib turish"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self, chat_id=None):
+        # 1. Chat bo'yicha navbat (joy oldindan band qilinadi)
+        if chat_id is not None:
+            now = time.monotonic()
+            slot = max(now, self._chat_next.get(chat_id, 0))
+            self._chat_next[chat_id] = slot + self.per_chat_interval
+            if len(self._chat_next) > 10000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+            if slot > now:
+                await asyncio.sleep(slot - now)
+        
+        # 2. Umumiy limit
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+telegram_limiter = RateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_INTERVAL)
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        retry_after = retry_after.total_seconds()
+    return float(retry_after)
+
+async def send_with_retry(method, chat_id, max_attempts=SEND_MAX_ATTEMPTS, **kwargs):
+    """Limitlarga rioya qilib yuborish. RetryAfter va tarmoq xatolarida qayta urinadi.
+    
+    Forbidden (bot bloklangan) va BadRequest darhol yuqoriga uzatiladi.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        await telegram_limiter.acquire(chat_id)
+        try:
+            return await method(chat_id=chat_id, **kwargs)
+        except RetryAfter as e:
+            delay = _retry_after_seconds(e)
+            logger.warning(f"⏳ Telegram limiti: {delay} soniya kutamiz (chat {chat_id})")
+            telegram_limiter.pause(delay)
+            if attempt >= max_attempts:
+                raise
+        except (Forbidden, BadRequest):
+            raise
+        except (TimedOut, NetworkError) as e:
+            if attempt >= max_attempts:
+                raise
+            logger.warning(f"⚠️ Yuborishda tarmoq xatosi, qayta urinish {attempt}/{max_attempts}: {e}")
+            await asyncio.sleep(min(2 ** attempt, 30))
+
+def mark_user_blocked(user_id):
+    """Botni bloklagan foydalanuvchini belgilash (keyingi broadcastlarda o'tkazib yuboriladi)"""
+    if user_id in user_data and not user_data[user_id].get('blocked'):
+        user_data[user_id]['blocked'] = True
+        save_change("user_data", user_id)
+
+# ==================== CHIQUVCHI XABARLAR NAVBATI ====================
+def outbox_step(method, chat_id, fallback=None, **kwargs):
+    """Navbat uchun bitta yuborish qadami (JSON ga saqlanadigan ko'rinishda)"""
+    if isinstance(kwargs.get('reply_markup'), InlineKeyboardMarkup):
+        kwargs['reply_markup'] = kwargs['reply_markup'].to_dict()
+    if kwargs.get('parse_mode') is not None:
+        kwargs['parse_mode'] = str(kwargs['parse_mode'])
+    
+    step = {'method': method, 'chat_id': chat_id, 'kwargs': kwargs}
+    if fallback:
+        step['fallback'] = fallback
+    return step
+
+class OutboundQueue:
+    """Kanal va admin xabarlari uchun saqlanadigan navbat.
+    
+    Handler xabarni navbatga qo'yadi va foydalanuvchiga darhol javob beradi, workerlar esa
+    fonda yuboradi. Har bir element kalit bo'yicha dublikatdan himoyalangan, qadamlar ketma-ket
+    yuboriladi va har bir yuborilgan qadam saqlanadi (qayta ishga tushganda takrorlanmaydi).
+    Xato bo'lsa eksponensial kutish bilan qayta uriniladi.
+    """
+    
+    def __init__(self, workers=OUTBOX_WORKERS):
+        self.workers = workers
+        self._queue = None
+        self._tasks = []
+        self._bot = None
+        self._delivered = collections.OrderedDict()  # Yaqinda yuborilgan kalitlar (dublikat uchun)
+    
+    def depth(self):
+        return len(outbox)
+    
+    def oldest_age(self, now):
+        """Navbatdagi eng eski xabar qancha kutmoqda (soniya). Qayta ishga tushishdan oldingi vaqt hisoblanmaydi"""
+        # outbox qo'shilish tartibida - birinchi element eng eskisi
+        item = next(iter(outbox.values()), None)
+        if item is None:
+            return 0
+        created = datetime.fromisoformat(item['created_at']).timestamp()
+        return max(0, now - max(created, bot_started_at or now))
+    
+    def enqueue(self, key, steps):
+        """Xabarni navbatga qo'yish. Dublikat bo'lsa False qaytaradi"""
+        if key in outbox or key in self._delivered:
+            logger.info(f"♻️ Dublikat xabar o'tkazib yuborildi: {key}")
+            return False
+        
+        outbox[key] = {
+            'key': key,
+            'steps': steps,
+            'step': 0,
+            'attempts': 0,
+            'created_at': datetime.now().isoformat()
+        }
+        save_change("outbox", key)
+        
+        if self._queue is not None:
+            self._queue.put_nowait(key)
+        return True
+    
+    def start(self, application):
+        """Workerlarni ishga tushirish va saqlangan xabarlarni navbatga qo'yish"""
+        self._bot = application.bot
+        self._queue = asyncio.Queue()
+        for key in list(outbox):
+            self._queue.put_nowait(key)
+        
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if outbox:
+            logger.info(f"📬 Navbatda qolgan xabarlar: {len(outbox)} ta")
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            item = outbox.get(key)
+            if item is None:
+                continue
             
-            await context.bot.send_photo(
-                chat_id=ADMIN_ID,
-                photo=user_data[user_id]['car_photo'],
-                caption=caption,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
-            )
+            try:
+                await self._deliver(item)
+            except Exception as e:
+                self._schedule_retry(item, e)
+                continue
             
-            logger.info(f"📤 Adminga MASHINA TEKSHIRUVI uchun xabar yuborildi: {app_id}")
+            self._finish(key)
+    
+    async def _deliver(self, item):
+        while item['step'] < len(item['steps']):
+            step = item['steps'][item['step']]
+            try:
+                await self._send(step['method'], step['chat_id'], step['kwargs'])
+            except Forbidden:
+                logger.warning(f"🚫 Chat {step['chat_id']} botni bloklagan, xabar bekor qilindi: {item['key']}")
+                mark_user_blocked(step['chat_id'])
+                return
+            except BadRequest as e:
+                fallback = step.get('fallback')
+                if not fallback:
+                    logger.error(f"❌ Xabar qadami yuborilmadi ({item['key']}): {e}")
+                else:
+                    logger.warning(f"⚠️ {step['method']} xatosi, zaxira xabar yuborilmoqda: {e}")
+                    await self._send(fallback['method'], step['chat_id'], fallback['kwargs'])
             
-        except Exception as e:
-            logger.error(f"⚠️ Adminga rasm yuborishda xato: {e}")
-            text_message = (
-                f"🚗 *MASHINA TEKSHRIVI*\n\n"
-                f"📋 **Haydovchi ma'lumotlari:**\n"
-                f"• ID: {app_id}\n"
-                f"• Ism: {user_data[user_id]['first_name']}\n"
-                f"• Telefon: {user_data[user_id]['phone']}\n"
-                f"• Mashina: {user_data[user_id]['car_type']}\n"
-                f"• Narx: {user_data[user_id]['price']}\n\n"
-                f"⚠️ *RASM YUBORISHDA XATOLIK*\n\n"
-                f"*Tasdiqlang yoki rad eting:*"
+            item['step'] += 1
+            save_change("outbox", item['key'])
+    
+    async def _send(self, method, chat_id, kwargs):
+        kwargs = dict(kwargs)
+        if isinstance(kwargs.get('reply_markup'), dict):
+            kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(kwargs['reply_markup'], self._bot)
+        await send_with_retry(getattr(self._bot, method), chat_id, **kwargs)
+    
+    def _schedule_retry(self, item, error):
+        item['attempts'] += 1
+        if item['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(f"❌ Xabar {item['attempts']} urinishdan keyin tashlab yuborildi ({item['key']}): {error}")
+            OUTBOX_FAILURES.inc(result="dropped")
+            self._finish(item['key'])
+            return
+        
+        OUTBOX_FAILURES.inc(result="retry")
+        save_change("outbox", item['key'])
+        delay = min(OUTBOX_RETRY_BASE * 2 ** (item['attempts'] - 1), OUTBOX_RETRY_MAX)
+        logger.warning(f"⚠️ Xabar yuborilmadi ({item['key']}), {delay} soniyadan keyin qayta: {error}")
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, item['key'])
+    
+    def _finish(self, key):
+        outbox.pop(key, None)
+        save_change("outbox", key)
+        
+        self._delivered[key] = True
+        if len(self._delivered) > 5000:
+            self._delivered.popitem(last=False)
+
+outbound_queue = OutboundQueue()
+
+Gauge("bot_outbox_depth", "Yuborilishi kutilayotgan xabarlar", outbound_queue.depth)
+Gauge("bot_active_access", "24 soatlik accessi faol yo'lovchilar", lambda: len(access_expires_at))
+Gauge("bot_verified_drivers", "Tasdiqlangan haydovchilar", lambda: len(verified_drivers))
+Gauge("bot_scheduled_events", "Rejali hodisalar (eslatmalar, access tugashi)", lambda: len(scheduled_events))
+Gauge("bot_last_update_age_seconds", "Oxirgi updatedan beri o'tgan vaqt", lambda: round(time.time() - last_update_at, 3) if last_update_at else None)
+Gauge("bot_uptime_seconds", "Jarayon ishlab turgan vaqt", lambda: round(time.time() - process_started_at))
+
+# ==================== TO'LOV TIZIMI FUNKSIYALARI ====================
+def has_paid_recently(user_id):
+    """24 soat ichida to'lov qilganmi tekshirish"""
+    expires = access_expires_at.get(int(user_id))
+    return expires is not None and expires > time.time()
+
+def add_payment_record(user_id, method, screenshot_id=None):
+    """To'lov yozuvini qo'shish"""
+    user_id_str = str(user_id)
+    
+    if user_id_str not in payments_data:
+        payments_data[user_id_str] = []
+    
+    # Bir soniyada ikkita to'lov bo'lsa ham ID takrorlanmasin
+    payment_id = base_id = f"pay_{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    suffix = 1
+    while payment_id in payment_index:
+        suffix += 1
+        payment_id = f"{base_id}_{suffix}"
+    
+    payment_record = {
+        'id': payment_id,
+        'date': datetime.now().isoformat(),
+        'amount': PAYMENT_AMOUNT,
+        'method': method,
+        'status': 'pending',
+        'screenshot': screenshot_id
+    }
+    
+    payments_data[user_id_str].append(payment_record)
+    payment_index[payment_record['id']] = (user_id_str, payment_record)
+    index_payment(payment_record)
+    schedule_pending_escalation('payment', payment_record['id'], payment_record['date'])
+    save_change("payments_data", user_id_str)
+    stats_payment_created(payment_record)
+    return payment_record['id']
+
+def render_driver_entry(app_id, driver):
+    """Bitta haydovchi matni (kesh; ariza o'zgarmaguncha qayta qurilmaydi)"""
+    entry = _driver_entry_cache.get(app_id)
+    if entry is None:
+        entry = (
+            f"*{driver.get('first_name', 'Noma\'lum')}*\n"
+            f"   🚘 {driver.get('car_type', 'Mashina yo\'q')}\n"
+            f"   💰 {format_price(driver)}\n"
+            f"   📞 {driver.get('phone', 'Telefon yo\'q')}\n"
+        )
+        if driver.get('route_from') and driver.get('route_to'):
+            entry += f"   🛣 {driver['route_from']} ⇄ {driver['route_to']}\n"
+        _driver_entry_cache[app_id] = entry
+    return entry
+
+def render_drivers_list(drivers):
+    """Haydovchilar ro'yxati matni: drivers = select_drivers_for_user() natijasi"""
+    message = "🚗 *TOP HAYDOVCHILAR*\n\n"
+    message += "💰 *To'lov qilganingiz uchun rahmat! (5,000 so'm)*\n\n"
+    
+    for i, (app_id, driver, distance) in enumerate(drivers, 1):
+        message += f"{i}. {render_driver_entry(app_id, driver)}"
+        if distance is not None:
+            message += f"   📍 ~{distance:.1f} km\n"
+        message += "\n"
+    
+    message += "📞 *Haydovchi bilan bog'laning va safar haqida kelishing*\n\n"
+    message += "⏱️ *24 soat davomida yangi haydovchilar qo'shilganda sizga xabar yuboriladi*"
+    return message
+
+def drivers_list_text(user_id):
+    """Foydalanuvchiga yuboriladigan haydovchilar ro'yxati (Markdown)"""
+    if not verified_drivers:
+        return "🚗 *Haydovchilar ro'yxati*\n\nHozircha faol haydovchilar yo'q. Biroz vaqt o'tgach qayta urinib ko'ring.\n\n✅ To'lovingiz qabul qilindi va saqlandi."
+    return render_drivers_list(select_drivers_for_user(user_id))
+
+async def send_drivers_list_to_user(context, user_id):
+    """Haydovchilar ro'yxatini foydalanuvchiga yuborish"""
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=drivers_list_text(user_id),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+def notify_subscribers_about_driver(app_id, app):
+    """Yangi tasdiqlangan haydovchi haqida faol accessi bor yo'lovchilarga xabar (navbat orqali).
+    
+    Haydovchi yo'nalishi va yo'lovchi yo'nalishi ma'lum bo'lsa, faqat mos kelganlarga yuboriladi.
+    """
+    now = time.time()
+    text = (
+        "🆕 *Yangi haydovchi qo'shildi!*\n\n"
+        f"{render_driver_entry(app_id, app)}\n"
+        "📞 *Haydovchi bilan bog'laning va safar haqida kelishing*"
+    )
+    
+    sent = 0
+    for user_id, expires in list(access_expires_at.items()):
+        if expires <= now or user_id == app.get('user_id') or user_data.get(user_id, {}).get('blocked'):
+            continue
+        
+        indexed = passenger_corridor.get(user_id)
+        if app_id in driver_corridor and indexed is not None and app_id not in drivers_for_corridor(*indexed[1]):
+            continue
+        
+        if outbound_queue.enqueue(f"newdriver:{app_id}:{user_id}", [
+            outbox_step('send_message', user_id, text=text, parse_mode=ParseMode.MARKDOWN)
+        ]):
+            sent += 1
+    
+    logger.info(f"📣 Yangi haydovchi {app_id} haqida {sent} ta obunachiga xabar navbatga qo'yildi")
+    return sent
+
+async def notify_admin_about_payment(context, user_id, payment_id, screenshot_id=None, first_name=None):
+    """Admin ga to'lov haqida xabar berish (navbat orqali)"""
+    try:
+        first_name = first_name or user_data.get(user_id, {}).get('first_name', 'Noma\'lum')
+        message = (
+            f"💳 *TO'LOV TEKSHRIVI*\n\n"
+            f"📋 **Foydalanuvchi ma'lumotlari:**\n"
+            f"• Ism: {first_name}\n"
+            f"• ID: {user_id}\n"
+            f"• Summa: {PAYMENT_AMOUNT:,} so'm\n"
+            f"• Vaqt: {datetime.now().strftime('%H:%M %d.%m.%Y')}\n"
+            f"• To'lov ID: {payment_id}\n\n"
+            f"🔍 *Screenshotni tekshiring:*\n"
+            f"1. To'lov summasi to'g'rimi?\n"
+            f"2. Screenshot aniq va ko'rinadimi?\n"
+            f"3. To'lov vaqti to'g'rimi?\n\n"
+            f"*Tasdiqlang yoki rad eting:*"
+        )
+        
+        keyboard = [
+            [
+                InlineKeyboardButton("✅ To'lovni tasdiqlash", callback_data=encode_callback('payment', 'verify', payment_id)),
+                InlineKeyboardButton("❌ To'lovni rad etish", callback_data=encode_callback('payment', 'reject', payment_id))
+            ]
+        ]
+        
+        if screenshot_id:
+            step = outbox_step(
+                'send_photo',
+                ADMIN_ID,
+                photo=screenshot_id,
+                caption=message,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode=ParseMode.MARKDOWN
             )
-            
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=text_message,
+        else:
+            step = outbox_step(
+                'send_message',
+                ADMIN_ID,
+                text=message,
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode=ParseMode.MARKDOWN
             )
         
+        outbound_queue.enqueue(f"payment:{payment_id}:admin", [step])
+        logger.info(f"📤 Adminga TO'LOV tekshiruvi uchun xabar navbatga qo'yildi: {payment_id}")
+    except Exception as e:
+        logger.error(f"Adminga xabar yuborishda xato: {e}")
+
+# ==================== HAYDOVCHI ARIZASINI YAKUNLASH ====================
+async def complete_driver_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Haydovchi arizasini admin tasdiqlashi uchun yuborish"""
+    try:
+        user_id = update.effective_user.id
+        
+        # Ro'yxatdan o'tish holatini tekshirish
+        session = get_registration_session(user_id)
+        if session is None:
+            await update.message.reply_text(
+                "❌ Xatolik! Iltimos, qaytadan /start boshlang.", 
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        # Kerakli maydonlarni tekshirish
+        required_fields = ['first_name', 'phone', 'car_type', 'price', 'car_photo']
+        missing_fields = []
+        
+        for field in required_fields:
+            if getattr(session, field) is None:
+                missing_fields.append(field)
+        
+        if missing_fields:
+            await update.message.reply_text(
+                f"❌ Quyidagi maydonlar to'ldirilmagan: {', '.join(missing_fields)}\nIltimos, qaytadan /start boshlang.", 
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        # Profil (ariza maydonlari user_data ga yozilmaydi)
+        user_data.setdefault(user_id, {}).update(
+            first_name=session.first_name,
+            phone=session.phone,
+            car_type=session.car_type,
+            role='driver'
+        )
+        
+        # Ariza ID sini yaratish
+        app_id = allocate_application_id("D")
+        
+        # Ma'lumotlarni vaqtinchalik saqlash (admin tasdiqlashini kutish)
+        driver_applications[app_id] = {
+            'user_id': user_id,  # int saqlanadi
+            'first_name': session.first_name,
+            'phone': session.phone,
+            'car_type': session.car_type,
+            'price': session.price,
+            'price_amount': session.price_amount,
+            'route': session.route,
+            'route_from': session.route_from,
+            'route_to': session.route_to,
+            'location': session.location,
+            'car_photo': session.car_photo,
+            'date': datetime.now().isoformat(),
+            'status': 'pending'
+        }
+        index_driver_application(app_id, driver_applications[app_id])
+        stats_application_created('driver', driver_applications[app_id])
+        schedule_pending_escalation('driver', app_id, driver_applications[app_id]['date'])
+        
+        # Admin uchun tasdiqlash keyboardi
+        keyboard = [
+            [InlineKeyboardButton("✅ Mashinani tasdiqlash", callback_data=encode_callback('driver', 'verify', app_id)),
+             InlineKeyboardButton("❌ Mashinani rad etish", callback_data=encode_callback('driver', 'reject', app_id))]
+        ]
+        
+        # Adminga xabar yuborish (navbat orqali; rasm yuborilmasa matnli xabar yuboriladi)
+        caption = (
+            f"🚗 *MASHINA TEKSHRIVI*\n\n"
+            f"📋 **Haydovchi ma'lumotlari:**\n"
+            f"• ID: {app_id}\n"
+            f"• Ism: {session.first_name}\n"
+            f"• Telefon: {session.phone}\n"
+            f"• Mashina: {session.car_type}\n"
+            f"• Narx: {session.price} ({session.price_amount:,} so'm)\n"
+            f"• Yoʻnalish: {session.route or 'koʻrsatilmagan'}\n"
+            f"• Lokatsiya: {'✅ yuborilgan' if session.location else '❌ yoʻq'}\n"
+            f"• Vaqt: {datetime.now().strftime('%H:%M %d.%m.%Y')}\n\n"
+            f"🔍 *Mashina rasmiga qarang va tekshiring:*\n"
+            f"1. Rasm mashinaga tegishlimi?\n"
+            f"2. Rasm aniq va ko'rinadimi?\n"
+            f"3. Barcha ma'lumotlar to'grimi?\n\n"
+            f"*Tasdiqlang yoki rad eting:*"
+        )
+        text_message = (
+            f"🚗 *MASHINA TEKSHRIVI*\n\n"
+            f"📋 **Haydovchi ma'lumotlari:**\n"
+            f"• ID: {app_id}\n"
+            f"• Ism: {session.first_name}\n"
+            f"• Telefon: {session.phone}\n"
+            f"• Mashina: {session.car_type}\n"
+            f"• Narx: {session.price}\n\n"
+            f"⚠️ *RASM YUBORISHDA XATOLIK*\n\n"
+            f"*Tasdiqlang yoki rad eting:*"
+        )
+        
+        outbound_queue.enqueue(f"driver_app:{app_id}:admin", [
+            outbox_step(
+                'send_photo',
+                ADMIN_ID,
+                photo=session.car_photo,
+                caption=caption,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode=ParseMode.MARKDOWN,
+                fallback=outbox_step(
+                    'send_message',
+                    ADMIN_ID,
+                    text=text_message,
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    parse_mode=ParseMode.MARKDOWN
+                )
+            )
+        ])
+        logger.info(f"📤 Adminga MASHINA TEKSHIRUVI uchun xabar navbatga qo'yildi: {app_id}")
+        
         # Foydalanuvchiga xabar
         await update.message.reply_text(
-            f"✅ *Rahmat, {user_data[user_id]['first_name']}!*\n\n"
+            f"✅ *Rahmat, {session.first_name}!*\n\n"
             f"Haydovchi arizangiz qabul qilindi (ID: {app_id})\n\n"
             f"⏳ *Mashina rasm tekshiruvida...*\n"
             f"Admin mashina rasmni tekshiryapti. Natija sizga yuboriladi.\n\n"
@@ -540,12 +2843,12 @@ async def complete_driver_application(update: Update, context: ContextTypes.DEFA
             parse_mode=ParseMode.MARKDOWN
         )
         
-        # User_states dan o'chirish
-        if user_id in user_states:
-            del user_states[user_id]
+        # Ro'yxatdan o'tish yakunlandi
+        registration_sessions.pop(user_id, None)
         
         # Ma'lumotlarni saqlash
-        save_data()
+        save_change("user_data", user_id)
+        save_change("driver_applications", app_id)
         
         logger.info(f"✅ Haydovchi arizasi #{app_id} admin tekshiruviga yuborildi")
         
@@ -561,7 +2864,7 @@ async def complete_driver_application(update: Update, context: ContextTypes.DEFA
 # ==================== ADMIN HAYDOVCHI TASDIQLASH HANDLERI ====================
 # ==================== ADMIN HAYDOVCHI TASDIQLASH HANDLERI ====================
 # ==================== ADMIN HAYDOVCHI TASDIQLASH HANDLERI ====================
-async def admin_driver_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_driver_action(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     """Admin haydovchi arizasini tasdiqlash yoki rad etish"""
     query = update.callback_query
     
@@ -577,30 +2880,13 @@ async def admin_driver_action(update: Update, context: ContextTypes.DEFAULT_TYPE
             pass
         return
     
-    callback_data = query.data
-    logger.info(f"🚗 Admin action: {callback_data}")
+    logger.info(f"🚗 Admin action: {query.data}")
     
     try:
-        if 'admin_' not in callback_data:
-            logger.error(f"❌ Noto'g'ri callback format: {callback_data}")
-            return
-        
-        # ✅ TO'G'RI AJRATISH
-        # callback_data: "admin_verify_driver_D0001" yoki "admin_reject_driver_D0001"
-        # parts = ['admin', 'verify', 'driver', 'D0001']
-        parts = callback_data.split('_')
-        
-        # Tekshirish
-        if len(parts) != 4:
-            logger.error(f"❌ Noto'g'ri callback format: {parts}")
-            await query.answer("Noto'g'ri format!", show_alert=True)
-            return
-        
-        action = parts[1]  # 'verify' yoki 'reject' (parts[1] bo'lishi kerak!)
-        driver_type = parts[2]  # 'driver'
-        app_id = parts[3]  # 'D0001'
+        action = data.action  # 'verify' yoki 'reject'
+        app_id = data.app_id  # 'D0001'
         
-        logger.info(f"🔧 Action: {action}, Driver Type: {driver_type}, App ID: {app_id}")
+        logger.info(f"🔧 Action: {action}, App ID: {app_id}")
         
         if action not in ['verify', 'reject']:
             logger.error(f"❌ Noto'g'ri action: {action}")
@@ -616,6 +2902,12 @@ async def admin_driver_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         driver_app = driver_applications[app_id]
         logger.info(f"🔍 Driver app ma'lumotlari: {driver_app}")
         
+        # Faqat pending -> verified/rejected; takroriy bosishda kanalga qayta yuborilmaydi
+        new_status = 'verified' if action == 'verify' else 'rejected'
+        if not status_transition_allowed(driver_app.get('status'), new_status):
+            logger.info(f"ℹ️ Ariza {app_id} allaqachon {driver_app.get('status')}, {new_status} ga o'tkazilmaydi")
+            return
+        
         # USER_ID ni olish
         user_id = driver_app.get('user_id')
         logger.info(f"🔍 Original user_id: {user_id}, type: {type(user_id)}")
@@ -639,58 +2931,47 @@ async def admin_driver_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         # ================ TASDIQLASH ================
         if action == 'verify':
+            old_status = driver_app.get('status')
             driver_app['status'] = 'verified'
             driver_app['verified_by'] = query.from_user.id
             driver_app['verified_at'] = datetime.now().isoformat()
+            update_driver_roster(app_id, driver_app)
+            stats_driver_status(old_status, 'verified')
             
             logger.info(f"✅ Haydovchi tasdiqlandi: {app_id}")
             
             # 1. FOYDALANUVCHIGA XABAR
-            try:
-                user_message = (
-                    f"✅ *Tabriklaymiz, {driver_app['first_name']}!*\n\n"
-                    f"Sizning haydovchi arizangiz tasdiqlandi (ID: {app_id})\n\n"
-                    f"🚗 Endi siz haydovchilar ro'yxatidasiz\n"
-                    f"👥 Yo'lovchilar siz bilan bog'lanishi mumkin\n"
-                    f"💰 Siz belgilagan narx: {driver_app['price']}\n\n"
-                    f"✅ *Muvaffaqiyatli safarlar!*"
-                )
-                
-                logger.info(f"📤 Foydalanuvchiga xabar yuborilmoqda: user_id={user_id}")
-                
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=user_message,
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                
-                logger.info(f"✅ Foydalanuvchiga xabar yuborildi: {user_id}")
-                
-            except Exception as e:
-                logger.error(f"❌ Foydalanuvchiga xabar yuborishda xato: {e}")
-                await query.answer(f"Xatolik: {str(e)[:50]}", show_alert=True)
+            user_message = (
+                f"✅ *Tabriklaymiz, {driver_app['first_name']}!*\n\n"
+                f"Sizning haydovchi arizangiz tasdiqlandi (ID: {app_id})\n\n"
+                f"🚗 Endi siz haydovchilar ro'yxatidasiz\n"
+                f"👥 Yo'lovchilar siz bilan bog'lanishi mumkin\n"
+                f"💰 Siz belgilagan narx: {driver_app['price']}\n\n"
+                f"✅ *Muvaffaqiyatli safarlar!*"
+            )
+            outbound_queue.enqueue(f"driver_verified:{app_id}:user", [
+                outbox_step('send_message', user_id, text=user_message, parse_mode=ParseMode.MARKDOWN)
+            ])
+            logger.info(f"📤 Foydalanuvchiga xabar navbatga qo'yildi: user_id={user_id}")
             
             # 2. KANALGA XABAR
-            try:
-                channel_text = (
-                    f"🚗 YANGI HAYDOVCHI QO'SHILDI #{app_id}\n\n"
-                    f"👤 Ism: {driver_app['first_name']}\n"
-                    f"📞 Telefon: {driver_app['phone']}\n"
-                    f"🚘 Mashina: {driver_app['car_type']}\n"
-                    f"💰 Narx: {driver_app['price']}\n"
-                    f"🕐 Qo'shilgan: {datetime.now().strftime('%H:%M %d.%m.%Y')}"
-                )
-                
-                await context.bot.send_message(
-                    chat_id=CHANNEL_ID,
-                    text=channel_text
-                )
-                logger.info(f"📤 Kanalga xabar yuborildi")
-                
-            except Exception as e:
-                logger.error(f"⚠️ Kanalga xabar yuborishda xato: {e}")
+            channel_text = (
+                f"🚗 YANGI HAYDOVCHI QO'SHILDI #{app_id}\n\n"
+                f"👤 Ism: {driver_app['first_name']}\n"
+                f"📞 Telefon: {driver_app['phone']}\n"
+                f"🚘 Mashina: {driver_app['car_type']}\n"
+                f"💰 Narx: {driver_app['price']}\n"
+                f"🕐 Qo'shilgan: {datetime.now().strftime('%H:%M %d.%m.%Y')}"
+            )
+            outbound_queue.enqueue(f"driver_verified:{app_id}:channel", [
+                outbox_step('send_message', CHANNEL_ID, text=channel_text)
+            ])
+            logger.info(f"📤 Kanalga xabar navbatga qo'yildi")
+            
+            # 3. 24 SOATLIK ACCESSI BOR YO'LOVCHILARGA XABAR
+            notify_subscribers_about_driver(app_id, driver_app)
             
-            # 3. ADMIN XABARINI YANGILASH
+            # 4. ADMIN XABARINI YANGILASH
             try:
                 await query.edit_message_text(
                     f"✅ *HAYDOVCHI TASDIQLANDI!* #{app_id}\n\n"
@@ -707,36 +2988,28 @@ async def admin_driver_action(update: Update, context: ContextTypes.DEFAULT_TYPE
                 
         # ================ RAD ETISH ================
         elif action == 'reject':
+            old_status = driver_app.get('status')
             driver_app['status'] = 'rejected'
             driver_app['rejected_by'] = query.from_user.id
             driver_app['rejected_at'] = datetime.now().isoformat()
+            update_driver_roster(app_id, driver_app)
+            stats_driver_status(old_status, 'rejected')
             
             logger.info(f"❌ Haydovchi rad etildi: {app_id}")
             
             # 1. FOYDALANUVCHIGA RAD ETISH XABARI
-            try:
-                reject_message = (
-                    f"❌ *Arizangiz rad etildi* (ID: {app_id})\n\n"
-                    f"Sabablar:\n"
-                    f"• Mashina rasmida muammo\n"
-                    f"• Noto'g'ri ma'lumotlar\n"
-                    f"• Rasm mashinaga tegishli emas\n\n"
-                    f"ℹ️ Qaytadan urinib ko'rishingiz mumkin. /start"
-                )
-                
-                logger.info(f"📤 Rad etish xabari yuborilmoqda: user_id={user_id}")
-                
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=reject_message,
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                
-                logger.info(f"📩 Rad etish xabari yuborildi: {user_id}")
-                
-            except Exception as e:
-                logger.error(f"❌ Rad etish xabari yuborishda xato: {e}")
-                await query.answer(f"Xatolik: {str(e)[:50]}", show_alert=True)
+            reject_message = (
+                f"❌ *Arizangiz rad etildi* (ID: {app_id})\n\n"
+                f"Sabablar:\n"
+                f"• Mashina rasmida muammo\n"
+                f"• Noto'g'ri ma'lumotlar\n"
+                f"• Rasm mashinaga tegishli emas\n\n"
+                f"ℹ️ Qaytadan urinib ko'rishingiz mumkin. /start"
+            )
+            outbound_queue.enqueue(f"driver_rejected:{app_id}:user", [
+                outbox_step('send_message', user_id, text=reject_message, parse_mode=ParseMode.MARKDOWN)
+            ])
+            logger.info(f"📤 Rad etish xabari navbatga qo'yildi: user_id={user_id}")
             
             # 2. ADMIN XABARINI YANGILASH
             try:
@@ -753,7 +3026,7 @@ async def admin_driver_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         # MA'LUMOTLARNI SAQLASH
         try:
-            save_data()
+            save_change("driver_applications", app_id)
             logger.info(f"💾 Ma'lumotlar saqlandi")
         except Exception as e:
             logger.error(f"❌ Saqlashda xato: {e}")
@@ -766,9 +3039,13 @@ async def admin_driver_action(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
+    # Bot blokdan chiqarilgan bo'lsa, belgini olib tashlash
+    if user_data.get(user.id, {}).pop('blocked', None):
+        save_change("user_data", user.id)
+    
     if user.id == ADMIN_ID:
         await update.message.reply_text(
-            f"👑 *Assalomu alaykum, Admin!*\n\nAdmin panelga xush kelibsiz. Quyidagi komandalar mavjud:\n/stats - Statistika\n/payments - To'lovlar ro'yxati\n/broadcast - Xabar yuborish\n/users - Foydalanuvchilar",
+            f"👑 *Assalomu alaykum, Admin!*\n\nAdmin panelga xush kelibsiz. Quyidagi komandalar mavjud:\n/stats - Statistika\n/payments - To'lovlar ro'yxati\n/archive - Arxiv\n/broadcast - Xabar yuborish\n/broadcast_status - Broadcast holati\n/users - Foydalanuvchilar",
             parse_mode=ParseMode.MARKDOWN
         )
         return
@@ -782,7 +3059,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # ==================== TO'LOV TIZIMI HANDLERLARI ====================
-async def show_drivers_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def show_drivers_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     """Haydovchilar ro'yxatini ko'rish tugmasi"""
     query = update.callback_query
     await query.answer()
@@ -818,12 +3095,12 @@ async def show_drivers_callback(update: Update, context: ContextTypes.DEFAULT_TY
         parse_mode=ParseMode.HTML
     )
 
-async def payment_method_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def payment_method_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     """To'lov usullari callback handleri"""
     query = update.callback_query
     await query.answer()
     
-    if query.data == 'pay_payme':
+    if data.action == 'payme':
         context.user_data['payment_method'] = "Payme"
         await query.edit_message_text(
             f"💵 <b>Payme orqali to'lash</b>\n\n"
@@ -840,7 +3117,7 @@ async def payment_method_callback(update: Update, context: ContextTypes.DEFAULT_
             parse_mode=ParseMode.HTML
         )
     
-    elif query.data == 'pay_card':
+    elif data.action == 'card':
         context.user_data['payment_method'] = "Bank karta"
         await query.edit_message_text(
             f"💳 <b>Bank karta orqali to'lash</b>\n\n"
@@ -857,7 +3134,7 @@ async def payment_method_callback(update: Update, context: ContextTypes.DEFAULT_
             parse_mode=ParseMode.HTML
         )
     
-    elif query.data == 'pay_click':
+    elif data.action == 'click':
         context.user_data['payment_method'] = "Click"
         await query.edit_message_text(
             f"📱 <b>Click orqali to'lash</b>\n\n"
@@ -874,14 +3151,14 @@ async def payment_method_callback(update: Update, context: ContextTypes.DEFAULT_
             parse_mode=ParseMode.HTML
         )
     
-    elif query.data == 'cancel_payment':
+    elif data.action == 'cancel':
         await query.edit_message_text(
             "❌ <b>To'lov bekor qilindi.</b>\n\n"
             "Bosh menyuga qaytish uchun /start ni bosing.",
             parse_mode=ParseMode.HTML
         )
     
-    elif query.data == 'confirm_payment':
+    elif data.action == 'confirm':
         method = context.user_data.get('payment_method', 'Noma\'lum')
         await query.edit_message_text(
             "✅ <b>To'lov qilganingizni bildirdingiz!</b>\n\n"
@@ -906,7 +3183,7 @@ async def handle_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 screenshot_id
             )
             
-            await notify_admin_about_payment(context, user_id, payment_id, screenshot_id)
+            await notify_admin_about_payment(context, user_id, payment_id, screenshot_id, update.effective_user.first_name)
             
             await update.message.reply_text(
                 "✅ *Screenshot qabul qilindi!*\n\nAdmin to'lovni tekshiryapti. Tasdiqlanganidan so'ng sizga haydovchilar ro'yxati yuboriladi.\n\n⏳ *Kuting...*",
@@ -922,7 +3199,7 @@ async def handle_screenshot(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.MARKDOWN
             )
 
-async def admin_payment_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def admin_payment_action(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
     """Admin to'lovni tasdiqlash yoki rad etish"""
     query = update.callback_query
     await query.answer()
@@ -931,66 +3208,80 @@ async def admin_payment_action(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.answer("Siz admin emassiz!", show_alert=True)
         return
     
-    if '_' not in query.data:
-        return
+    action = data.action  # verify yoki reject
+    payment_id = data.payment_id
     
-    parts = query.data.split('_')
-    if len(parts) < 2:
-        return
+    logger.info(f"💰 To'lov action: {action}, ID: {payment_id}")
     
-    action = parts[0]  # verify yoki reject
-    payment_id = '_'.join(parts[1:])  # pay_... qismi
+    found = find_payment(payment_id)
+    if found is None:
+        await query.answer("To'lov topilmadi!", show_alert=True)
+        return
     
-    logger.info(f"💰 To'lov action: {action}, ID: {payment_id}")
+    user_id_str, payment = found
+    old_status = payment.get('status')
     
-    for user_id_str, payments in payments_data.items():
-        for payment in payments:
-            if payment['id'] == payment_id:
-                if action == 'verify':
-                    payment['status'] = 'verified'
-                    payment['verified_by'] = query.from_user.id
-                    payment['verified_at'] = datetime.now().isoformat()
-                    
-                    user_id_int = int(user_id_str)
-                    await send_drivers_list_to_user(context, user_id_int)
-                    
-                    await context.bot.send_message(
-                        chat_id=user_id_int,
-                        text="✅ *To'lovingiz tasdiqlandi!*\n\nHaydovchilar ro'yxati sizga yuborildi. 24 soat davomida yangi haydovchilar qo'shilganda xabar olasiz.\n\nRahmat! 🚗",
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    
-                    try:
-                        await query.edit_message_text(
-                            f"✅ *To'lov tasdiqlandi!*\n\nFoydalanuvchiga haydovchilar ro'yxati yuborildi.",
-                            parse_mode=ParseMode.MARKDOWN
-                        )
-                    except:
-                        pass
-                    
-                elif action == 'reject':
-                    payment['status'] = 'rejected'
-                    payment['rejected_by'] = query.from_user.id
-                    payment['rejected_at'] = datetime.now().isoformat()
-                    
-                    await context.bot.send_message(
-                        chat_id=int(user_id_str),
-                        text="❌ *To'lov rad etildi!*\n\nSizning to'lovingiz tasdiqlanmadi. Sabab:\n• Screenshot noaniq\n• To'lov summasi noto'g'ri\n• Boshqa xatolik\n\nQayta urinib ko'ring yoki admin bilan bog'laning.",
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    
-                    try:
-                        await query.edit_message_text(
-                            f"❌ *To'lov rad etildi!*\n\nFoydalanuvchiga rad etilganligi haqida xabar yuborildi.",
-                            parse_mode=ParseMode.MARKDOWN
-                        )
-                    except:
-                        pass
-                
-                save_data()
-                return
+    # Faqat pending -> verified/rejected: ro'yxat ikkinchi marta yuborilmaydi, tushum ikki marta
+    # hisoblanmaydi, verified_at ustidan yozilmaydi
+    new_status = 'verified' if action == 'verify' else 'rejected'
+    if not status_transition_allowed(old_status, new_status):
+        logger.info(f"ℹ️ To'lov {payment_id} allaqachon {old_status}, {new_status} ga o'tkazilmaydi")
+        return
     
-    await query.answer("To'lov topilmadi!", show_alert=True)
+    # Holat o'zgarishi va saqlash birinchi, tarmoq amallaridan oldin: foydalanuvchiga xabar
+    # yetmasa ham (bloklagan va h.k.) to'lov va statistika bir-biriga mos qoladi
+    if action == 'verify':
+        payment['status'] = 'verified'
+        payment['verified_by'] = query.from_user.id
+        payment['verified_at'] = datetime.now().isoformat()
+        save_change("payments_data", user_id_str)
+        index_payment(payment)
+        stats_payment_status(payment, old_status)
+        
+        user_id_int = int(user_id_str)
+        grant_access(user_id_int, payment)
+        outbound_queue.enqueue(f"payment_verified:{payment_id}:user", [
+            outbox_step('send_message', user_id_int, text=drivers_list_text(user_id_int), parse_mode=ParseMode.MARKDOWN),
+            outbox_step(
+                'send_message',
+                user_id_int,
+                text="✅ *To'lovingiz tasdiqlandi!*\n\nHaydovchilar ro'yxati sizga yuborildi. 24 soat davomida yangi haydovchilar qo'shilganda xabar olasiz.\n\nRahmat! 🚗",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        ])
+        
+        try:
+            await query.edit_message_text(
+                f"✅ *To'lov tasdiqlandi!*\n\nFoydalanuvchiga haydovchilar ro'yxati yuborildi.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        except:
+            pass
+        
+    elif action == 'reject':
+        payment['status'] = 'rejected'
+        payment['rejected_by'] = query.from_user.id
+        payment['rejected_at'] = datetime.now().isoformat()
+        save_change("payments_data", user_id_str)
+        index_payment(payment)
+        stats_payment_status(payment, old_status)
+        
+        outbound_queue.enqueue(f"payment_rejected:{payment_id}:user", [
+            outbox_step(
+                'send_message',
+                int(user_id_str),
+                text="❌ *To'lov rad etildi!*\n\nSizning to'lovingiz tasdiqlanmadi. Sabab:\n• Screenshot noaniq\n• To'lov summasi noto'g'ri\n• Boshqa xatolik\n\nQayta urinib ko'ring yoki admin bilan bog'laning.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        ])
+        
+        try:
+            await query.edit_message_text(
+                f"❌ *To'lov rad etildi!*\n\nFoydalanuvchiga rad etilganligi haqida xabar yuborildi.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        except:
+            pass
 
 # ==================== BUTTON HANDLER ====================
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1001,6 +3292,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info(f"🔔 Callback query: {callback_data} from user {user_id}")
     
+    # Qayta yetkazilgan callback (bir xil query ID) - javob ham, amal ham takrorlanmaydi
+    if not processed_callbacks.claim(query.id):
+        logger.info(f"ℹ️ Takroriy callback o'tkazib yuborildi: {query.id}")
+        return
+    
     # ✅ Birinchi navbatda callback query ni javob berish
     try:
         await query.answer()
@@ -1009,68 +3305,290 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Agar answer() ishlamasa ham davom etamiz
     
     try:
-        if callback_data == 'role_driver':
-            user_states[user_id] = 'registering_driver_name'
-            await query.edit_message_text('Iltimos, ismingizni kiriting:')
-            
-        elif callback_data == 'role_passenger':
-            user_states[user_id] = 'registering_passenger_name'
-            await query.edit_message_text('Iltimos, ismingizni kiriting:')
-            
-        elif callback_data.startswith('car_type_'):
-            car_type = callback_data[9:]
-            if user_id not in user_data:
-                user_data[user_id] = {}
-            user_data[user_id]['car_type'] = car_type
-            user_states[user_id] = 'registering_driver_price'
-            await query.edit_message_text('Bir safar narxini kiriting (masalan: 150000 soʻm):')
-            
-        elif callback_data.startswith('car_pref_'):
-            pref = callback_data[9:]
-            if user_id not in user_data:
-                user_data[user_id] = {}
-            user_data[user_id]['car_preference'] = pref
-            user_states[user_id] = 'registering_passenger_time'
-            await query.edit_message_text('Qachon joʻnamoqchisiz?', reply_markup=time_keyboard())
-            
-        elif callback_data.startswith('time_'):
-            time_text = callback_data[5:]
-            if time_text == 'Boshqa':
-                user_states[user_id] = 'registering_passenger_time_manual'
-                await query.edit_message_text('Vaqtni oʻzingiz yozing (masalan: 15:30, ertaga soat 10:00):')
-            else:
-                user_data[user_id]['departure_time'] = time_text
-                await complete_passenger_application(update, context)
-                
-        elif callback_data == 'show_drivers':
-            await show_drivers_callback(update, context)
-            
-        elif callback_data in ['pay_card', 'pay_click', 'pay_payme', 'cancel_payment', 'confirm_payment']:
-            await payment_method_callback(update, context)
-            
-        elif callback_data.startswith('verify_') or callback_data.startswith('reject_'):
-            logger.info(f"📞 To'lov tasdiqlash callback: {callback_data}")
-            await admin_payment_action(update, context)
-            
-        elif callback_data.startswith('admin_verify_driver_') or callback_data.startswith('admin_reject_driver_'):
-            logger.info(f"🚗 Haydovchi tasdiqlash callback: {callback_data}")
-            await admin_driver_action(update, context)
-            
-        else:
+        # Prefiks bo'yicha bitta lug'at qidiruvi (CALLBACK_HANDLERS)
+        data = decode_callback(callback_data)
+        if data is None:
             logger.warning(f"⚠️ Noma'lum callback: {callback_data}")
             try:
                 await query.answer("Noma'lum tugma!", show_alert=True)
             except:
                 pass
+            return
+        
+        handler = CALLBACK_HANDLERS[data.prefix]
+        lock_key = CALLBACK_LOCKS.get(data.prefix)
+        if lock_key is None:
+            await handler(update, context, data)
+        else:
+            async with entity_lock(*lock_key(data)):
+                await handler(update, context, data)
                 
     except Exception as e:
         logger.error(f"❌ button_handler da xato: {e}")
+        processed_callbacks.release(query.id)
         try:
             await query.answer(f"Xatolik: {str(e)[:50]}...", show_alert=True)
         except:
             pass
 
+# ==================== RO'YXATDAN O'TISH (FSM) ====================
+# Har bir rol uchun qadamlar ketma-ketligi; qadam to'g'ri javob olganda keyingisiga o'tiladi,
+# oxirgi qadamdan keyin ariza yakunlanadi. Ma'lumotlar sessiyada yig'iladi va user_data ga
+# faqat yakunlanganda (profil maydonlari) yoziladi.
+REGISTRATION_FLOWS = {
+    'driver': ('name', 'phone', 'car_type', 'price', 'route', 'location', 'photo'),
+    'passenger': ('name', 'phone', 'departure', 'destination', 'car_preference', 'time'),
+}
+
+# Qadam -> (so'rov matni, klaviatura yasovchi yoki None)
+REGISTRATION_PROMPTS = {
+    'name': ('Iltimos, ismingizni kiriting:', None),
+    'phone': ('Telefon raqamingizni yuboring:', phone_keyboard),
+    'car_type': ('Mashina turini tanlang:', car_type_keyboard),
+    'price': ('Bir safar narxini kiriting (masalan: 150000 soʻm):', None),
+    'route': ('🛣 Qaysi yoʻnalishda qatnaysiz?\n\nMasalan: "Toshkent - Samarqand" deb yozing.', skip_keyboard),
+    'location': (
+        '📍 Qaysi hududda ishlaysiz? Joylashuvingizni yuboring - yoʻlovchilarga yaqin haydovchilar birinchi koʻrsatiladi.\n\n'
+        'Keyinroq ham istalgan vaqtda lokatsiya yuborib yangilashingiz mumkin.',
+        lambda: location_keyboard("📍 Joylashuvni yuborish", skippable=True)
+    ),
+    'photo': ('🚗 Mashinangiz rasmini yuboring:', ReplyKeyboardRemove),
+    'departure': ('📍 Qayerdan joʻnamoqchisiz?\n\nMasalan: "Toshkent, Chilanzor" yoki "Samarqand shahar" deb yozing.', None),
+    'destination': ('📍 Borish joyingizni yuboring:', lambda: location_keyboard("📍 Borish joyini yuborish")),
+    'car_preference': ('Qanday mashina afzal koʻrasiz?', car_preference_keyboard),
+    'time': ('Qachon joʻnamoqchisiz?', time_keyboard),
+}
+
+# Tugma orqali tanlanadigan qadamlar: callback prefiksi -> (qadam, sessiya maydoni)
+REGISTRATION_CALLBACK_STEPS = {
+    'car': ('car_type', 'car_type'),
+    'pref': ('car_preference', 'car_preference'),
+    'time': ('time', 'departure_time'),
+}
+
+class RegistrationSession:
+    """Tugallanmagan ro'yxatdan o'tish: joriy qadam va yig'ilgan maydonlar"""
+    __slots__ = (
+        'role', 'state', 'updated_at',
+        'first_name', 'phone', 'car_type', 'price', 'price_amount', 'route', 'route_from', 'route_to', 'location', 'car_photo',
+        'departure', 'departure_location', 'destination', 'destination_location', 'car_preference', 'departure_time'
+    )
+    
+    def __init__(self, role):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        self.role = role
+        self.state = REGISTRATION_FLOWS[role][0]
+        self.touch()
+    
+    def touch(self):
+        self.updated_at = time.monotonic()
+    
+    def expired(self, now=None):
+        return (now or time.monotonic()) - self.updated_at > REGISTRATION_TTL
+
+def get_registration_session(user_id):
+    """Foydalanuvchining faol sessiyasi (muddati o'tgan bo'lsa o'chiriladi va None qaytadi)"""
+    session = registration_sessions.get(user_id)
+    if session is not None and session.expired():
+        del registration_sessions[user_id]
+        return None
+    return session
+
+async def purge_stale_registrations(context: ContextTypes.DEFAULT_TYPE):
+    """Uzoq vaqt harakatsiz qolgan ro'yxatdan o'tishlarni o'chirish (job_queue orqali)"""
+    now = time.monotonic()
+    stale = [user_id for user_id, session in registration_sessions.items() if session.expired(now)]
+    for user_id in stale:
+        del registration_sessions[user_id]
+    
+    if stale:
+        logger.info(f"🧹 Tugallanmagan ro'yxatdan o'tishlar o'chirildi: {len(stale)} ta")
+
+async def send_registration_prompt(session, message, query=None):
+    """Joriy qadam so'rovini yuborish (tugma bosilganda inline xabar tahrirlanadi)"""
+    text, make_markup = REGISTRATION_PROMPTS[session.state]
+    reply_markup = make_markup() if make_markup else None
+    if query is not None and (reply_markup is None or isinstance(reply_markup, InlineKeyboardMarkup)):
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    else:
+        await message.reply_text(text, reply_markup=reply_markup)
+
+async def advance_registration(update: Update, context: ContextTypes.DEFAULT_TYPE, session, query=None):
+    """Keyingi qadamga o'tish yoki oxirgi qadamdan keyin arizani yakunlash"""
+    flow = REGISTRATION_FLOWS[session.role]
+    position = flow.index(session.state) + 1
+    session.touch()
+    
+    if position == len(flow):
+        if session.role == 'driver':
+            await complete_driver_application(update, context)
+        else:
+            await complete_passenger_application(update, context)
+        return
+    
+    session.state = flow[position]
+    await send_registration_prompt(session, query.message if query else update.message, query)
+
+async def registration_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
+    """Haydovchi yoki yo'lovchi sifatida ro'yxatdan o'tishni boshlash"""
+    query = update.callback_query
+    if data.role not in REGISTRATION_FLOWS:
+        return
+    
+    session = RegistrationSession(data.role)
+    registration_sessions[query.from_user.id] = session
+    await send_registration_prompt(session, query.message, query)
+
+async def registration_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
+    """Tugma orqali tanlanadigan qadamlar (mashina turi, afzal mashina, vaqt)"""
+    query = update.callback_query
+    state, field = REGISTRATION_CALLBACK_STEPS[data.prefix]
+    value = data.value
+    
+    session = get_registration_session(query.from_user.id)
+    if session is None or session.state != state:
+        await query.edit_message_text("❌ Bu tugma eskirgan. Iltimos, qaytadan /start boshlang.")
+        return
+    
+    if state == 'time' and value == 'Boshqa':
+        # Vaqt matn ko'rinishida kiritiladi (xuddi shu qadamda)
+        session.touch()
+        await query.edit_message_text('Vaqtni oʻzingiz yozing (masalan: 15:30, ertaga soat 10:00):')
+        return
+    
+    setattr(session, field, value)
+    await advance_registration(update, context, session, query)
+
+def _location_dict(location):
+    return {'latitude': location.latitude, 'longitude': location.longitude}
+
+async def registration_step_name(session, message):
+    if not message.text:
+        await send_registration_prompt(session, message)
+        return False
+    session.first_name = message.text.strip()
+    return True
+
+async def registration_step_phone(session, message):
+    if message.contact:
+        phone = message.contact.phone_number
+        if not phone.startswith('+'):
+            phone = '+' + phone
+        session.phone = phone
+    elif message.text:
+        session.phone = message.text.strip()
+    else:
+        await send_registration_prompt(session, message)
+        return False
+    return True
+
+async def registration_step_price(session, message):
+    amount = parse_price(message.text)
+    if amount is None:
+        await message.reply_text(
+            f'❗ Narxni tushunmadim. {PRICE_MIN_AMOUNT:,} - {PRICE_MAX_AMOUNT:,} so\'m oralig\'ida raqam bilan yozing, '
+            f'masalan: 150000 yoki "150 ming".'
+        )
+        return False
+    session.price = message.text.strip()
+    session.price_amount = amount
+    return True
+
+async def registration_step_route(session, message):
+    text = (message.text or '').strip()
+    if text == SKIP_BUTTON_TEXT:
+        session.route = session.route_from = session.route_to = None
+        return True
+    
+    route = resolve_route(text)
+    if route is None:
+        await message.reply_text(
+            f'❗ Yoʻnalishni tushunmadim. Ikki shaharni yozing, masalan: "Toshkent - Samarqand"\n'
+            f'yoki "{SKIP_BUTTON_TEXT}" tugmasini bosing.'
+        )
+        return False
+    session.route = text
+    session.route_from, session.route_to = route
+    return True
+
+async def registration_step_location(session, message):
+    if message.location:
+        session.location = _location_dict(message.location)
+    elif message.text and message.text.strip() == SKIP_BUTTON_TEXT:
+        session.location = None
+    else:
+        await message.reply_text(f'Iltimos, lokatsiya yuboring yoki "{SKIP_BUTTON_TEXT}" tugmasini bosing.')
+        return False
+    return True
+
+async def registration_step_photo(session, message):
+    if not message.photo:
+        await message.reply_text('Iltimos, faqat rasm yuboring!')
+        return False
+    session.car_photo = message.photo[-1].file_id
+    return True
+
+async def registration_step_departure(session, message):
+    if message.location:
+        session.departure_location = _location_dict(message.location)
+        session.departure = f"Location: {message.location.latitude}, {message.location.longitude}"
+    elif message.text:
+        session.departure = message.text.strip()
+    else:
+        await send_registration_prompt(session, message)
+        return False
+    return True
+
+async def registration_step_destination(session, message):
+    if message.location:
+        session.destination_location = _location_dict(message.location)
+        session.destination = f"Location: {message.location.latitude}, {message.location.longitude}"
+    elif message.text:
+        session.destination = message.text.strip()
+    else:
+        await send_registration_prompt(session, message)
+        return False
+    return True
+
+async def registration_step_time(session, message):
+    if not message.text:
+        await send_registration_prompt(session, message)
+        return False
+    session.departure_time = message.text.strip()
+    return True
+
+# Matn/lokatsiya/rasm qabul qiladigan qadamlar: qadam -> handler(session, message) -> o'tish mumkinmi
+REGISTRATION_MESSAGE_STEPS = {
+    'name': registration_step_name,
+    'phone': registration_step_phone,
+    'price': registration_step_price,
+    'route': registration_step_route,
+    'location': registration_step_location,
+    'photo': registration_step_photo,
+    'departure': registration_step_departure,
+    'destination': registration_step_destination,
+    'time': registration_step_time,
+}
+
 # ==================== MESSAGE HANDLER ====================
+async def update_driver_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Tasdiqlangan haydovchi lokatsiya yuborsa - ish hududini yangilash"""
+    user_id = update.effective_user.id
+    app_id = driver_app_by_user.get(user_id)
+    app = driver_applications.get(app_id)
+    
+    if app is None or app.get('status') != 'verified':
+        return
+    
+    location = update.message.location
+    app['location'] = {'latitude': location.latitude, 'longitude': location.longitude}
+    app['location_updated'] = datetime.now().isoformat()
+    update_driver_location_index(app_id, app)
+    save_change("driver_applications", app_id)
+    
+    await update.message.reply_text("📍 Joylashuvingiz yangilandi! Yaqin atrofdagi yoʻlovchilar sizni birinchi koʻradi.")
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Barcha matnli xabarlarni boshqarish"""
     user_id = update.effective_user.id
@@ -1080,92 +3598,34 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_screenshot(update, context)
         return
     
-    if user_id not in user_states:
-        if message.text and message.text.startswith('/myapp'):
+    session = get_registration_session(user_id)
+    if session is None:
+        if message.location:
+            await update_driver_location(update, context)
+        elif message.text and message.text.startswith('/myapp'):
             await my_application(update, context)
         return
 
-    state = user_states[user_id]
-    if user_id not in user_data:
-        user_data[user_id] = {}
-
-    if state in ['registering_driver_name', 'registering_passenger_name']:
-        user_data[user_id]['first_name'] = message.text.strip()
-        next_state = 'registering_driver_phone' if 'driver' in state else 'registering_passenger_phone'
-        user_states[user_id] = next_state
-        keyboard = [[KeyboardButton("📱 Telefon raqamni yuborish", request_contact=True)]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-        await message.reply_text('Telefon raqamingizni yuboring:', reply_markup=reply_markup)
-
-    elif state in ['registering_driver_phone', 'registering_passenger_phone']:
-        if message.contact:
-            phone = message.contact.phone_number
-            if not phone.startswith('+'):
-                phone = '+' + phone
-            user_data[user_id]['phone'] = phone
-        else:
-            user_data[user_id]['phone'] = message.text.strip()
-
-        if 'driver' in state:
-            user_states[user_id] = 'registering_driver_car_type'
-            await message.reply_text('Mashina turini tanlang:', reply_markup=car_type_keyboard())
-        else:
-            user_states[user_id] = 'registering_passenger_departure'
-            await message.reply_text('📍 Qayerdan joʻnamoqchisiz?\n\nMasalan: "Toshkent, Chilanzor" yoki "Samarqand shahar" deb yozing.')
-
-    elif state == 'registering_passenger_departure':
-        if message.location:
-            user_data[user_id]['departure_location'] = {
-                'latitude': message.location.latitude,
-                'longitude': message.location.longitude
-            }
-            user_data[user_id]['departure'] = f"Location: {message.location.latitude}, {message.location.longitude}"
-        elif message.text:
-            user_data[user_id]['departure'] = message.text.strip()
-        user_states[user_id] = 'registering_passenger_destination'
-        keyboard = [[KeyboardButton("📍 Borish joyini yuborish", request_location=True)]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-        await message.reply_text('📍 Borish joyingizni yuboring:', reply_markup=reply_markup)
-
-    elif state == 'registering_passenger_destination':
-        if message.location:
-            user_data[user_id]['destination_location'] = {
-                'latitude': message.location.latitude,
-                'longitude': message.location.longitude
-            }
-            user_data[user_id]['destination'] = f"Location: {message.location.latitude}, {message.location.longitude}"
-        elif message.text:
-            user_data[user_id]['destination'] = message.text.strip()
-        user_states[user_id] = 'registering_passenger_car_preference'
-        await message.reply_text('Qanday mashina afzal koʻrasiz?', reply_markup=car_preference_keyboard())
-
-    elif state == 'registering_driver_price':
-        user_data[user_id]['price'] = message.text.strip()
-        user_states[user_id] = 'registering_driver_photo'
-        await message.reply_text('🚗 Mashinangiz rasmini yuboring:')
-
-    elif state == 'registering_driver_photo':
-        if message.photo:
-            user_data[user_id]['car_photo'] = message.photo[-1].file_id
-            await complete_driver_application(update, context)
-        else:
-            await message.reply_text('Iltimos, faqat rasm yuboring!')
+    step = REGISTRATION_MESSAGE_STEPS.get(session.state)
+    if step is None:
+        # Bu qadam tugma orqali tanlanadi - so'rovni qayta ko'rsatamiz
+        await send_registration_prompt(session, message)
+        return
 
-    elif state == 'registering_passenger_time_manual':
-        user_data[user_id]['departure_time'] = message.text.strip()
-        await complete_passenger_application(update, context)
+    if await step(session, message):
+        await advance_registration(update, context, session)
 
 # ==================== YO'LOVCHI ARIZASINI YAKUNLASH ====================
 async def complete_passenger_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Yo'lovchi arizasini yakunlash"""
     try:
         # Foydalanuvchi ma'lumotlarini olish
-        if hasattr(update, 'callback_query'):
+        if getattr(update, 'callback_query', None):
             user_id = update.callback_query.from_user.id
             chat_id = update.callback_query.message.chat_id
             message_to_reply = update.callback_query.message
             is_callback = True
-        elif hasattr(update, 'message'):
+        elif getattr(update, 'message', None):
             user_id = update.effective_user.id
             chat_id = update.effective_chat.id
             message_to_reply = update.message
@@ -1176,8 +3636,9 @@ async def complete_passenger_application(update: Update, context: ContextTypes.D
         
         logger.info(f"🔍 Foydalanuvchi {user_id} uchun ariza yakunlanmoqda...")
         
-        # Foydalanuvchi ma'lumotlarini tekshirish
-        if user_id not in user_data:
+        # Ro'yxatdan o'tish holatini tekshirish
+        session = get_registration_session(user_id)
+        if session is None:
             if is_callback:
                 await message_to_reply.edit_text("❌ Xatolik! Iltimos, qaytadan /start boshlang.")
             else:
@@ -1189,7 +3650,7 @@ async def complete_passenger_application(update: Update, context: ContextTypes.D
         missing_fields = []
         
         for field in required_fields:
-            if field not in user_data[user_id]:
+            if getattr(session, field) is None:
                 missing_fields.append(field)
         
         if missing_fields:
@@ -1202,78 +3663,79 @@ async def complete_passenger_application(update: Update, context: ContextTypes.D
                 await context.bot.send_message(chat_id=chat_id, text=error_text)
             return
         
-        # Rolni o'rnatish
-        user_data[user_id]['role'] = 'passenger'
+        # Profil (ariza maydonlari user_data ga yozilmaydi)
+        user_data.setdefault(user_id, {}).update(
+            first_name=session.first_name,
+            phone=session.phone,
+            role='passenger'
+        )
         
         # Ariza ID sini yaratish
-        global application_counter
-        app_id = f"P{application_counter:04d}"
-        application_counter += 1
+        app_id = allocate_application_id("P")
+        created = datetime.now()
         
         # Ma'lumotlarni saqlash
         passenger_applications[app_id] = {
             'user_id': user_id,
-            'first_name': user_data[user_id]['first_name'],
-            'phone': user_data[user_id]['phone'],
-            'departure': user_data[user_id].get('departure'),
-            'departure_location': user_data[user_id].get('departure_location'),
-            'destination': user_data[user_id].get('destination'),
-            'destination_location': user_data[user_id].get('destination_location'),
-            'car_preference': user_data[user_id]['car_preference'],
-            'departure_time': user_data[user_id]['departure_time'],
-            'date': datetime.now().isoformat()
+            'first_name': session.first_name,
+            'phone': session.phone,
+            'departure': session.departure,
+            'departure_location': session.departure_location,
+            'destination': session.destination,
+            'destination_location': session.destination_location,
+            'departure_place': resolve_place(session.departure, session.departure_location),
+            'destination_place': resolve_place(session.destination, session.destination_location),
+            'car_preference': session.car_preference,
+            'departure_time': session.departure_time,
+            'departure_window': departure_window_field(session.departure_time, created),
+            'date': created.isoformat()
         }
+        index_passenger_application(app_id, passenger_applications[app_id])
+        stats_application_created('passenger', passenger_applications[app_id])
         
         logger.info(f"✅ Ariza #{app_id} saqlandi")
         
         # Kanalga xabar yuborish
-        departure_text = user_data[user_id].get('departure') or "Lokatsiya yuborilgan"
-        destination_text = user_data[user_id].get('destination') or "Lokatsiya yuborilgan"
+        departure_text = session.departure or "Lokatsiya yuborilgan"
+        destination_text = session.destination or "Lokatsiya yuborilgan"
         
         application_text = (
             f"🚶 YANGI YOʻLOVCHI ARIZASI #{app_id}\n\n"
-            f"Ism: {user_data[user_id]['first_name']}\n"
-            f"Telefon: {user_data[user_id]['phone']}\n"
+            f"Ism: {session.first_name}\n"
+            f"Telefon: {session.phone}\n"
             f"Joʻnash: {departure_text}\n"
             f"Borish: {destination_text}\n"
-            f"Mashina: {user_data[user_id]['car_preference']}\n"
-            f"Vaqt: {user_data[user_id]['departure_time']}\n"
+            f"Mashina: {session.car_preference}\n"
+            f"Vaqt: {session.departure_time}\n"
             f"User ID: {user_id}"
         )
         
-        try:
-            # Lokatsiyalarni yuborish
-            if user_data[user_id].get('departure_location'):
-                await context.bot.send_location(
-                    chat_id=CHANNEL_ID,
-                    latitude=user_data[user_id]['departure_location']['latitude'],
-                    longitude=user_data[user_id]['departure_location']['longitude']
-                )
-            
-            if user_data[user_id].get('destination_location'):
-                await context.bot.send_location(
-                    chat_id=CHANNEL_ID,
-                    latitude=user_data[user_id]['destination_location']['latitude'],
-                    longitude=user_data[user_id]['destination_location']['longitude']
-                )
-            
-            # Asosiy xabarni yuborish
-            await context.bot.send_message(chat_id=CHANNEL_ID, text=application_text)
-            logger.info(f"📤 Kanalga xabar yuborildi: {CHANNEL_ID}")
-            
-        except Exception as e:
-            logger.error(f"⚠️ Kanalga xabar yuborishda xato: {e}")
+        # Lokatsiyalar va asosiy xabar bitta element sifatida ketma-ket yuboriladi
+        channel_steps = []
+        for location_key in ('departure_location', 'destination_location'):
+            location = getattr(session, location_key)
+            if location:
+                channel_steps.append(outbox_step(
+                    'send_location',
+                    CHANNEL_ID,
+                    latitude=location['latitude'],
+                    longitude=location['longitude']
+                ))
+        channel_steps.append(outbox_step('send_message', CHANNEL_ID, text=application_text))
+        
+        outbound_queue.enqueue(f"passenger_app:{app_id}:channel", channel_steps)
+        logger.info(f"📤 Kanal xabari navbatga qo'yildi: {CHANNEL_ID}")
         
-        # User_states dan o'chirish
-        if user_id in user_states:
-            del user_states[user_id]
+        # Ro'yxatdan o'tish yakunlandi
+        registration_sessions.pop(user_id, None)
         
         # Ma'lumotlarni saqlash
-        save_data()
+        save_change("user_data", user_id)
+        save_change("passenger_applications", app_id)
         
         # Foydalanuvchiga to'lov xabarini yuborish
         reply_text = (
-            f"✅ Rahmat, {user_data[user_id]['first_name']}!\n"
+            f"✅ Rahmat, {session.first_name}!\n"
             f"Yangi arizangiz qabul qilindi (ID: {app_id})\n\n"
             f"🚗 *Haydovchilar ro'yxatini ko'rish uchun 5,000 so'm to'lang*\n"
             f"24 soat davomida cheksiz haydovchilarni ko'rishingiz mumkin!\n\n"
@@ -1295,244 +3757,796 @@ async def complete_passenger_application(update: Update, context: ContextTypes.D
                 parse_mode=ParseMode.MARKDOWN
             )
         
-        logger.info(f"💰 {user_id} ga to'lov menyusi yuborildi")
+        logger.info(f"💰 {user_id} ga to'lov menyusi yuborildi")
+        
+    except Exception as e:
+        logger.error(f"❌ complete_passenger_application da katta xato: {e}")
+        import traceback
+        traceback.print_exc()
+        try:
+            if getattr(update, 'callback_query', None):
+                await update.callback_query.message.reply_text("❌ Xatolik yuz berdi. Iltimos, qaytadan /start boshlang.")
+            else:
+                await update.message.reply_text("❌ Xatolik yuz berdi. Iltimos, qaytadan /start boshlang.")
+        except:
+            pass
+
+# ==================== BOSHQA FUNKSIYALAR ====================
+async def my_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Foydalanuvchining arizasini ko'rish"""
+    user_id = update.effective_user.id
+    
+    # Haydovchi arizasini tekshirish
+    app_id = driver_app_by_user.get(user_id)
+    if app_id in driver_applications:
+        app = driver_applications[app_id]
+        status_text = "⏳ Admin tasdiqlashini kutyapti"
+        if app.get('status') == 'verified':
+            status_text = "✅ Tasdiqlangan"
+        elif app.get('status') == 'rejected':
+            status_text = "❌ Rad etilgan"
+        
+        await update.message.reply_text(
+            f"🚗 *Sizning haydovchi arizangiz* ({app_id})\n\n"
+            f"👤 Ism: {app['first_name']}\n"
+            f"📞 Telefon: {app['phone']}\n"
+            f"🚘 Mashina: {app['car_type']}\n"
+            f"💰 Narx: {app['price']}\n"
+            f"🛣 Yoʻnalish: {app.get('route') or 'koʻrsatilmagan'}\n"
+            f"📅 Sana: {app['date'][:10]}\n"
+            f"📊 Status: {status_text}",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+    
+    # Yo'lovchi arizasini tekshirish (oxirgisi)
+    passenger_app_ids = passenger_apps_by_user.get(user_id)
+    
+    if passenger_app_ids:
+        app_id = passenger_app_ids[-1]
+        app = passenger_applications[app_id]
+        departure = app.get('departure') or "Lokatsiya"
+        destination = app.get('destination') or "Lokatsiya"
+        
+        await update.message.reply_text(
+            f"🚶 *Sizning yoʻlovchi arizangiz* ({app_id})\n\n"
+            f"👤 Ism: {app['first_name']}\n"
+            f"📞 Telefon: {app['phone']}\n"
+            f"📍 Joʻnash: {departure}\n"
+            f"🎯 Borish: {destination}\n"
+            f"🕐 Vaqt: {app['departure_time']}\n"
+            f"🚗 Mashina: {app['car_preference']}\n"
+            f"📅 Sana: {app['date'][:10]}",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        
+        if has_paid_recently(user_id):
+            await update.message.reply_text(
+                "✅ *Siz to'lov qilgansiz!*\n24 soat davomida haydovchilar ro'yxatini ko'rishingiz mumkin.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        else:
+            await update.message.reply_text(
+                f"💰 *Haydovchilar ro'yxatini ko'rish uchun to'lov qiling!*\nSumma: {PAYMENT_AMOUNT:,} so'm\n24 soat davomida cheksiz access",
+                reply_markup=payment_methods_keyboard(),
+                parse_mode=ParseMode.MARKDOWN
+            )
+    else:
+        await update.message.reply_text(
+            "📭 Siz hali ariza topshirmagansiz.\nAriza topshirish uchun /start ni bosing.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+async def upcoming_passengers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/yolovchilar - haydovchi yo'nalishida keyingi soatda jo'naydigan yo'lovchilar"""
+    app_id = driver_app_by_user.get(update.effective_user.id)
+    driver = driver_applications.get(app_id)
+    if driver is None or driver.get('status') != 'verified':
+        await update.message.reply_text("🚗 Bu komanda faqat tasdiqlangan haydovchilar uchun.")
+        return
+    if not (driver.get('route_from') and driver.get('route_to')):
+        await update.message.reply_text("🛣 Arizangizda yoʻnalish koʻrsatilmagan. Yoʻnalish boʻyicha yoʻlovchilarni koʻrish uchun qaytadan roʻyxatdan oʻting.")
+        return
+    
+    now = time.time()
+    origin, destination = driver['route_from'], driver['route_to']
+    found = [(origin, destination, passenger_id) for passenger_id in upcoming_passengers(origin, destination, now=now)]
+    found += [(destination, origin, passenger_id) for passenger_id in upcoming_passengers(destination, origin, now=now)]
+    if not found:
+        await update.message.reply_text(f"🕐 Keyingi soatda {origin} ⇄ {destination} yoʻnalishida joʻnaydigan yoʻlovchilar yoʻq.")
+        return
+    
+    found.sort(key=lambda item: passenger_window[item[2]][0])
+    message = f"🚶 *KEYINGI SOATDA JOʻNAYDIGAN YOʻLOVCHILAR* ({origin} ⇄ {destination})\n\n"
+    for i, (start_place, end_place, passenger_id) in enumerate(found[:DEMAND_LIST_MAX], 1):
+        passenger = passenger_applications[passenger_id]
+        message += (
+            f"{i}. *{passenger.get('first_name', 'Noma\'lum')}* - {start_place} → {end_place}\n"
+            f"   🕐 {passenger.get('departure_time', '')} ({datetime.fromtimestamp(passenger_window[passenger_id][0]).strftime('%H:%M')} dan)\n"
+            f"   📞 {passenger.get('phone', 'Yo\'q')}\n\n"
+        )
+    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+
+def render_price_list(title, app_ids):
+    """Narx bo'yicha saralangan haydovchilar matni"""
+    message = f"{title}\n\n"
+    for i, app_id in enumerate(app_ids, 1):
+        message += f"{i}. {render_driver_entry(app_id, verified_drivers[app_id])}\n"
+    message += "📞 *Haydovchi bilan bog'laning va safar haqida kelishing*"
+    return message
+
+async def _require_drivers_access(update):
+    """Haydovchilar ro'yxati faqat to'lov qilganlarga; bo'lmasa to'lov menyusi yuboriladi"""
+    user_id = update.effective_user.id
+    if user_id == ADMIN_ID or has_paid_recently(user_id):
+        return True
+    await update.message.reply_text(
+        f"🔒 Haydovchilar ro'yxatini ko'rish uchun {PAYMENT_AMOUNT:,} so'm to'lang.\n\nTo'lov usulini tanlang:",
+        reply_markup=payment_methods_keyboard()
+    )
+    return False
+
+async def cheapest_drivers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/arzon [N] - eng arzon N ta haydovchi"""
+    if not await _require_drivers_access(update):
+        return
+    
+    limit = DRIVERS_LIST_LIMIT
+    if context.args and context.args[0].isdigit():
+        limit = max(1, min(int(context.args[0]), PRICE_LIST_MAX))
+    
+    app_ids = cheapest_drivers(limit)
+    if not app_ids:
+        await update.message.reply_text("🚗 Hozircha narxi koʻrsatilgan faol haydovchilar yoʻq.")
+        return
+    
+    await update.message.reply_text(
+        render_price_list(f"💸 *ENG ARZON {len(app_ids)} TA HAYDOVCHI*", app_ids),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+async def price_range_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/narx <dan> [gacha] - narxi shu oraliqdagi haydovchilar (bitta son - shu narxgacha)"""
+    if not await _require_drivers_access(update):
+        return
+    
+    # "100 ming - 150 ming" yoki har bir argument alohida narx: "100000 150000"
+    text = ' '.join(context.args)
+    parts = text.split('-') if '-' in text else context.args
+    amounts = [amount for amount in map(parse_price, parts) if amount]
+    if not amounts:
+        await update.message.reply_text(
+            "💰 Narx oralig'ini yozing:\n/narx 100000 150000\n/narx 100 ming - 150 ming\n/narx 120000 (shu narxgacha)"
+        )
+        return
+    
+    low, high = (0, amounts[0]) if len(amounts) == 1 else sorted(amounts[:2])
+    app_ids = drivers_in_price_range(low, high, PRICE_LIST_MAX)
+    if not app_ids:
+        await update.message.reply_text(f"🚗 {low:,} - {high:,} so'm oralig'ida faol haydovchilar yoʻq.")
+        return
+    
+    await update.message.reply_text(
+        render_price_list(f"💰 *{low:,} - {high:,} SO'M ORALIG'IDAGI HAYDOVCHILAR*", app_ids),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Yordam komandasi"""
+    await update.message.reply_text(
+        "🚕 *Ride Sharing Bot - Yordam*\n\n/start - Botni ishga tushirish\n/myapp - Ariza holatini ko'rish\n/arzon - Eng arzon haydovchilar\n/narx - Narx oralig'i bo'yicha haydovchilar\n/yolovchilar - Keyingi soatdagi yo'lovchilar (haydovchilar uchun)\n/help - Yordam\n\n💰 *Xizmat narxi:* 5,000 so'm (yo'lovchidan)\n⏱️ *Access muddati:* 24 soat\n👥 *Haydovchilar:* Bepul ro'yxatdan o'tadi\n\n📞 *Admin:* @username (murojaat uchun)",
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+# ==================== ADMIN KOMANDALARI ====================
+async def admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin to'lovlar ro'yxatini ko'rish (sahifalab)"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    
+    # /payments <payment_id> - bitta to'lovni ko'rish (arxivdagilari ham)
+    if context.args:
+        found = find_payment(context.args[0])
+        if found is None:
+            entry = await run_archive_lookup(find_archived, 'payments', context.args[0])
+            found = (entry['user_id'], entry['record']) if entry else None
+        if found is None:
+            await update.message.reply_text(f"❌ To'lov topilmadi: {context.args[0]}")
+            return
+        
+        user_id_str, payment = found
+        user_info = user_data.get(int(user_id_str), {})
+        await update.message.reply_text(
+            f"💳 To'lov: {payment['id']}\n\n"
+            f"👤 {user_info.get('first_name', 'Noma\'lum')} ({user_id_str})\n"
+            f"📞 {user_info.get('phone', 'Yo\'q')}\n"
+            f"💰 {payment['amount']:,} so'm\n"
+            f"💳 {payment['method']}\n"
+            f"🕐 {payment['date'][:16]}\n"
+            f"📊 {payment['status'].upper()}"
+        )
+        return
+    
+    summary = get_stats()['payments']
+    if not any(item['count'] for item in summary.values()):
+        await update.message.reply_text("📭 To'lovlar mavjud emas")
+        return
+    
+    total_count = sum(item['count'] for item in summary.values())
+    total_amount = sum(item['amount'] for item in summary.values())
+    verified_amount = summary.get('verified', {}).get('amount', 0)
+    pending_amount = summary.get('pending', {}).get('amount', 0)
+    rejected_amount = summary.get('rejected', {}).get('amount', 0)
+    
+    # Statistika
+    text = "💰 *TO'LOVLAR RO'YXATI*\n\n"
+    text += f"📊 *STATISTIKA:*\n"
+    text += f"• Jami to'lovlar: {total_count} ta\n"
+    text += f"• Jami summa: {total_amount:,} so'm\n"
+    text += f"• ✅ Tasdiqlangan: {verified_amount:,} so'm\n"
+    text += f"• ⏳ Kutilayotgan: {pending_amount:,} so'm\n"
+    text += f"• ❌ Rad etilgan: {rejected_amount:,} so'm"
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    
+    # To'lovlar - sahifalab (eng yangilari birinchi)
+    await send_report(update.message, 'payments')
+
+# ==================== ARXIV ====================
+# Eski yo'lovchi arizalari va to'lovlar (pending bo'lmaganlari) oylik segmentlarga ko'chiriladi:
+# har bir qator {"id", "user_id", "record"}. Segmentga faqat qo'shiladi (har safar yangi gzip member),
+# so'ng yozuvlar asosiy ma'lumotlardan o'chiriladi - oraliqda uzilish bo'lsa keyingi safar qayta
+# yoziladi va o'qishda ID bo'yicha takror o'tkazib yuboriladi.
+# meta_data["archive"]: {"passengers": {oy: soni}, "payments": {oy: soni}, "last_run": vaqt} - faqat
+# /archive hisoboti uchun; segmentlar ARCHIVE_DIR dan topiladi
+ARCHIVE_KINDS = ('passengers', 'payments')
+_PAYMENT_ID_MONTH_RE = re.compile(r'_(\d{4})(\d{2})\d{8}')
+
+def archive_segment_path(kind, month):
+    return os.path.join(ARCHIVE_DIR, f"{kind}-{month}.jsonl.gz")
+
+def archive_months(kind):
+    """Diskdagi segmentlar oylari (yangilari birinchi) - meta_data dagi hisoblagichlarga bog'liq emas"""
+    prefix, suffix = f"{kind}-", ".jsonl.gz"
+    try:
+        names = os.listdir(ARCHIVE_DIR)
+    except FileNotFoundError:
+        return []
+    months = [name[len(prefix):-len(suffix)] for name in names if name.startswith(prefix) and name.endswith(suffix)]
+    return sorted(months, reverse=True)
+
+def _append_archive_segments(segments):
+    """Segmentlarga yozuvlarni qo'shish (executor da). segments: path -> [json qatorlar]"""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for path, lines in segments.items():
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as f:
+                f.write(("\n".join(lines) + "\n").encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+
+def read_archive(kind, months=None):
+    """Arxiv yozuvlarini segmentma-segment o'qish (generator - kerakligicha o'qiladi, takrorlar o'tkaziladi)"""
+    seen = set()
+    for month in months if months is not None else archive_months(kind):
+        path = archive_segment_path(kind, month)
+        if not os.path.exists(path):
+            continue
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry['id'] not in seen:
+                        seen.add(entry['id'])
+                        yield entry
+        except (EOFError, OSError) as e:
+            # Yozish paytida uzilgan oxirgi member
+            logger.warning(f"⚠️ Arxiv segmenti oxirigacha o'qilmadi ({path}): {e}")
+
+def find_archived(kind, record_id):
+    """Arxivdan yozuvni ID bo'yicha topish (to'lov ID sidan oy aniqlanadi - bitta segment o'qiladi)"""
+    months = None
+    match = _PAYMENT_ID_MONTH_RE.search(record_id) if kind == 'payments' else None
+    if match:
+        months = [f"{match.group(1)}-{match.group(2)}"]
+    for entry in read_archive(kind, months):
+        if entry['id'] == record_id:
+            return entry
+    return None
+
+def archived_for_user(user_id, limit=ARCHIVE_LIST_MAX):
+    """Foydalanuvchining arxivdagi arizalari va to'lovlari: {tur: [yozuv, ...]} (yangilari birinchi)"""
+    found = {}
+    for kind in ARCHIVE_KINDS:
+        entries = found[kind] = []
+        for entry in read_archive(kind):
+            if str(entry['user_id']) == str(user_id):
+                entries.append(entry)
+                if len(entries) >= limit:
+                    break
+    return found
+
+async def run_archive_lookup(func, *args):
+    """Arxivdan o'qish diskka murojaat qiladi - event loopni to'xtatmaslik uchun executor da"""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+def archive_candidates(cutoff):
+    """Arxivga ko'chiriladigan yozuvlar: (yo'lovchi arizalari, to'lovlar).
+    
+    Foydalanuvchining oxirgi yo'lovchi arizasi (haydovchilarni saralash va /myapp uchun) va
+    pending to'lovlar asosiy ma'lumotlarda qoladi.
+    """
+    latest = {app_ids[-1] for app_ids in passenger_apps_by_user.values()}
+    passengers = [
+        (app_id, app) for app_id, app in passenger_applications.items()
+        if app.get('date') and app['date'] < cutoff and app_id not in latest
+    ]
+    payments = [
+        (user_id_str, payment) for user_id_str, user_payments in payments_data.items() for payment in user_payments
+        if payment.get('date') and payment['date'] < cutoff and payment.get('status') != 'pending'
+    ]
+    return passengers, payments
+
+async def archive_old_records(context: ContextTypes.DEFAULT_TYPE = None):
+    """ARCHIVE_AFTER_DAYS kundan eski yozuvlarni arxivga ko'chirish (job_queue orqali, kuniga bir marta)"""
+    cutoff = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+    passengers, payments = archive_candidates(cutoff)
+    if not passengers and not payments:
+        return 0, 0
+    
+    segments = {}
+    counts = {}
+    for kind, items in (('passengers', [(app.get('user_id'), app_id, app) for app_id, app in passengers]),
+                        ('payments', [(user_id_str, payment['id'], payment) for user_id_str, payment in payments])):
+        for user_id, record_id, record in items:
+            month = record['date'][:7]
+            line = json.dumps({'id': record_id, 'user_id': user_id, 'record': record}, ensure_ascii=False)
+            segments.setdefault(archive_segment_path(kind, month), []).append(line)
+            counts.setdefault(kind, collections.Counter())[month] += 1
+    
+    try:
+        await run_archive_lookup(_append_archive_segments, segments)
+    except OSError as e:
+        STORAGE_ERRORS.inc(operation="archive")
+        logger.error(f"❌ Arxivga yozishda xato: {e}")
+        return 0, 0
+    
+    # Segmentlar diskda - endi asosiy ma'lumotlardan o'chirish
+    for app_id, app in passengers:
+        if passenger_applications.pop(app_id, None) is not None:
+            unindex_passenger_application(app_id, app)
+            save_change("passenger_applications", app_id)
+    
+    archived_payment_ids = collections.defaultdict(set)
+    for user_id_str, payment in payments:
+        archived_payment_ids[user_id_str].add(payment['id'])
+        unindex_payment(payment)
+    for user_id_str, payment_ids in archived_payment_ids.items():
+        remaining = [payment for payment in payments_data.get(user_id_str, []) if payment['id'] not in payment_ids]
+        if remaining:
+            payments_data[user_id_str] = remaining
+        else:
+            payments_data.pop(user_id_str, None)
+        save_change("payments_data", user_id_str)
+    
+    archive = meta_data.setdefault('archive', {})
+    for kind, months in counts.items():
+        totals = archive.setdefault(kind, {})
+        for month, count in months.items():
+            totals[month] = totals.get(month, 0) + count
+    archive['last_run'] = datetime.now().isoformat()
+    save_change("meta", "archive")
+    
+    logger.info(f"🗄 Arxivga ko'chirildi: {len(passengers)} ta yo'lovchi arizasi, {len(payments)} ta to'lov")
+    return len(passengers), len(payments)
+
+def _render_archived_entry(kind, entry):
+    record = entry['record']
+    if kind == 'payments':
+        return (
+            f"💳 {entry['id']} ({entry['user_id']}) - {record.get('amount', 0):,} so'm, "
+            f"{record.get('method', '')}, {record.get('status', '').upper()}, {record.get('date', '')[:16]}"
+        )
+    return (
+        f"🚶 {entry['id']} ({entry['user_id']}) - {record.get('first_name', 'Noma\'lum')}, "
+        f"{record.get('departure') or 'Lokatsiya'} → {record.get('destination') or 'Lokatsiya'}, "
+        f"{record.get('departure_time', '')}, {record.get('date', '')[:16]}"
+    )
+
+async def admin_archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Arxiv: /archive - umumiy, /archive <user_id> - foydalanuvchi tarixi, /archive <ID> - bitta yozuv,
+    /archive run - hozir arxivlash"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    
+    arg = context.args[0] if context.args else None
+    
+    if arg == 'run':
+        passengers, payments = await archive_old_records()
+        await update.message.reply_text(f"🗄 Arxivga ko'chirildi: {passengers} ta yo'lovchi arizasi, {payments} ta to'lov")
+        return
+    
+    if arg is None:
+        archive = meta_data.get('archive', {})
+        text = f"🗄 ARXIV ({ARCHIVE_AFTER_DAYS} kundan eski yozuvlar)\n\n"
+        for kind, title in (('passengers', "🚶 Yo'lovchi arizalari"), ('payments', "💳 To'lovlar")):
+            months = archive.get(kind, {})
+            text += f"{title}: {sum(months.values())} ta\n"
+            for month in archive_months(kind)[:STATS_DAILY_SHOWN]:
+                text += f"   {month}: {months.get(month, '?')} ta\n"
+        text += f"\n🕐 Oxirgi arxivlash: {archive.get('last_run', 'hali yoʻq')[:16]}\n"
+        text += f"📂 Asosiy ma'lumotlarda: {len(passenger_applications)} ta ariza, {len(payment_index)} ta to'lov\n\n"
+        text += "/archive <user_id> - foydalanuvchi tarixi\n/archive <ID> - ariza yoki to'lov\n/archive run - hozir arxivlash"
+        await update.message.reply_text(text)
+        return
+    
+    if arg.isdigit():
+        found = await run_archive_lookup(archived_for_user, arg)
+        lines = [_render_archived_entry(kind, entry) for kind in ARCHIVE_KINDS for entry in found[kind]]
+        if not lines:
+            await update.message.reply_text(f"📭 Arxivda {arg} foydalanuvchi yozuvlari yo'q")
+            return
+        await update.message.reply_text(f"🗄 {arg} - ARXIVDAGI YOZUVLAR\n\n" + "\n".join(lines))
+        return
+    
+    kind = 'passengers' if arg.upper().startswith('P') and arg[1:].isdigit() else 'payments'
+    entry = await run_archive_lookup(find_archived, kind, arg.upper() if kind == 'passengers' else arg)
+    if entry is None:
+        await update.message.reply_text(f"❌ Arxivda topilmadi: {arg}")
+        return
+    await update.message.reply_text(_render_archived_entry(kind, entry))
+
+# ==================== BROADCAST ====================
+class BroadcastManager:
+    """Fonda ishlaydigan, limitlarga rioya qiladigan va qayta ishga tushganda davom etadigan broadcast.
+    
+    Holat meta_data["broadcast"] da saqlanadi: foydalanuvchilar user_id bo'yicha tartiblanadi
+    va har bir paketdan keyin oxirgi ishlangan user_id (cursor) yoziladi.
+    """
+    
+    def __init__(self):
+        self._task = None
+    
+    @property
+    def state(self):
+        return meta_data.get("broadcast")
+    
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+    
+    def start(self, application, text):
+        meta_data["broadcast"] = {
+            'id': datetime.now().strftime('%Y%m%d%H%M%S'),
+            'text': text,
+            'status': 'running',
+            'cursor': None,
+            'total': len(user_data),
+            'sent': 0,
+            'failed': 0,
+            'blocked': 0,
+            'skipped': 0,
+            'started_at': datetime.now().isoformat()
+        }
+        save_change("meta", "broadcast")
+        self._task = asyncio.create_task(self._run(application.bot))
+    
+    def resume(self, application):
+        """Qayta ishga tushgandan keyin tugallanmagan broadcastni davom ettirish"""
+        state = self.state
+        if state and state.get('status') == 'running' and not self.is_running():
+            logger.info(f"📢 Broadcast davom ettirilmoqda: {state['id']} (cursor={state['cursor']})")
+            self._task = asyncio.create_task(self._run(application.bot))
+    
+    def suspend(self):
+        """Bot to'xtaganda: holat 'running' qoladi, keyingi ishga tushishda davom etadi"""
+        if self.is_running():
+            self._task.cancel()
+    
+    def stop(self):
+        state = self.state
+        if state and state.get('status') == 'running':
+            state['status'] = 'cancelled'
+            save_change("meta", "broadcast")
+        if self.is_running():
+            self._task.cancel()
+    
+    async def _send_one(self, bot, semaphore, user_id, text):
+        async with semaphore:
+            try:
+                await send_with_retry(
+                    bot.send_message,
+                    user_id,
+                    text=f"📢 *Admin xabari:*\n\n{text}",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                return 'sent'
+            except Forbidden:
+                mark_user_blocked(user_id)
+                return 'blocked'
+            except Exception as e:
+                logger.error(f"Xabar yuborishda xato user_id {user_id}: {e}")
+                return 'failed'
+    
+    async def _run(self, bot):
+        state = self.state
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        
+        user_ids = sorted(user_data)
+        start = 0 if state['cursor'] is None else bisect.bisect_right(user_ids, state['cursor'])
         
-    except Exception as e:
-        logger.error(f"❌ complete_passenger_application da katta xato: {e}")
-        import traceback
-        traceback.print_exc()
         try:
-            if hasattr(update, 'callback_query'):
-                await update.callback_query.message.reply_text("❌ Xatolik yuz berdi. Iltimos, qaytadan /start boshlang.")
-            else:
-                await update.message.reply_text("❌ Xatolik yuz berdi. Iltimos, qaytadan /start boshlang.")
-        except:
-            pass
-
-# ==================== BOSHQA FUNKSIYALAR ====================
-async def my_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Foydalanuvchining arizasini ko'rish"""
-    user_id = update.effective_user.id
-    
-    # Haydovchi arizasini tekshirish
-    for app_id, app in driver_applications.items():
-        if app.get('user_id') == user_id:
-            status_text = "⏳ Admin tasdiqlashini kutyapti"
-            if app.get('status') == 'verified':
-                status_text = "✅ Tasdiqlangan"
-            elif app.get('status') == 'rejected':
-                status_text = "❌ Rad etilgan"
+            for i in range(start, len(user_ids), BROADCAST_BATCH_SIZE):
+                batch = user_ids[i:i + BROADCAST_BATCH_SIZE]
+                targets = [user_id for user_id in batch if not user_data.get(user_id, {}).get('blocked')]
+                state['skipped'] += len(batch) - len(targets)
+                
+                results = await asyncio.gather(
+                    *(self._send_one(bot, semaphore, user_id, state['text']) for user_id in targets)
+                )
+                for result in results:
+                    state[result] += 1
+                
+                state['cursor'] = batch[-1]
+                save_change("meta", "broadcast")
             
-            await update.message.reply_text(
-                f"🚗 *Sizning haydovchi arizangiz* ({app_id})\n\n"
-                f"👤 Ism: {app['first_name']}\n"
-                f"📞 Telefon: {app['phone']}\n"
-                f"🚘 Mashina: {app['car_type']}\n"
-                f"💰 Narx: {app['price']}\n"
-                f"📅 Sana: {app['date'][:10]}\n"
-                f"📊 Status: {status_text}",
+            state['status'] = 'done'
+            state['finished_at'] = datetime.now().isoformat()
+            save_change("meta", "broadcast")
+            logger.info(f"📢 Broadcast tugadi: {state['id']}")
+            
+            await bot.send_message(
+                chat_id=ADMIN_ID,
+                text=f"✅ *Xabar yuborildi!*\n\n{format_broadcast_status(state)}",
                 parse_mode=ParseMode.MARKDOWN
             )
-            return
-    
-    # Yo'lovchi arizasini tekshirish
-    passenger_apps = []
-    for app_id, app in passenger_applications.items():
-        if app.get('user_id') == user_id:
-            passenger_apps.append((app_id, app))
+        except asyncio.CancelledError:
+            logger.info(f"📢 Broadcast to'xtatildi: {state['id']}")
+            raise
+        except Exception as e:
+            logger.error(f"❌ Broadcastda xato: {e}")
+
+broadcast_manager = BroadcastManager()
+
+def format_broadcast_status(state):
+    processed = state['sent'] + state['failed'] + state['blocked'] + state['skipped']
+    return (
+        f"🆔 {state['id']} ({state['status']})\n"
+        f"📊 Jarayon: {processed}/{state['total']}\n"
+        f"✅ Muvaffaqiyatli: {state['sent']}\n"
+        f"❌ Muvaffaqiyatsiz: {state['failed']}\n"
+        f"🚫 Botni bloklagan: {state['blocked']}\n"
+        f"⏭️ O'tkazib yuborilgan: {state['skipped']}"
+    )
+
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin broadcast xabar yuborish (fonda)"""
+    if update.effective_user.id != ADMIN_ID:
+        return
     
-    if passenger_apps:
-        app_id, app = passenger_apps[-1]
-        departure = app.get('departure') or "Lokatsiya"
-        destination = app.get('destination') or "Lokatsiya"
-        
+    if len(context.args) == 0:
         await update.message.reply_text(
-            f"🚶 *Sizning yoʻlovchi arizangiz* ({app_id})\n\n"
-            f"👤 Ism: {app['first_name']}\n"
-            f"📞 Telefon: {app['phone']}\n"
-            f"📍 Joʻnash: {departure}\n"
-            f"🎯 Borish: {destination}\n"
-            f"🕐 Vaqt: {app['departure_time']}\n"
-            f"🚗 Mashina: {app['car_preference']}\n"
-            f"📅 Sana: {app['date'][:10]}",
+            "📢 *Xabar yuborish*\n\nFoydalanish: /broadcast <xabar>\nMasalan: /broadcast Yangi yangilik!\n\n"
+            "/broadcast\\_status - jarayonni ko'rish\n/broadcast\\_stop - to'xtatish",
             parse_mode=ParseMode.MARKDOWN
         )
-        
-        if has_paid_recently(user_id):
-            await update.message.reply_text(
-                "✅ *Siz to'lov qilgansiz!*\n24 soat davomida haydovchilar ro'yxatini ko'rishingiz mumkin.",
-                parse_mode=ParseMode.MARKDOWN
-            )
-        else:
-            await update.message.reply_text(
-                f"💰 *Haydovchilar ro'yxatini ko'rish uchun to'lov qiling!*\nSumma: {PAYMENT_AMOUNT:,} so'm\n24 soat davomida cheksiz access",
-                reply_markup=payment_methods_keyboard(),
-                parse_mode=ParseMode.MARKDOWN
-            )
-    else:
+        return
+    
+    if broadcast_manager.is_running():
         await update.message.reply_text(
-            "📭 Siz hali ariza topshirmagansiz.\nAriza topshirish uchun /start ni bosing.",
+            f"⏳ *Oldingi broadcast hali tugamagan*\n\n{format_broadcast_status(broadcast_manager.state)}",
             parse_mode=ParseMode.MARKDOWN
         )
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Yordam komandasi"""
+        return
+    
+    message = ' '.join(context.args)
+    broadcast_manager.start(context.application, message)
+    
     await update.message.reply_text(
-        "🚕 *Ride Sharing Bot - Yordam*\n\n/start - Botni ishga tushirish\n/myapp - Ariza holatini ko'rish\n/help - Yordam\n\n💰 *Xizmat narxi:* 5,000 so'm (yo'lovchidan)\n⏱️ *Access muddati:* 24 soat\n👥 *Haydovchilar:* Bepul ro'yxatdan o'tadi\n\n📞 *Admin:* @username (murojaat uchun)",
+        f"📢 *Broadcast boshlandi!*\n\n👥 Foydalanuvchilar: {broadcast_manager.state['total']}\n"
+        f"Jarayonni /broadcast\\_status orqali kuzating.",
         parse_mode=ParseMode.MARKDOWN
     )
 
-# ==================== ADMIN KOMANDALARI ====================
-async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin statistikasini ko'rish"""
+async def admin_broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Broadcast jarayonini ko'rish"""
     if update.effective_user.id != ADMIN_ID:
         return
     
-    total_users = len(user_data)
-    total_drivers = len(driver_applications)
-    total_passengers = len(passenger_applications)
-    
-    total_payments = 0
-    verified_payments = 0
-    total_income = 0
-    
-    for user_payments in payments_data.values():
-        for payment in user_payments:
-            total_payments += 1
-            if payment.get('status') == 'verified':
-                verified_payments += 1
-                total_income += PAYMENT_AMOUNT
-    
-    stats_text = f"📊 *BOT STATISTIKASI*\n\n👥 *Umumiy foydalanuvchilar:* {total_users}\n🚗 *Haydovchilar:* {total_drivers}\n🚶 *Yo'lovchilar:* {total_passengers}\n\n💰 *TO'LOVLAR:*\n• Umumiy to'lovlar: {total_payments}\n• Tasdiqlangan: {verified_payments}\n• Daromad: {total_income:,} so'm\n\n📅 *Bugun:* {datetime.now().strftime('%d.%m.%Y')}"
+    state = broadcast_manager.state
+    if not state:
+        await update.message.reply_text("📭 Hali broadcast yuborilmagan")
+        return
     
-    await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(format_broadcast_status(state))
 
-async def admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin to'lovlar ro'yxatini ko'rish (to'liq ma'lumotlar)"""
+async def admin_broadcast_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ishlayotgan broadcastni to'xtatish"""
     if update.effective_user.id != ADMIN_ID:
         return
     
-    if not payments_data:
-        await update.message.reply_text("📭 To'lovlar mavjud emas")
+    if not broadcast_manager.is_running():
+        await update.message.reply_text("📭 Ishlayotgan broadcast yo'q")
         return
     
-    text = "💰 *TO'LOVLAR RO'YXATI*\n\n"
+    broadcast_manager.stop()
+    await update.message.reply_text(f"🛑 Broadcast to'xtatildi\n\n{format_broadcast_status(broadcast_manager.state)}")
+
+# ==================== HISOBOTLAR (SAHIFALAB) ====================
+def _status_emoji(status):
+    return "✅" if status == 'verified' else "⏳" if status == 'pending' else "❌"
+
+def _format_date(value, fmt='%d.%m.%Y %H:%M'):
+    try:
+        return datetime.fromisoformat(value).strftime(fmt)
+    except (TypeError, ValueError):
+        return (value or '')[:16]
+
+def _payment_key(payment_id):
+    found = payment_index.get(payment_id)
+    return (found[1].get('date', ''), payment_id) if found else None
+
+def _driver_key(app_id):
+    app = driver_applications.get(app_id)
+    return (app.get('date', ''), app_id) if app else None
+
+def _passenger_key(app_id):
+    app = passenger_applications.get(app_id)
+    return (app.get('date', ''), app_id) if app else None
+
+def _render_payment_item(number, payment_id, record):
+    user_id_str, payment = record
+    user_info = user_data.get(int(user_id_str), {})
+    return (
+        f"{number}. {_status_emoji(payment['status'])} *{user_info.get('first_name', 'Noma\'lum')}*\n"
+        f"   📞 {user_info.get('phone', 'Yo\'q')}\n"
+        f"   🆔 {user_id_str}\n"
+        f"   💰 {payment['amount']:,} so'm\n"
+        f"   💳 {payment['method']}\n"
+        f"   🕐 {_format_date(payment['date'])}\n"
+        f"   📊 {payment['status'].upper()}\n"
+        f"   🔗 ID: {payment['id']}\n"
+    )
+
+def _render_paid_item(number, payment_id, record):
+    user_id_str, payment = record
+    user_info = user_data.get(int(user_id_str), {})
+    return (
+        f"{number}. *{user_info.get('first_name', 'Noma\'lum')}*\n"
+        f"   📞 {user_info.get('phone', 'Yo\'q')}\n"
+        f"   👤 ID: {user_id_str}\n"
+        f"   💰 {payment['amount']:,} so'm\n"
+        f"   💳 {payment['method']}\n"
+        f"   📅 {_format_date(payment['date'], '%d.%m.%Y')}\n"
+    )
+
+def _render_driver_item(number, app_id, driver):
+    status = driver.get('status')
+    status_text = "Tasdiqlangan" if status == 'verified' else "Kutilayotgan" if status == 'pending' else "Rad etilgan"
+    
+    text = (
+        f"{number}. {_status_emoji(status)} *{driver.get('first_name', 'Noma\'lum')}* (#{app_id})\n"
+        f"   📞 {driver.get('phone', 'Yo\'q')}\n"
+        f"   👤 User ID: {driver.get('user_id', 'Noma\'lum')}\n"
+        f"   🚘 {driver.get('car_type', 'Yo\'q')}\n"
+        f"   💰 {format_price(driver, 'Yo\'q')}\n"
+        f"   📊 Status: {status_text}\n"
+    )
+    if driver.get('verified_at'):
+        text += f"   ✅ Tasdiqlangan: {_format_date(driver['verified_at'])}\n"
+    elif driver.get('rejected_at'):
+        text += f"   ❌ Rad etilgan: {_format_date(driver['rejected_at'])}\n"
+    text += f"   📅 {driver.get('date', '')[:10]}\n"
+    return text
+
+def _render_passenger_item(number, app_id, passenger):
+    departure = passenger.get('departure') or ''
+    destination = passenger.get('destination') or ''
     
-    total_amount = 0
-    verified_amount = 0
-    pending_amount = 0
-    rejected_amount = 0
+    text = (
+        f"{number}. *{passenger.get('first_name', 'Noma\'lum')}* (#{app_id})\n"
+        f"   📞 {passenger.get('phone', 'Yo\'q')}\n"
+        f"   👤 User ID: {passenger.get('user_id', 'Noma\'lum')}\n"
+    )
+    if departure:
+        text += f"   📍 {departure[:40]}{'...' if len(departure) > 40 else ''}\n"
+    if destination:
+        text += f"   🎯 {destination[:40]}{'...' if len(destination) > 40 else ''}\n"
+    text += (
+        f"   🚗 {passenger.get('car_preference', 'Yo\'q')}\n"
+        f"   🕐 {passenger.get('departure_time', 'Yo\'q')}\n"
+        f"   📅 {passenger.get('date', '')[:10]}\n"
+    )
+    return text
+
+# Hisobot nomi -> (sarlavha, yozuvni chizish funksiyasi)
+REPORTS = {
+    'payments': ("🔄 *TO'LOVLAR*", _render_payment_item),
+    'paid': ("💰 *TO'LOV QILGANLAR*", _render_paid_item),
+    'drivers': ("🚗 *HAYDOVCHILAR*", _render_driver_item),
+    'drivers_verified': ("✅ *TASDIQLANGAN HAYDOVCHILAR*", _render_driver_item),
+    'passengers': ("🚶 *YO'LOVCHILAR*", _render_passenger_item),
+}
+# Xotiradagi hisobot indekslari uchun: nom -> (kalit funksiyasi, yozuvni olish)
+REPORT_SOURCES = {
+    'payments': (_payment_key, payment_index.get),
+    'paid': (_payment_key, payment_index.get),
+    'drivers': (_driver_key, lambda app_id: driver_applications[app_id]),
+    'drivers_verified': (_driver_key, lambda app_id: driver_applications[app_id]),
+    'passengers': (_passenger_key, lambda app_id: passenger_applications[app_id]),
+}
+
+def index_report_page(name, cursor=None, direction='next', page_size=REPORT_PAGE_SIZE):
+    """Hisobot sahifasi report_indexes dan: (jami, sahifadan yangiroqlar soni, [(ID, yozuv), ...]).
     
-    all_payments = []
+    cursor - oldingi sahifaning chetidagi yozuv ID si; 'next' undan eskilarini,
+    'prev' undan yangilarini beradi. Faqat shu sahifa olinadi - O(sahifa).
+    """
+    key_fn, record_fn = REPORT_SOURCES[name]
+    index = report_indexes[name]
+    total = len(index)
     
-    # Barcha to'lovlarni yig'ish
-    for user_id_str, payments in payments_data.items():
-        for payment in payments:
-            # Foydalanuvchi ma'lumotlarini olish
-            user_name = "Noma'lum"
-            user_phone = "Yo'q"
-            
-            user_id_int = int(user_id_str)
-            if user_id_int in user_data:
-                user_name = user_data[user_id_int].get('first_name', 'Noma\'lum')
-                user_phone = user_data[user_id_int].get('phone', 'Yo\'q')
-            
-            payment['user_name'] = user_name
-            payment['user_phone'] = user_phone
-            payment['user_id'] = user_id_int
-            
-            all_payments.append(payment)
-            
-            # Statistika
-            total_amount += payment['amount']
-            if payment['status'] == 'verified':
-                verified_amount += payment['amount']
-            elif payment['status'] == 'pending':
-                pending_amount += payment['amount']
-            elif payment['status'] == 'rejected':
-                rejected_amount += payment['amount']
+    key = key_fn(cursor) if cursor else None
+    if key is None:
+        end = total
+    elif direction == 'prev':
+        end = min(total, bisect.bisect_right(index, key) + page_size)
+    else:
+        end = bisect.bisect_left(index, key)
+    start = max(0, end - page_size)
     
-    # Statistika
-    text += f"📊 *STATISTIKA:*\n"
-    text += f"• Jami to'lovlar: {len(all_payments)} ta\n"
-    text += f"• Jami summa: {total_amount:,} so'm\n"
-    text += f"• ✅ Tasdiqlangan: {verified_amount:,} so'm\n"
-    text += f"• ⏳ Kutilayotgan: {pending_amount:,} so'm\n"
-    text += f"• ❌ Rad etilgan: {rejected_amount:,} so'm\n\n"
+    items = [(index[i][1], record_fn(index[i][1])) for i in range(end - 1, start - 1, -1)]
+    return total, total - end, items
+
+def report_page(name, cursor=None, direction='next', page_size=REPORT_PAGE_SIZE):
+    """Hisobotning bitta sahifasi: (matn, klaviatura). Eng yangi yozuvlar birinchi.
     
-    # Oxirgi 10 ta to'lov
-    text += "🔄 *OXIRGI TO'LOVLAR:*\n\n"
+    Sahifa saqlash backendidan olinadi (SQLite da indekslangan so'rov, JSON da xotiradagi indeks).
+    """
+    title, render_item = REPORTS[name]
+    total, newer, items = storage.report_page(name, cursor, direction, page_size)
     
-    # Vaqt bo'yicha tartiblash (eng yangilari birinchi)
-    all_payments.sort(key=lambda x: x['date'], reverse=True)
+    if not total:
+        return f"{title}\n\n📭 Ma'lumot yo'q", None
     
-    for i, payment in enumerate(all_payments[:15], 1):
-        status_emoji = "✅" if payment['status'] == 'verified' else "⏳" if payment['status'] == 'pending' else "❌"
-        
-        text += f"{i}. {status_emoji} *{payment['user_name']}*admin_paymentsCo\n"
-        text += f"   📞 {payment['user_phone']}\n"
-        text += f"   🆔 {payment['user_id']}\n"
-        text += f"   💰 {payment['amount']:,} so'm\n"
-        text += f"   💳 {payment['method']}\n"
-        
-        # Vaqtni formatlash
-        try:
-            payment_time = datetime.fromisoformat(payment['date']).strftime('%d.%m.%Y %H:%M')
-            text += f"   🕐 {payment_time}\n"
-        except:
-            text += f"   📅 {payment['date'][:16]}\n"
-        
-        text += f"   📊 {payment['status'].upper()}\n"
-        text += f"   🔗 ID: {payment['id']}\n"
-        text += "   " + "─" * 20 + "\n"
+    lines = [f"{title} ({newer + 1}-{newer + len(items)} / {total})\n"]
+    for number, (item_id, record) in enumerate(items, newer + 1):
+        lines.append(render_item(number, item_id, record))
     
-    if len(all_payments) > 15:
-        text += f"\n... va yana {len(all_payments) - 15} ta to'lov\n"
+    buttons = []
+    if newer > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Yangiroq", callback_data=encode_callback('page', name, 'prev', items[0][0])))
+    if newer + len(items) < total:
+        buttons.append(InlineKeyboardButton("Eskiroq ➡️", callback_data=encode_callback('page', name, 'next', items[-1][0])))
     
-    # Xabar uzunligini tekshirish
-    if len(text) > 4000:
-        await update.message.reply_text(text[:4000], parse_mode=ParseMode.MARKDOWN)
-        if len(text) > 4000:
-            await update.message.reply_text(text[4000:], parse_mode=ParseMode.MARKDOWN)
-    else:
-        await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
 
-async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin broadcast xabar yuborish"""
-    if update.effective_user.id != ADMIN_ID:
+async def send_report(message, name):
+    """Hisobotning birinchi sahifasini yuborish"""
+    text, reply_markup = report_page(name)
+    await message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+
+async def report_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, data):
+    """Hisobot sahifalari orasida yurish (inline tugmalar)"""
+    query = update.callback_query
+    if query.from_user.id != ADMIN_ID:
         return
     
-    if len(context.args) == 0:
-        await update.message.reply_text(
-            "📢 *Xabar yuborish*\n\nFoydalanish: /broadcast <xabar>\nMasalan: /broadcast Yangi yangilik!",
-            parse_mode=ParseMode.MARKDOWN
-        )
+    if data.report not in REPORTS:
+        logger.warning(f"⚠️ Noto'g'ri sahifa callback: {query.data}")
         return
     
-    message = ' '.join(context.args)
-    success = 0
-    failed = 0
-    
-    for user_id in user_data.keys():
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,  # user_id allaqachon int
-                text=f"📢 *Admin xabari:*\n\n{message}",
-                parse_mode=ParseMode.MARKDOWN
-            )
-            success += 1
-        except Exception as e:
-            logger.error(f"Xabar yuborishda xato user_id {user_id}: {e}")
-            failed += 1
-    
-    await update.message.reply_text(
-        f"✅ *Xabar yuborildi!*\n\n✅ Muvaffaqiyatli: {success}\n❌ Muvaffaqiyatsiz: {failed}",
-        parse_mode=ParseMode.MARKDOWN
-    )
+    text, reply_markup = report_page(data.report, data.cursor, data.direction)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    except BadRequest as e:
+        # "Message is not modified" - sahifa o'zgarmagan
+        logger.warning(f"⚠️ Sahifani yangilab bo'lmadi: {e}")
 
 # ==================== ADMIN KOMANDALARI ====================
 async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin foydalanuvchilar ro'yxatini ko'rish (to'liq ma'lumotlar)"""
+    """Admin foydalanuvchilar ro'yxatini ko'rish (sahifalab)"""
     if update.effective_user.id != ADMIN_ID:
         return
     
@@ -1545,67 +4559,26 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # 1. HAYDOVCHILAR
     if driver_applications:
-        verified_count = len([d for d in driver_applications.values() if d.get('status') == 'verified'])
-        pending_count = len([d for d in driver_applications.values() if d.get('status') == 'pending'])
-        rejected_count = len([d for d in driver_applications.values() if d.get('status') == 'rejected'])
-        
+        driver_counts = get_stats()['drivers']
         text += f"🚗 *HAYDOVCHILAR: {len(driver_applications)} ta*\n"
-        text += f"   ✅ Tasdiqlangan: {verified_count} ta\n"
-        text += f"   ⏳ Kutilayotgan: {pending_count} ta\n"
-        text += f"   ❌ Rad etilgan: {rejected_count} ta\n\n"
-        
-        # Tasdiqlangan haydovchilar
-        if verified_count > 0:
-            text += "   *Tasdiqlangan haydovchilar:*\n"
-            verified_drivers = [d for d in driver_applications.values() if d.get('status') == 'verified']
-            for i, driver in enumerate(verified_drivers[:10], 1):
-                text += f"   {i}. {driver.get('first_name', 'Noma\'lum')}\n"
-                text += f"      📞 {driver.get('phone', 'Yo\'q')}\n"
-                text += f"      🚘 {driver.get('car_type', 'Yo\'q')}\n"
-                text += f"      💰 {driver.get('price', 'Yo\'q')}\n"
-                text += "      ──────────\n"
-        
-        text += "\n"
+        text += f"   ✅ Tasdiqlangan: {driver_counts.get('verified', 0)} ta\n"
+        text += f"   ⏳ Kutilayotgan: {driver_counts.get('pending', 0)} ta\n"
+        text += f"   ❌ Rad etilgan: {driver_counts.get('rejected', 0)} ta\n\n"
     
     # 2. YO'LOVCHILAR
     if passenger_applications:
         text += f"🚶 *YO'LOVCHILAR: {len(passenger_applications)} ta*\n\n"
-        
-        for i, (app_id, passenger) in enumerate(list(passenger_applications.items())[:10], 1):
-            text += f"{i}. {passenger.get('first_name', 'Noma\'lum')}\n"
-            text += f"   📞 {passenger.get('phone', 'Yo\'q')}\n"
-            
-            departure = passenger.get('departure', '')
-            destination = passenger.get('destination', '')
-            
-            if departure and len(departure) > 30:
-                departure = departure[:27] + "..."
-            if destination and len(destination) > 30:
-                destination = destination[:27] + "..."
-            
-            text += f"   📍 {departure or 'Yo\'q'}\n"
-            text += f"   🎯 {destination or 'Yo\'q'}\n"
-            text += f"   🚗 {passenger.get('car_preference', 'Yo\'q')}\n"
-            text += f"   🕐 {passenger.get('departure_time', 'Yo\'q')}\n"
-            text += f"   📅 {passenger.get('date', '')[:10]}\n"
-            text += "   ──────────\n"
-        
-        if len(passenger_applications) > 10:
-            text += f"\n... va yana {len(passenger_applications) - 10} ta yo'lovchi\n"
     
     # 3. RO'YXATDAN O'TGANLAR
     if user_data:
-        drivers_in_user_data = len([u for u in user_data.values() if u.get('role') == 'driver'])
-        passengers_in_user_data = len([u for u in user_data.values() if u.get('role') == 'passenger'])
-        
-        text += f"\n📋 *RO'YXATDAN O'TGANLAR: {len(user_data)} ta*\n"
-        text += f"   🚗 Haydovchi: {drivers_in_user_data} ta\n"
-        text += f"   🚶 Yo'lovchi: {passengers_in_user_data} ta\n"
+        role_counts = storage.role_counts()
+        text += f"📋 *RO'YXATDAN O'TGANLAR: {len(user_data)} ta*\n"
+        text += f"   🚗 Haydovchi: {role_counts.get('driver', 0)} ta\n"
+        text += f"   🚶 Yo'lovchi: {role_counts.get('passenger', 0)} ta\n"
         
         # Oxirgi 5 ta ro'yxatdan o'tgan
         text += "\n   *Oxirgi ro'yxatdan o'tganlar:*\n"
-        recent_users = list(user_data.items())[-5:]
-        for user_id_str, user_info in recent_users:
+        for user_id_str, user_info in storage.recent_users(5):
             role = "🚗" if user_info.get('role') == 'driver' else "🚶"
             text += f"   {role} {user_info.get('first_name', 'Noma\'lum')}\n"
             text += f"      📞 {user_info.get('phone', 'Yo\'q')}\n"
@@ -1613,200 +4586,359 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text += f"      🚘 {user_info.get('car_type', 'Yo\'q')}\n"
             text += "      ─\n"
     
-    # Xabar uzunligini tekshirish
-    if len(text) > 4000:
-        # Ikki qismga bo'lish
-        await update.message.reply_text(text[:4000], parse_mode=ParseMode.MARKDOWN)
-        await update.message.reply_text(text[4000:8000] if len(text) > 8000 else text[4000:], 
-                                       parse_mode=ParseMode.MARKDOWN)
-    else:
-        await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    
+    # Ro'yxatlar - har biri alohida xabar, sahifalab
+    if verified_drivers:
+        await send_report(update.message, 'drivers_verified')
+    if passenger_applications:
+        await send_report(update.message, 'passengers')
 
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin statistikasini ko'rish"""
+    """Admin statistikasini ko'rish (hisoblagichlardan, O(1))"""
     if update.effective_user.id != ADMIN_ID:
         return
     
-    total_users = len(user_data)
-    total_drivers = len(driver_applications)
-    total_passengers = len(passenger_applications)
-    
-    # Haydovchi statistikasi
-    verified_drivers = len([d for d in driver_applications.values() if d.get('status') == 'verified'])
-    pending_drivers = len([d for d in driver_applications.values() if d.get('status') == 'pending'])
-    rejected_drivers = len([d for d in driver_applications.values() if d.get('status') == 'rejected'])
-    
-    # To'lov statistikasi
-    total_payments = 0
-    verified_payments = 0
-    pending_payments = 0
-    total_income = 0
-    
-    for user_payments in payments_data.values():
-        for payment in user_payments:
-            total_payments += 1
-            if payment.get('status') == 'verified':
-                verified_payments += 1
-                total_income += PAYMENT_AMOUNT
-            elif payment.get('status') == 'pending':
-                pending_payments += 1
+    stats = get_stats()
+    drivers = stats['drivers']
+    payments = stats['payments']
     
     stats_text = (
         f"📊 *BOT STATISTIKASI*\n\n"
-        f"👥 *Umumiy foydalanuvchilar:* {total_users}\n"
-        f"🚗 *Haydovchilar:* {total_drivers}\n"
-        f"   ├ ✅ Tasdiqlangan: {verified_drivers}\n"
-        f"   ├ ⏳ Kutilayotgan: {pending_drivers}\n"
-        f"   └ ❌ Rad etilgan: {rejected_drivers}\n"
-        f"🚶 *Yo'lovchilar:* {total_passengers}\n\n"
+        f"👥 *Umumiy foydalanuvchilar:* {len(user_data)}\n"
+        f"🚗 *Haydovchilar:* {sum(drivers.values())}\n"
+        f"   ├ ✅ Tasdiqlangan: {drivers.get('verified', 0)}\n"
+        f"   ├ ⏳ Kutilayotgan: {drivers.get('pending', 0)}\n"
+        f"   └ ❌ Rad etilgan: {drivers.get('rejected', 0)}\n"
+        f"🚶 *Yo'lovchilar:* {stats['passengers']}\n\n"
         f"💰 *TO'LOVLAR:*\n"
-        f"• Umumiy to'lovlar: {total_payments}\n"
-        f"• ✅ Tasdiqlangan: {verified_payments}\n"
-        f"• ⏳ Kutilayotgan: {pending_payments}\n"
-        f"• 💰 Daromad: {total_income:,} so'm\n\n"
-        f"📅 *Bugun:* {datetime.now().strftime('%d.%m.%Y %H:%M')}\n"
-        f"📈 *Bot ishga tushgan:* {datetime.now().strftime('%d.%m.%Y')}"
+        f"• Umumiy to'lovlar: {sum(item['count'] for item in payments.values())}\n"
+        f"• ✅ Tasdiqlangan: {payments.get('verified', {}).get('count', 0)}\n"
+        f"• ⏳ Kutilayotgan: {payments.get('pending', {}).get('count', 0)}\n"
+        f"• 💰 Daromad: {payments.get('verified', {}).get('amount', 0):,} so'm\n\n"
     )
     
+    # Kunlik ko'rsatkichlar (oxirgi kunlar)
+    days = stats_days()[-STATS_DAILY_SHOWN:]
+    if days:
+        stats_text += "📈 *KUNLIK:* (🚗 haydovchi, 🚶 yo'lovchi, 💳 to'lov, ✅ tasdiqlangan)\n"
+        for day in reversed(days):
+            bucket = meta_data[STATS_DAY_PREFIX + day]
+            stats_text += (
+                f"`{day[8:10]}.{day[5:7]}` 🚗{bucket['drivers']} 🚶{bucket['passengers']} "
+                f"💳{bucket['payments']} ✅{bucket['verified_payments']} 💰{bucket['revenue']:,}\n"
+            )
+        stats_text += "\n"
+    
+    stats_text += f"📅 *Bugun:* {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+    
     await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
 
 async def admin_detailed_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Batafsil foydalanuvchilar ro'yxati (yangi versiya)"""
+    """Batafsil foydalanuvchilar ro'yxati (sahifalab)"""
     if update.effective_user.id != ADMIN_ID:
         return
     
+    if not driver_applications and not passenger_applications and not payments_data:
+        await update.message.reply_text("📭 Hozircha hech qanday ma'lumot mavjud emas")
+        return
+    
     text = "📋 *BARCHA MA'LUMOTLAR - Batafsil*\n\n"
     
-    # 1. HAYDOVCHILAR (Batafsil)
+    # 1. HAYDOVCHILAR
     if driver_applications:
-        verified_count = len([d for d in driver_applications.values() if d.get('status') == 'verified'])
-        pending_count = len([d for d in driver_applications.values() if d.get('status') == 'pending'])
-        rejected_count = len([d for d in driver_applications.values() if d.get('status') == 'rejected'])
-        
+        driver_counts = get_stats()['drivers']
         text += f"🚗 *HAYDOVCHILAR: {len(driver_applications)} ta*\n"
-        text += f"   ✅ Tasdiqlangan: {verified_count} ta\n"
-        text += f"   ⏳ Kutilayotgan: {pending_count} ta\n"
-        text += f"   ❌ Rad etilgan: {rejected_count} ta\n\n"
-        
-        for app_id, driver in list(driver_applications.items())[:15]:
-            status_emoji = "✅" if driver.get('status') == 'verified' else "⏳" if driver.get('status') == 'pending' else "❌"
-            status_text = "Tasdiqlangan" if driver.get('status') == 'verified' else "Kutilayotgan" if driver.get('status') == 'pending' else "Rad etilgan"
-            
-            text += f"{status_emoji} *{driver.get('first_name', 'Noma\'lum')}* (#{app_id})\n"
-            text += f"   📞 {driver.get('phone', 'Yo\'q')}\n"
-            text += f"   👤 User ID: {driver.get('user_id', 'Noma\'lum')}\n"
-            text += f"   🚘 {driver.get('car_type', 'Yo\'q')}\n"
-            text += f"   💰 {driver.get('price', 'Yo\'q')}\n"
-            text += f"   📊 Status: {status_text}\n"
-            
-            if driver.get('verified_at'):
-                verified_time = datetime.fromisoformat(driver['verified_at']).strftime('%d.%m.%Y %H:%M')
-                text += f"   ✅ Tasdiqlangan: {verified_time}\n"
-            elif driver.get('rejected_at'):
-                rejected_time = datetime.fromisoformat(driver['rejected_at']).strftime('%d.%m.%Y %H:%M')
-                text += f"   ❌ Rad etilgan: {rejected_time}\n"
-            
-            text += f"   📅 {driver.get('date', '')[:10]}\n"
-            text += "   " + "─" * 20 + "\n"
-        
-        if len(driver_applications) > 15:
-            text += f"\n... va yana {len(driver_applications) - 15} ta haydovchi\n"
-        
-        text += "\n"
+        text += f"   ✅ Tasdiqlangan: {driver_counts.get('verified', 0)} ta\n"
+        text += f"   ⏳ Kutilayotgan: {driver_counts.get('pending', 0)} ta\n"
+        text += f"   ❌ Rad etilgan: {driver_counts.get('rejected', 0)} ta\n\n"
     
-    # 2. YO'LOVCHILAR (Batafsil)
+    # 2. YO'LOVCHILAR
     if passenger_applications:
         text += f"🚶 *YO'LOVCHILAR: {len(passenger_applications)} ta*\n\n"
-        
-        for app_id, passenger in list(passenger_applications.items())[:15]:
-            text += f"*{passenger.get('first_name', 'Noma\'lum')}* (#{app_id})\n"
-            text += f"   📞 {passenger.get('phone', 'Yo\'q')}\n"
-            text += f"   👤 User ID: {passenger.get('user_id', 'Noma\'lum')}\n"
-            
-            departure = passenger.get('departure', '')
-            destination = passenger.get('destination', '')
-            
-            if departure:
-                text += f"   📍 {departure[:40]}{'...' if len(departure) > 40 else ''}\n"
-            if destination:
-                text += f"   🎯 {destination[:40]}{'...' if len(destination) > 40 else ''}\n"
-            
-            text += f"   🚗 {passenger.get('car_preference', 'Yo\'q')}\n"
-            text += f"   🕐 {passenger.get('departure_time', 'Yo\'q')}\n"
-            text += f"   📅 {passenger.get('date', '')[:10]}\n"
-            text += "   " + "─" * 20 + "\n"
-        
-        if len(passenger_applications) > 15:
-            text += f"\n... va yana {len(passenger_applications) - 15} ta yo'lovchi\n"
     
     # 3. TO'LOV QILGANLAR
-    if payments_data:
-        paid_users = []
-        total_payments = 0
-        
-        for user_id_str, payments in payments_data.items():
-            for payment in payments:
-                if payment.get('status') == 'verified':
-                    total_payments += 1
-                    
-                    # Foydalanuvchi ma'lumotlarini olish
-                    user_name = "Noma'lum"
-                    user_phone = "Yo'q"
-                    
-                    user_id_int = int(user_id_str)
-                    if user_id_int in user_data:
-                        user_name = user_data[user_id_int].get('first_name', 'Noma\'lum')
-                        user_phone = user_data[user_id_int].get('phone', 'Yo\'q')
-                    
-                    paid_users.append({
-                        'name': user_name,
-                        'phone': user_phone,
-                        'user_id': user_id_int,
-                        'amount': payment['amount'],
-                        'date': payment['date'],
-                        'method': payment['method']
-                    })
-        
-        if paid_users:
-            text += f"\n💰 *TO'LOV QILGANLAR: {len(paid_users)} ta foydalanuvchi*\n"
-            text += f"   Jami to'lovlar: {total_payments} ta\n"
-            text += f"   Jami summa: {sum([p['amount'] for p in paid_users]):,} so'm\n\n"
-            
-            for i, payment in enumerate(paid_users[:10], 1):
-                text += f"{i}. *{payment['name']}*\n"
-                text += f"   📞 {payment['phone']}\n"
-                text += f"   👤 ID: {payment['user_id']}\n"
-                text += f"   💰 {payment['amount']:,} so'm\n"
-                text += f"   💳 {payment['method']}\n"
+    verified_summary = get_stats()['payments'].get('verified', {'count': 0, 'amount': 0})
+    if verified_summary['count']:
+        text += f"💰 *TO'LOV QILGANLAR:*\n"
+        text += f"   Jami to'lovlar: {verified_summary['count']} ta\n"
+        text += f"   Jami summa: {verified_summary['amount']:,} so'm\n"
+    
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    
+    # Batafsil ro'yxatlar - sahifalab
+    if driver_applications:
+        await send_report(update.message, 'drivers')
+    if passenger_applications:
+        await send_report(update.message, 'passengers')
+    if verified_summary['count']:
+        await send_report(update.message, 'paid')
+
+# ==================== CALLBACK MARSHRUTLARI ====================
+# callback prefiksi -> handler(update, context, data); data - decode_callback() qaytargan namedtuple
+CALLBACK_HANDLERS = {
+    'role': registration_start_callback,
+    'car': registration_callback,
+    'pref': registration_callback,
+    'time': registration_callback,
+    'drivers': show_drivers_callback,
+    'pay': payment_method_callback,
+    'payment': admin_payment_action,
+    'driver': admin_driver_action,
+    'page': report_page_callback,
+}
+assert CALLBACK_HANDLERS.keys() == CALLBACK_SCHEMAS.keys()
+
+# Admin amallari shu yozuv qulfi ostida bajariladi: prefiks -> data dan (tur, kalit)
+CALLBACK_LOCKS = {
+    'payment': lambda data: ('payment', data.payment_id),
+    'driver': lambda data: ('driver', data.app_id),
+}
+
+# ==================== WEBHOOK SERVER ====================
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+class WebServer:
+    """Bot bilan bitta event loop da ishlaydigan minimal HTTP/1.1 server.
+    
+    Handler: async (path, headers, body) -> (status, content_type, body_bytes)
+    """
+    
+    def __init__(self, fallback=None):
+        self.routes = {}
+        self.fallback = fallback
+        self._server = None
+    
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+    
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"🌐 HTTP server port {port} da ishga tushdi")
+    
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+    
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), timeout=60)
+                if not request_line:
+                    break
                 
-                try:
-                    payment_time = datetime.fromisoformat(payment['date']).strftime('%d.%m.%Y')
-                    text += f"   📅 {payment_time}\n"
-                except:
-                    text += f"   📅 {payment['date'][:10]}\n"
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
                 
-                text += "   " + "─" * 15 + "\n"
-            
-            if len(paid_users) > 10:
-                text += f"\n... va yana {len(paid_users) - 10} ta to'lov qilgan foydalanuvchi\n"
+                length = int(headers.get("content-length", 0))
+                if length > WEBHOOK_MAX_BODY:
+                    await self._respond(writer, 413, "text/plain", b"Payload too large", close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                
+                path = target.split("?", 1)[0]
+                handler = self.routes.get((method, path)) or self.fallback
+                if handler is None:
+                    status, content_type, payload = 404, "text/plain", b"Not found"
+                else:
+                    status, content_type, payload = await handler(path, headers, body)
+                
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, content_type, payload, close)
+                if close:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except Exception as e:
+            logger.error(f"❌ HTTP so'rovni qayta ishlashda xato: {e}")
+        finally:
+            writer.close()
     
-    if not driver_applications and not passenger_applications and not payments_data:
-        await update.message.reply_text("📭 Hozircha hech qanday ma'lumot mavjud emas")
-        return
+    @staticmethod
+    async def _respond(writer, status, content_type, payload, close=False):
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
+
+def _json_response(data, status=200):
+    return status, "application/json", json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+def create_web_server(application):
+    """Webhook + bosh sahifa + health endpointlari"""
+    server = WebServer()
     
-    # Xabar uzunligini tekshirish
-    if len(text) > 4000:
-        parts = [text[i:i+4000] for i in range(0, len(text), 4000)]
-        for i, part in enumerate(parts, 1):
-            if i == 1:
-                await update.message.reply_text(part, parse_mode=ParseMode.MARKDOWN)
-            else:
-                await update.message.reply_text(f"*(davomi {i}/{len(parts)})*\n" + part, parse_mode=ParseMode.MARKDOWN)
-    else:
-        await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    async def home_route(path, headers, body):
+        return 200, "text/html; charset=utf-8", home().encode("utf-8")
+    
+    async def health_route(path, headers, body):
+        return _json_response(*health_status())
+    
+    async def metrics_route(path, headers, body):
+        return 200, "text/plain; version=0.0.4", render_metrics().encode("utf-8")
+    
+    async def webhook_route(path, headers, body):
+        if WEBHOOK_SECRET and headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return 403, "text/plain", b"Forbidden"
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except Exception as e:
+            logger.warning(f"⚠️ Noto'g'ri webhook so'rovi: {e}")
+            return 400, "text/plain", b"Bad request"
+        
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"OK"
+    
+    server.route("GET", "/", home_route)
+    server.route("GET", "/health", health_route)
+    server.route("GET", "/metrics", metrics_route)
+    server.route("POST", WEBHOOK_PATH, webhook_route)
+    return server
+
+async def run_webhook(application):
+    """Webhook rejimi: updatelar va HTTP endpointlar bitta event loop da"""
+    port = int(os.environ.get("PORT", 8000))
+    server = create_web_server(application)
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    try:
+        await server.start("0.0.0.0", port)
+        
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
+            logger.info(f"🔗 Webhook o'rnatildi: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("⚠️ WEBHOOK_URL berilmagan - webhook Telegramda o'rnatilmadi")
+        
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
+# ==================== LOKAL SINOV (STAND-IN) ====================
+async def _http_post(url, payload, headers=None):
+    """Oddiy HTTP POST (JSON). (status, body) qaytaradi"""
+    parsed = urllib.parse.urlsplit(url)
+    reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port or 80)
+    body = json.dumps(payload).encode("utf-8")
+    extra = "".join(f"{k}: {v}\r\n" for k, v in (headers or {}).items())
+    writer.write(
+        f"POST {parsed.path or '/'} HTTP/1.1\r\nHost: {parsed.netloc}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: close\r\n{extra}\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status = int(response.split(b" ", 2)[1])
+    return status, response.split(b"\r\n\r\n", 1)[-1]
+
+async def run_stand_in(webhook_url, port=8081, count=3):
+    """Telegram o'rniga lokal server: Bot API chaqiruvlariga soxta javob beradi va
+    webhookga soxta updatelar yuboradi.
+    
+    Bot quyidagicha ishga tushiriladi:
+        BOT_MODE=webhook TELEGRAM_API_BASE=http://127.0.0.1:8081/bot python telegram_bot.py
+    Keyin:
+        python telegram_bot.py stand-in http://127.0.0.1:8000/telegram 3
+    """
+    async def api_route(path, headers, body):
+        api_method = path.rsplit("/", 1)[-1]
+        if headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            params = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode("utf-8")).items()}
+        else:
+            params = {}
+        logger.info(f"🧪 Stand-in API: {api_method} {params}")
+        
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stand-in", "username": "stand_in_bot"}
+        elif api_method in ("setWebhook", "deleteWebhook", "answerCallbackQuery"):
+            result = True
+        else:
+            chat_id = params.get("chat_id", 0)
+            result = {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+                "text": params.get("text", "")
+            }
+        return _json_response({"ok": True, "result": result})
+    
+    server = WebServer(fallback=api_route)
+    await server.start("127.0.0.1", port)
+    
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    for i in range(1, count + 1):
+        update = {
+            "update_id": int(time.time()) * 1000 + i,
+            "message": {
+                "message_id": i,
+                "date": int(time.time()),
+                "chat": {"id": 100000 + i, "type": "private"},
+                "from": {"id": 100000 + i, "is_bot": False, "first_name": f"Test{i}"},
+                "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+            }
+        }
+        for _ in range(30):
+            try:
+                status, _ = await _http_post(webhook_url, update, headers)
+                break
+            except OSError:
+                # Bot hali ishga tushmagan - biroz kutamiz
+                await asyncio.sleep(1)
+        else:
+            logger.error(f"❌ Webhookga ulanib bo'lmadi: {webhook_url}")
+            break
+        logger.info(f"🧪 Soxta update #{i} yuborildi: HTTP {status}")
+    
+    logger.info("🧪 Stand-in server ishlayapti (to'xtatish: Ctrl+C)")
+    await asyncio.Event().wait()
 
 # ==================== BOTNI ISHGA TUSHIRISH ====================
-# ==================== BOTNI ISHGA TUSHIRISH ====================
+
+async def on_startup(application: Application):
+    """Bot ishga tushgandan keyin fon vazifalarini tiklash"""
+    global bot_started_at
+    outbound_queue.start(application)
+    broadcast_manager.resume(application)
+    bot_started_at = time.time()
+
+async def on_shutdown(application: Application):
+    """Bot to'xtashidan oldin fon vazifalarini to'xtatish"""
+    global bot_started_at
+    bot_started_at = None
+    broadcast_manager.suspend()
+    await outbound_queue.stop()
+    await snapshot_scheduler.flush()
 
 def run_telegram_bot():
     """Telegram botni ishga tushiradi"""
@@ -1817,46 +4949,73 @@ def run_telegram_bot():
     logger.info("=" * 50)
     
     try:
-        app = ApplicationBuilder() \
+        # Timeoutlar so'rov klientida; klient har bir API so'rovini metrikalarga yozadi
+        builder = ApplicationBuilder() \
             .token(BOT_TOKEN) \
-            .connect_timeout(30) \
-            .read_timeout(30) \
-            .write_timeout(30) \
-            .pool_timeout(30) \
-            .get_updates_connect_timeout(30) \
-            .get_updates_read_timeout(30) \
-            .get_updates_write_timeout(30) \
-            .get_updates_pool_timeout(30) \
-            .build()
+            .request(InstrumentedRequest(connect_timeout=30, read_timeout=30, write_timeout=30, pool_timeout=30)) \
+            .get_updates_request(InstrumentedRequest(connection_pool_size=1, connect_timeout=30, read_timeout=30, write_timeout=30, pool_timeout=30)) \
+            .concurrent_updates(CONCURRENT_UPDATES) \
+            .post_init(on_startup) \
+            .post_shutdown(on_shutdown)
+        
+        if TELEGRAM_API_BASE:
+            # Lokal sinov: so'rovlar stand-in serverga yuboriladi
+            builder = builder.base_url(TELEGRAM_API_BASE)
+        
+        app = builder.build()
         
         # Error handler
        
         
+        # Barcha handlerlar o'lchanadi (/metrics) va bitta foydalanuvchi updatelari navbat bilan ishlanadi
+        def wrap(handler):
+            # Lock tashqarida: davomiylik metrikasi lock kutishini emas, handler vaqtini o'lchaydi
+            return serialized(instrumented(handler))
+        
         # Command handlerlar
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("myapp", my_application))
-        app.add_handler(CommandHandler("help", help_command))
+        app.add_handler(CommandHandler("start", wrap(start)))
+        app.add_handler(CommandHandler("myapp", wrap(my_application)))
+        app.add_handler(CommandHandler("help", wrap(help_command)))
+        app.add_handler(CommandHandler("arzon", wrap(cheapest_drivers_command)))
+        app.add_handler(CommandHandler("narx", wrap(price_range_command)))
+        app.add_handler(CommandHandler("yolovchilar", wrap(upcoming_passengers_command)))
         
         # Admin commandlar
-        app.add_handler(CommandHandler("stats", admin_stats))
-        app.add_handler(CommandHandler("payments", admin_payments))
-        app.add_handler(CommandHandler("broadcast", admin_broadcast))
-        app.add_handler(CommandHandler("users", admin_users))
-        app.add_handler(CommandHandler("allusers", admin_detailed_users))  # Yangi komanda
+        app.add_handler(CommandHandler("stats", wrap(admin_stats)))
+        app.add_handler(CommandHandler("payments", wrap(admin_payments)))
+        app.add_handler(CommandHandler("archive", wrap(admin_archive)))
+        app.add_handler(CommandHandler("broadcast", wrap(admin_broadcast)))
+        app.add_handler(CommandHandler("broadcast_status", wrap(admin_broadcast_status)))
+        app.add_handler(CommandHandler("broadcast_stop", wrap(admin_broadcast_stop)))
+        app.add_handler(CommandHandler("users", wrap(admin_users)))
+        app.add_handler(CommandHandler("allusers", wrap(admin_detailed_users)))  # Yangi komanda
         
         # Callback handler
-        app.add_handler(CallbackQueryHandler(button_handler))
+        app.add_handler(CallbackQueryHandler(wrap(button_handler)))
         
         # Message handlerlar
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        app.add_handler(MessageHandler(filters.PHOTO, handle_message))
-        app.add_handler(MessageHandler(filters.LOCATION, handle_message))
-        app.add_handler(MessageHandler(filters.CONTACT, handle_message))
+        message_handler = wrap(handle_message)
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+        app.add_handler(MessageHandler(filters.PHOTO, message_handler))
+        app.add_handler(MessageHandler(filters.LOCATION, message_handler))
+        app.add_handler(MessageHandler(filters.CONTACT, message_handler))
 
         app.add_error_handler(error_handler)
         
-        logger.info("✅ Bot ishga tushdi! Polling rejimida...")
-        app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+        # Rejali vazifalar
+        if app.job_queue:
+            app.job_queue.run_repeating(run_scheduled_events, interval=SCHEDULER_TICK, first=SCHEDULER_TICK)
+            app.job_queue.run_repeating(purge_stale_registrations, interval=REGISTRATION_PURGE_INTERVAL, first=REGISTRATION_PURGE_INTERVAL)
+            app.job_queue.run_repeating(archive_old_records, interval=ARCHIVE_INTERVAL, first=ARCHIVE_FIRST_DELAY)
+        else:
+            logger.warning("⚠️ JobQueue mavjud emas: pip install \"python-telegram-bot[job-queue]\"")
+        
+        if BOT_MODE == "webhook":
+            logger.info("✅ Bot ishga tushdi! Webhook rejimida...")
+            asyncio.run(run_webhook(app))
+        else:
+            logger.info("✅ Bot ishga tushdi! Polling rejimida...")
+            app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
         
     except Exception as e:
         logger.error(f"❌ Botni ishga tushirishda xato: {e}")
@@ -1864,9 +5023,18 @@ def run_telegram_bot():
         traceback.print_exc()
 
 if __name__ == '__main__':
-    # 1. Flask serverni alohida threadda ishga tushiramiz
-    flask_thread = threading.Thread(target=run_flask_server, daemon=True)
-    flask_thread.start()
+    if len(sys.argv) > 1 and sys.argv[1] == 'stand-in':
+        # Lokal sinov: python telegram_bot.py stand-in <webhook_url> [updatelar soni]
+        webhook_url = sys.argv[2] if len(sys.argv) > 2 else f"http://127.0.0.1:{os.environ.get('PORT', 8000)}{WEBHOOK_PATH}"
+        count = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+        asyncio.run(run_stand_in(webhook_url, count=count))
+        sys.exit(0)
+    
+    # 1. Polling rejimida Flask serverni alohida threadda ishga tushiramiz
+    # (webhook rejimida bosh sahifa va /health bot serverining o'zida)
+    if BOT_MODE != "webhook":
+        flask_thread = threading.Thread(target=run_flask_server, daemon=True)
+        flask_thread.start()
     
     # 2. Asosiy threadda Telegram botni ishga tushiramiz
     run_telegram_bot()